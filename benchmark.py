@@ -0,0 +1,445 @@
+# benchmark.py
+# 离线基准测试: 用本地模拟服务代替 Unsplash/Pexels/Pixabay/Together 与火山引擎，对 main.py 的各个工具
+# 在不同并发度下测量 p50/p95/p99 延迟、吞吐量与每个场景的 RSS 变化，不访问任何付费或限流的外部接口。
+#
+#   python benchmark.py                                   # 全部场景，并发 1,4,16
+#   python benchmark.py --tools search_images,download_image --concurrency 1,8 --requests 200
+#   python benchmark.py --latency-ms 80 --error-rate 0.05 --save baseline.json
+#   python benchmark.py --compare baseline.json --tolerance 0.25   # p95/吞吐退化超过 25% 时退出码为 1
+
+import argparse
+import asyncio
+import base64
+import functools
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlsplit
+
+
+def _current_rss_mb() -> float | None:
+    # 当前 RSS (读 /proc/self/statm)；getrusage 的 ru_maxrss 是只增不减的进程高水位，无法按场景区分，
+    # 因此不用它；没有 /proc 的平台 (macOS/Windows) 返回 None
+    try:
+        with open("/proc/self/statm", "r") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values: return 0.0
+    position = (len(sorted_values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def _make_png(size: int) -> bytes:
+    # 随机像素的 PNG，压缩率接近真实照片，避免过小的响应体低估 base64/解码/写盘的开销
+    from PIL import Image
+
+    image = Image.frombytes("RGB", (size, size), os.urandom(size * size * 3))
+    buffer = BytesIO()
+    image.save(buffer, "PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+# --- 模拟上游服务 ---
+# 响应结构与真实接口一致 (Unsplash results / Pexels photos / Pixabay hits / Together data[].b64_json)，
+# 图片下载走 /images/<名称>.png；每个请求注入 latency_ms ± jitter 的延迟，并按 error_rate 返回 503。
+class _MockState:
+    def __init__(self, image_bytes: bytes, latency_ms: float, jitter_ms: float, error_rate: float):
+        self.image_bytes = image_bytes
+        self.image_b64 = base64.b64encode(image_bytes).decode("ascii")
+        self.latency_ms, self.jitter_ms, self.error_rate = latency_ms, jitter_ms, error_rate
+        self.base_url = None
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def delay(self):
+        seconds = max(0.0, self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+        if seconds: time.sleep(seconds)
+
+    def should_fail(self) -> bool:
+        failed = random.random() < self.error_rate
+        with self.lock:
+            self.requests += 1
+            if failed: self.errors += 1
+        return failed
+
+
+def _unsplash_payload(state: _MockState, query: str, per_page: int) -> dict:
+    results = []
+    for index in range(per_page):
+        photo_id = f"u{uuid.uuid4().hex[:11]}"
+        image_url = f"{state.base_url}/images/unsplash_{photo_id}.png"
+        results.append({
+            "id": photo_id, "created_at": "2024-05-01T12:00:00Z", "width": 4000, "height": 3000, "color": "#262626",
+            "blur_hash": "LEHV6nWB2yk8pyo0adR*.7kCMdnj", "likes": random.randint(0, 5000),
+            "description": f"{query} photo {index}", "alt_description": f"a {query}",
+            "urls": {"raw": image_url, "full": image_url + "?q=85", "regular": image_url + "?w=1080",
+                     "small": image_url + "?w=400", "thumb": image_url + "?w=200"},
+            "links": {"self": f"{state.base_url}/photos/{photo_id}", "html": f"{state.base_url}/p/{photo_id}",
+                      "download": image_url},
+            "user": {"id": uuid.uuid4().hex[:12], "username": "mock_user", "name": "Mock Photographer",
+                     "portfolio_url": None, "total_photos": 120}})
+    return {"total": 10000, "total_pages": 10000 // max(1, per_page), "results": results}
+
+
+def _pexels_payload(state: _MockState, query: str, per_page: int) -> dict:
+    photos = []
+    for index in range(per_page):
+        photo_id = random.randint(10 ** 6, 10 ** 8)
+        image_url = f"{state.base_url}/images/pexels_{photo_id}.png"
+        photos.append({
+            "id": photo_id, "width": 5000, "height": 3333, "url": f"{state.base_url}/photo/{photo_id}/",
+            "photographer": "Mock Photographer", "photographer_url": f"{state.base_url}/@mock",
+            "photographer_id": 42, "avg_color": "#7E7E7E", "liked": False, "alt": f"{query} {index}",
+            "src": {"original": image_url, "large2x": image_url + "?h=1300", "large": image_url + "?h=650",
+                    "medium": image_url + "?h=350", "small": image_url + "?h=130", "portrait": image_url + "?p=1",
+                    "landscape": image_url + "?l=1", "tiny": image_url + "?h=20"}})
+    return {"page": 1, "per_page": per_page, "total_results": 8000, "photos": photos,
+            "next_page": f"{state.base_url}/v1/search/?page=2&per_page={per_page}"}
+
+
+def _pixabay_payload(state: _MockState, query: str, per_page: int) -> dict:
+    hits = []
+    for index in range(per_page):
+        hit_id = random.randint(10 ** 6, 10 ** 7)
+        image_url = f"{state.base_url}/images/pixabay_{hit_id}.png"
+        hits.append({
+            "id": hit_id, "pageURL": f"{state.base_url}/photos/{hit_id}/", "type": "photo",
+            "tags": f"{query}, mock, benchmark", "previewURL": image_url + "?s=150", "previewWidth": 150,
+            "previewHeight": 99, "webformatURL": image_url + "?s=640", "webformatWidth": 640,
+            "webformatHeight": 426, "largeImageURL": image_url, "imageWidth": 4000, "imageHeight": 2667,
+            "imageSize": 2400000, "views": 1000, "downloads": 500, "collections": 10, "likes": 50,
+            "comments": 5, "user_id": 7, "user": "mock_user", "userImageURL": ""})
+    return {"total": 5000, "totalHits": 500, "hits": hits}
+
+
+def _together_payload(state: _MockState, request_body: dict) -> dict:
+    count = max(1, int(request_body.get("n", 1)))
+    return {"id": f"mock-{uuid.uuid4().hex}", "model": request_body.get("model"), "object": "list",
+            "data": [{"index": index, "b64_json": state.image_b64, "timings": {"inference": 0.5}}
+                     for index in range(count)]}
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: _MockState = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/json", extra_headers: dict = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (extra_headers or {}).items(): self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD": self.wfile.write(body)
+
+    def _send_json(self, payload: dict):
+        self._send(200, json.dumps(payload).encode("utf-8"))
+
+    def _injected_failure(self) -> bool:
+        self.state.delay()
+        if not self.state.should_fail(): return False
+        self._send(503, b'{"error": "injected failure"}', extra_headers={"Retry-After": "0"})
+        return True
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        if self._injected_failure(): return
+        per_page = int(params.get("per_page", 10))
+        query = params.get("query") or params.get("q") or ""
+        if parts.path == "/search/photos":
+            self._send_json(_unsplash_payload(self.state, query, per_page))
+        elif parts.path == "/v1/search":
+            self._send_json(_pexels_payload(self.state, query, per_page))
+        elif parts.path == "/api/":
+            self._send_json(_pixabay_payload(self.state, query, per_page))
+        elif parts.path.startswith("/images/"):
+            self._send(200, self.state.image_bytes, "image/png", {"ETag": '"mock-image"'})
+        else:
+            self._send(404, b'{"error": "not found"}')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self._injected_failure(): return
+        if urlsplit(self.path).path != "/v1/images/generations":
+            self._send(404, b'{"error": "not found"}')
+            return
+        self._send_json(_together_payload(self.state, json.loads(body or b"{}")))
+
+
+class _MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def handle_error(self, request, client_address):
+        # 客户端主动断开 (连接池丢弃/超时) 属于正常情况，不打印堆栈
+        if not isinstance(sys.exc_info()[1], (ConnectionError, TimeoutError)):
+            super().handle_error(request, client_address)
+
+
+def start_mock_server(state: _MockState) -> _MockServer:
+    handler = type("MockHandler", (_MockHandler,), {"state": state})
+    server = _MockServer(("127.0.0.1", 0), handler)
+    state.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, name="mock-upstream", daemon=True).start()
+    return server
+
+
+class _MockVolcengineApi:
+    # a_igc_stylize_image 的替身: 返回与 SDK 成功响应相同的结构 (code=10000, data.binary_data_base64=[...])；
+    # 注入的错误以业务错误码返回，与真实接口在 HTTP 200 下报告失败的方式一致
+    def __init__(self, state: _MockState):
+        self.state = state
+
+    def a_igc_stylize_image(self, request):
+        self.state.delay()
+        request_id = uuid.uuid4().hex
+        if self.state.should_fail():
+            return SimpleNamespace(code=50500, message="injected failure", request_id=request_id, data=None,
+                                   result=None)
+        return SimpleNamespace(code=10000, message="Success", request_id=request_id, result=None,
+                               data=SimpleNamespace(binary_data_base64=[self.state.image_b64], request_id=request_id))
+
+
+# --- 场景 ---
+# 场景表: 名称 -> (是否异步, call(ctx, index))；call 返回工具的 JSON 字符串 (异步场景返回协程)。
+# ctx 由 _scenario_context 构造，提供 main 模块、模拟上游状态、输入图片、风格名与输出目录；--list 直接读这张表。
+def _url(ctx, index: int) -> str:
+    return f"{ctx.state.base_url}/images/bench_{index}_{uuid.uuid4().hex[:8]}.png"
+
+
+def _query(index: int) -> str:
+    return f"query {index} {uuid.uuid4().hex[:6]}"
+
+
+SCENARIOS = {
+    "search_images": (False, lambda ctx, i: ctx.main.search_images(_query(i), "unsplash", "10")),
+    "search_images_all": (False, lambda ctx, i: ctx.main.search_images(_query(i), "all", "20")),
+    "search_images_async": (True, lambda ctx, i: ctx.main.search_images_async(_query(i), "all", "20")),
+    "download_image": (False, lambda ctx, i: ctx.main.download_image(_url(ctx, i), f"dl_{i}.png", ctx.out_dir)),
+    "download_image_async": (True, lambda ctx, i: ctx.main.download_image_async(_url(ctx, i), f"dl_{i}.png",
+                                                                                ctx.out_dir)),
+    "download_images": (False, lambda ctx, i: ctx.main.download_images(
+        json.dumps([[_url(ctx, i * 8 + k), f"batch_{i}_{k}.png"] for k in range(8)]), ctx.out_dir)),
+    "generate_icon_togetherai": (False, lambda ctx, i: ctx.main.generate_icon_togetherai(
+        f"icon {i}", f"gen_{i}.png", ctx.out_dir)),
+    "generate_icon_togetherai_async": (True, lambda ctx, i: ctx.main.generate_icon_togetherai_async(
+        f"icon {i}", f"gen_{i}.png", ctx.out_dir)),
+    "volcengine_style_transfer": (False, lambda ctx, i: ctx.main.volcengine_style_transfer(
+        ctx.input_images[i % 2], ctx.style_names[i % len(ctx.style_names)], f"styled_{i}.png", ctx.out_dir)),
+    "volcengine_style_transfer_async": (True, lambda ctx, i: ctx.main.volcengine_style_transfer_async(
+        ctx.input_images[i % 2], ctx.style_names[i % len(ctx.style_names)], f"styled_{i}.png", ctx.out_dir)),
+    "volcengine_style_transfer_batch": (False, lambda ctx, i: ctx.main.volcengine_style_transfer_batch(
+        ctx.input_images, ctx.style_names, ctx.out_dir, f"batch_{i}_{{image}}_{{style}}")),
+    "watermark_images": (False, lambda ctx, i: ctx.main.watermark_images(
+        [ctx.input_images[i % 2]], text=f"mark {i}", save_folder=ctx.out_dir)),
+}
+
+
+def _scenario_context(main, state: _MockState, work_dir: str) -> SimpleNamespace:
+    input_images = []
+    for index in range(2):
+        path = os.path.join(work_dir, f"input_{index}.png")
+        with open(path, "wb") as f:
+            f.write(state.image_bytes)
+        input_images.append(path)
+    return SimpleNamespace(main=main, state=state, input_images=input_images,
+                           style_names=list(main.VOLCENGINE_STYLES)[:2], out_dir=os.path.join(work_dir, "out"))
+
+
+def _succeeded(result) -> bool:
+    try:
+        return bool(json.loads(result).get("success"))
+    except (TypeError, ValueError, AttributeError):
+        return False
+
+
+def _run_sync(call, requests_count: int, concurrency: int) -> tuple[list[float], int, float]:
+    def timed(index: int) -> tuple[float, bool]:
+        started = time.perf_counter()
+        try:
+            ok = _succeeded(call(index))
+        except Exception:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bench") as executor:
+        outcomes = list(executor.map(timed, range(requests_count)))
+    return [latency for latency, _ in outcomes], sum(1 for _, ok in outcomes if not ok), time.perf_counter() - started
+
+
+def _run_async(call, requests_count: int, concurrency: int) -> tuple[list[float], int, float]:
+    async def runner() -> tuple[list, float]:
+        slots = asyncio.Semaphore(concurrency)
+
+        async def timed(index: int) -> tuple[float, bool]:
+            async with slots:
+                started = time.perf_counter()
+                try:
+                    ok = _succeeded(await call(index))
+                except Exception:
+                    ok = False
+                return time.perf_counter() - started, ok
+
+        started = time.perf_counter()
+        outcomes = await asyncio.gather(*(timed(index) for index in range(requests_count)))
+        return outcomes, time.perf_counter() - started
+
+    outcomes, wall = asyncio.run(runner())
+    return [latency for latency, _ in outcomes], sum(1 for _, ok in outcomes if not ok), wall
+
+
+def _configure_main(main, state: _MockState, work_dir: str, args):
+    # 配置快照只读，通过运行时覆盖指向 mock 上游；rate 为 0 表示不限速
+    overrides = {
+        "api": {"unsplash_access_key": "mock", "pexels_api_key": "mock", "pixabay_api_key": "mock",
+                "together_api_key": "mock", "max_retries": args.max_retries, "retry_delay": 0.05,
+                "retry_max_delay": 0.5,
+                "rate_limits": {name: {"rate": 0} for name in main.CONFIG["api"]["rate_limits"]},
+                "endpoints": {name: state.base_url for name in ("unsplash", "pexels", "pixabay", "together")},
+                "volcengine": {"access_key_id": "mock", "secret_access_key": "mock"}},
+        "output": {"base_folder": work_dir},
+        "metrics": {"enabled": True},
+    }
+    if not args.cache: overrides["cache"] = {name: {"enabled": False} for name in main.CONFIG["cache"]}
+    main._CONFIG.apply_overrides(overrides)
+    if not args.verbose:
+        # 注入的错误会产生大量预期内的错误日志，默认静默以免干扰结果输出
+        for name in ("mcp_images", "urllib3"): logging.getLogger(name).setLevel(logging.CRITICAL)
+    volcengine_api = _MockVolcengineApi(state)
+    main._VOLCENGINE_CLIENTS.get = lambda ak, sk, region: volcengine_api
+
+
+def _stage_summary(main) -> list[dict]:
+    return [{key: stage[key] for key in ("name", "provider", "calls", "errors", "latency_ms")}
+            for stage in main._METRICS.snapshot()["stages"]]
+
+
+def run_benchmark(args) -> dict:
+    work_dir = tempfile.mkdtemp(prefix="mcp_images_bench_")
+    state = _MockState(_make_png(args.image_size), args.latency_ms, args.jitter_ms, args.error_rate)
+    server = start_mock_server(state)
+    import main
+
+    _configure_main(main, state, work_dir, args)
+    context = _scenario_context(main, state, work_dir)
+    selected = list(SCENARIOS) if args.tools == "all" else [name.strip() for name in args.tools.split(",") if name]
+    unknown = [name for name in selected if name not in SCENARIOS]
+    if unknown: raise SystemExit(f"未知场景: {', '.join(unknown)}. 可选: {', '.join(SCENARIOS)}")
+    results = []
+    try:
+        for name in selected:
+            is_async, scenario = SCENARIOS[name]
+            call = functools.partial(scenario, context)
+            for concurrency in args.concurrency:
+                main._METRICS.reset()
+                requests_count = max(args.requests, concurrency)
+                rss_before = _current_rss_mb()
+                latencies, errors, wall = (_run_async if is_async else _run_sync)(call, requests_count, concurrency)
+                rss_after = _current_rss_mb()
+                latencies.sort()
+                row = {"tool": name, "concurrency": concurrency, "requests": requests_count, "errors": errors,
+                       "p50_ms": round(_percentile(latencies, 0.50) * 1000, 2),
+                       "p95_ms": round(_percentile(latencies, 0.95) * 1000, 2),
+                       "p99_ms": round(_percentile(latencies, 0.99) * 1000, 2),
+                       "throughput_rps": round(requests_count / wall, 2) if wall else 0.0,
+                       "rss_delta_mb": None if rss_before is None or rss_after is None
+                       else round(rss_after - rss_before, 1)}
+                if args.stages: row["stages"] = _stage_summary(main)
+                results.append(row)
+                _print_row(row)
+    finally:
+        server.shutdown()
+        if not args.keep: shutil.rmtree(work_dir, ignore_errors=True)
+    return {"settings": {"latency_ms": args.latency_ms, "jitter_ms": args.jitter_ms, "error_rate": args.error_rate,
+                         "image_size": args.image_size, "cache": args.cache},
+            "upstream": {"requests": state.requests, "injected_errors": state.errors}, "results": results}
+
+
+def _print_row(row: dict):
+    rss = "-" if row["rss_delta_mb"] is None else f"{row['rss_delta_mb']:+.1f}"
+    print(f"{row['tool']:<34} c={row['concurrency']:<4} n={row['requests']:<5} err={row['errors']:<4} "
+          f"p50={row['p50_ms']:>9.2f}ms p95={row['p95_ms']:>9.2f}ms p99={row['p99_ms']:>9.2f}ms "
+          f"{row['throughput_rps']:>9.2f} req/s  rss={rss}MB", flush=True)
+
+
+def compare_with_baseline(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    # p95 变慢或吞吐下降超过 tolerance (相对比例) 的 (工具, 并发) 组合视为退化
+    previous = {(row["tool"], row["concurrency"]): row for row in baseline.get("results", [])}
+    regressions = []
+    for row in report["results"]:
+        base = previous.get((row["tool"], row["concurrency"]))
+        if base is None: continue
+        if base["p95_ms"] and row["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{row['tool']} c={row['concurrency']}: p95 {base['p95_ms']}ms -> {row['p95_ms']}ms")
+        if base["throughput_rps"] and row["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{row['tool']} c={row['concurrency']}: 吞吐 {base['throughput_rps']} -> "
+                               f"{row['throughput_rps']} req/s")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark for main.py tools against local mock upstreams")
+    parser.add_argument("--tools", default="all", help="逗号分隔的场景名，默认 all；--list 查看可选场景")
+    parser.add_argument("--list", action="store_true", help="列出可选场景后退出")
+    parser.add_argument("--concurrency", default="1,4,16",
+                        type=lambda value: [max(1, int(item)) for item in value.split(",") if item.strip()],
+                        help="逗号分隔的并发度列表")
+    parser.add_argument("--requests", type=int, default=50, help="每个 (场景, 并发度) 的调用次数")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="模拟上游的注入延迟 (毫秒)")
+    parser.add_argument("--jitter-ms", type=float, default=5.0, help="注入延迟的随机抖动 (毫秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟上游返回错误的概率 (0-1)")
+    parser.add_argument("--max-retries", type=int, default=2, help="覆盖 api.max_retries")
+    parser.add_argument("--image-size", type=int, default=512, help="模拟图片的边长 (像素)")
+    parser.add_argument("--cache", action="store_true", help="保留各类结果缓存 (默认关闭以测量冷路径)")
+    parser.add_argument("--stages", action="store_true", help="在结果中附带每个场景的阶段指标 (get_metrics)")
+    parser.add_argument("--verbose", action="store_true", help="保留 main.py 与 urllib3 的日志输出")
+    parser.add_argument("--keep", action="store_true", help="保留临时输出目录")
+    parser.add_argument("--save", help="把结果写入 JSON 文件 (可作为之后 --compare 的基线)")
+    parser.add_argument("--compare", help="与基线 JSON 比较，退化时退出码为 1")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="--compare 允许的相对退化比例")
+    return parser.parse_args(argv)
+
+
+def main_cli(argv=None) -> int:
+    args = parse_args(argv)
+    if args.list:
+        print("\n".join(SCENARIOS))
+        return 0
+    report = run_benchmark(args)
+    print(f"upstream requests={report['upstream']['requests']} injected_errors={report['upstream']['injected_errors']}")
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            regressions = compare_with_baseline(report, json.load(f), args.tolerance)
+        for line in regressions: print(f"REGRESSION: {line}")
+        if regressions: return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -1,26 +1,136 @@
 # main.py
 
+import time
+
+_IMPORT_STARTED = time.perf_counter()
+
 import json
+import logging
 import os
+import random
 import base64
+import hashlib
+import importlib
+import importlib.util
+import mmap
+import struct
+import shutil
 import uuid
 from io import BytesIO
-from PIL import Image, ImageDraw, ImageFont
 import argparse
-import traceback
 import sys
-import requests
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import functools
+import inspect
+import threading
+import weakref
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, wait
+from types import MappingProxyType, SimpleNamespace
+from urllib.parse import urlsplit
+
+logger = logging.getLogger("mcp_images")
+
+# --- 启动耗时与延迟加载的依赖 ---
+# PIL、requests、httpx 与火山引擎 SDK 都在首次使用时才导入：MCP 宿主按会话通过 stdio 拉起服务时，
+# 只用搜索/下载的会话不需要付出 PIL 与火山引擎 SDK 的导入开销，也不要求安装火山引擎 SDK。
+_STARTUP_REPORT = {"phases_ms": {}, "lazy_imports_ms": {}}
+
+
+def _mark_startup(phase: str):
+    _STARTUP_REPORT["phases_ms"][phase] = round((time.perf_counter() - _IMPORT_STARTED) * 1000, 1)
+
+
+class _LazyModule:
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            started = time.perf_counter()
+            module = importlib.import_module(self._name)
+            _STARTUP_REPORT["lazy_imports_ms"].setdefault(self._name, round((time.perf_counter() - started) * 1000, 1))
+            self._module = module
+        return self._module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+
+Image = _LazyModule("PIL.Image")
+ImageDraw = _LazyModule("PIL.ImageDraw")
+ImageFont = _LazyModule("PIL.ImageFont")
+requests = _LazyModule("requests")
+# 异步 HTTP 客户端 (FastMCP 的依赖)；缺失时异步工具退化为线程池中执行同步实现
+httpx = _LazyModule("httpx") if importlib.util.find_spec("httpx") else None
+
+
+class BackendUnavailableError(ImportError):
+    pass
+
+
+# 可选的服务后端插件: 首次调用相关工具时才导入其 SDK；未安装时只有依赖它的工具返回错误，其余工具照常可用
+class _Backend:
+    def __init__(self, name: str, modules: dict[str, str], install_hint: str):
+        self.name = name
+        self._modules = modules
+        self._install_hint = install_hint
+        self._lock = threading.Lock()
+        self._loaded = None
+
+    def available(self) -> bool:
+        # 只查找顶层包而不导入
+        return all(importlib.util.find_spec(module.split(".")[0]) is not None for module in self._modules.values())
+
+    def loaded(self) -> bool:
+        return self._loaded is not None
+
+    def load(self) -> SimpleNamespace:
+        if self._loaded is not None: return self._loaded
+        with self._lock:
+            if self._loaded is None:
+                started, modules = time.perf_counter(), {}
+                for alias, module_name in self._modules.items():
+                    try:
+                        modules[alias] = importlib.import_module(module_name)
+                    except ImportError as e_import:
+                        raise BackendUnavailableError(
+                            f"{self.name} 后端不可用: 无法导入 {module_name} ({e_import})。请安装: {self._install_hint}"
+                        ) from e_import
+                _STARTUP_REPORT["lazy_imports_ms"][f"backend:{self.name}"] = round(
+                    (time.perf_counter() - started) * 1000, 1)
+                logger.debug("%s 后端已加载 (%.1f ms)", self.name, (time.perf_counter() - started) * 1000)
+                self._loaded = SimpleNamespace(**modules)
+        return self._loaded
+
+    def status(self) -> dict:
+        return {"available": self.available(), "loaded": self.loaded()}
+
+
+_BACKENDS = {
+    "volcengine": _Backend("volcengine", {"core": "volcenginesdkcore", "rest": "volcenginesdkcore.rest",
+                                          "cv": "volcenginesdkcv20240606"}, "pip install volcengine-python-sdk"),
+}
+
+
+class _NeverRaised(Exception):
+    pass
+
+
+def _volcengine_sdk() -> SimpleNamespace:
+    return _BACKENDS["volcengine"].load()
+
+
+def _volcengine_api_exception() -> type:
+    # 供 except 子句使用: SDK 尚未加载时不可能抛出 ApiException，返回一个永不匹配的异常类型而不触发导入
+    backend = _BACKENDS["volcengine"]
+    return backend.load().rest.ApiException if backend.loaded() else _NeverRaised
 
-# --- Volcengine SDK Imports ---
-try:
-    import volcenginesdkcore
-    import volcenginesdkcv20240606
-    from volcenginesdkcore.rest import ApiException
-    from volcenginesdkcore.configuration import Configuration
-except ImportError:
-    print("致命错误: 无法导入火山引擎核心 SDK (volcenginesdkcore 或 volcenginesdkcv*)。")
-    print("请确保已正确安装: pip install volcengine-python-sdk")
-    sys.exit(1)
 
 # --- MCP Framework Import (假设存在) ---
 try:
@@ -28,7 +138,7 @@ try:
 
     app = FastMCP(name="图片处理与生成服务_MCP_App")
 except ImportError:
-    print("警告: FastMCP 框架未找到。如果您不使用此框架，可以忽略此消息。")
+    logger.warning("FastMCP 框架未找到。如果您不使用此框架，可以忽略此消息。")
 
 
     class DummyApp:
@@ -39,123 +149,795 @@ except ImportError:
 
 
     app = DummyApp()
+_mark_startup("imports")
 
+# --- 配置 (可热更新的只读快照) ---
+# 配置按 默认值 < config.json < 环境变量 < 运行时覆盖 逐层深度合并，经 _validate_config 校验后冻结为只读快照并
+# 原子替换；校验失败时保留旧快照。环境变量形如 MCP_IMAGES__API__TIMEOUT=30 (以 "__" 分隔的键路径，值按 JSON 解析，
+# 解析失败时作为字符串)。工具调用开始时固定当前快照 (见 _metered)，进行中的请求在旧快照上完成；
+# 快照变化涉及的资源 (HTTP 连接池、火山引擎客户端、线程池、日志级别) 由 subscribe 注册的回调重建。
 CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")
-CONFIG = {}
-VOLCENGINE_STYLES = {}
-
-
-def load_config(config_path="config.json"):
-    global CONFIG, VOLCENGINE_STYLES, CONFIG_FILE
-    CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), config_path)
-    default_config = {
-        "api": {
-            "unsplash_access_key": "", "pexels_api_key": "", "pixabay_api_key": "", "together_api_key": "",
-            "volcengine": {"access_key_id": "YOUR_AK_HERE", "secret_access_key": "YOUR_SK_HERE",
-                           "region": "cn-beijing"},
-            "timeout": 60, "max_retries": 3, "retry_delay": 5
-        },
-        "server": {"name": "图片处理与生成服务", "host": "0.0.0.0", "port": 5173},
-        "image": {"max_results": 20, "default_width": 512, "default_height": 512},
-        "output": {"base_folder": "generated_images", "default_extension": ".png",
-                   "allowed_extensions": [".png", ".jpg", ".jpeg", ".svg", ".webp"],
-                   "logo_font_path": None, "logo_font_size": 20},
-        "volcengine_styles": {
-            "动漫风": {"req_key": "img2img_cartoon_style"},
-            "国风-水墨": {"req_key": "img2img_pretty_style", "sub_req_key": "img2img_pretty_style_ink"},
-            "写实漫画": {"req_key": "img2img_comic_style"},
-            "通用模型": {"req_key": "img2img_general_style"},
-            "网红日漫风": {"req_key": "img2img_ghibli_style"},
-            "3D风": {"req_key": "img2img_disney_3d_style"},
-            "写实风": {"req_key": "img2img_real_mix_style"},
-            "天使风": {"req_key": "img2img_pastel_boys_style"},
-            "日漫风": {"req_key": "img2img_makoto_style"},
-            "公主风": {"req_key": "img2img_rev_animated_style"},
-            "梦幻风": {"req_key": "img2img_blueline_style"},
-            "水墨风": {"req_key": "img2img_water_ink_style"},
-            "新莫奈花园": {"req_key": "i2i_ai_create_monet"},
-            "水彩风": {"req_key": "img2img_water_paint_style"},
-            "莫奈花园": {"req_key": "img2img_comic_style", "sub_req_key": "img2img_comic_style_monet"},
-            "精致美漫": {"req_key": "img2img_comic_style", "sub_req_key": "img2img_comic_style_marvel"},
-            "赛博机械": {"req_key": "img2img_comic_style", "sub_req_key": "img2img_comic_style_future"},
-            "精致韩漫": {"req_key": "img2img_exquisite_style"},
-            "浪漫光影": {"req_key": "img2img_pretty_style", "sub_req_key": "img2img_pretty_style_light"},
-            "陶瓷娃娃": {"req_key": "img2img_ceramics_style"},
-            "中国红": {"req_key": "img2img_chinese_style"},
-            "丑萌粘土": {"req_key": "img2img_clay_style", "sub_req_key": "img2img_clay_style_3d"},
-            "可爱玩偶": {"req_key": "img2img_clay_style", "sub_req_key": "img2img_clay_style_bubble"},
-            "3D-游戏_Z时代": {"req_key": "img2img_3d_style", "sub_req_key": "img2img_3d_style_era"},
-            "动画电影": {"req_key": "img2img_3d_style", "sub_req_key": "img2img_3d_style_movie"},
-            "玩偶": {"req_key": "img2img_3d_style", "sub_req_key": "img2img_3d_style_doll"}
+_CONFIG_ENV_PREFIX = "MCP_IMAGES__"
+_DEFAULT_CONFIG = {
+    "api": {
+        "unsplash_access_key": "", "pexels_api_key": "", "pixabay_api_key": "", "together_api_key": "",
+        "volcengine": {"access_key_id": "YOUR_AK_HERE", "secret_access_key": "YOUR_SK_HERE",
+                       "region": "cn-beijing", "max_workers": 32, "batch_concurrency": 4},
+        "timeout": 60, "max_retries": 3, "retry_delay": 5, "retry_max_delay": 60, "call_deadline": 180,
+        "search_deadline": 15,
+        "endpoints": {"unsplash": "https://api.unsplash.com", "pexels": "https://api.pexels.com",
+                      "pixabay": "https://pixabay.com", "together": "https://api.together.xyz"},
+        "http_pool": {"max_hosts": 16, "pool_connections": 4, "per_host_connections": 10, "keep_alive": True,
+                      "block": False},
+        "rate_limits": {
+            "unsplash": {"rate": 50 / 3600, "burst": 50},
+            "pexels": {"rate": 200 / 3600, "burst": 200},
+            "pixabay": {"rate": 100 / 60, "burst": 100},
+            "together": {"rate": 2, "burst": 4},
+            "volcengine": {"rate": 2, "burst": 2}
         }
+    },
+    "server": {"name": "图片处理与生成服务", "host": "0.0.0.0", "port": 5173, "blocking_workers": 32},
+    "image": {"max_results": 20, "default_width": 512, "default_height": 512,
+              "auto_fit_inputs": True, "fit_max_side": 4096, "fit_target_bytes": 4 * 1024 * 1024,
+              "fit_quality": 90, "fit_min_quality": 60, "restore_output_size": False,
+              "max_variants": 4, "generation_workers": 4},
+    "output": {"base_folder": "generated_images", "default_extension": ".png",
+               "allowed_extensions": [".png", ".jpg", ".jpeg", ".svg", ".webp"],
+               "logo_font_path": None, "logo_font_size": 20,
+               "derivatives": {"enabled": False, "sizes": [64, 128, 256, 512], "formats": ["png", "webp"],
+                               "subfolder": None, "webp_quality": 90, "max_workers": None}},
+    "logging": {"level": "INFO", "format": "%(asctime)s %(levelname)s %(name)s: %(message)s"},
+    "metrics": {"enabled": True, "prometheus_path": "/metrics", "max_series": 2000},
+    "config": {"watch_interval": 2.0},
+    "jobs": {"workers": 2, "max_queued": 1000, "max_attempts": 2, "lease": 60, "poll_interval": 1.0,
+             "retention_days": 7, "database": "jobs.sqlite3"},
+    "download": {"max_workers": 8, "per_host_limit": 4, "max_bytes": 200 * 1024 * 1024, "resume_attempts": 3,
+                 "min_chunk_size": 64 * 1024, "max_chunk_size": 1024 * 1024},
+    "cache": {
+        "search": {"enabled": True, "ttl": 3600, "max_entries": 512, "persist": True},
+        "stylize": {"enabled": True, "max_bytes": 1024 * 1024 * 1024, "link_mode": "hardlink"},
+        "downloads": {"enabled": True, "max_bytes": 2 * 1024 * 1024 * 1024, "link_mode": "hardlink",
+                      "url_ttl": 30 * 24 * 3600},
+        "generations": {"enabled": True, "max_bytes": 1024 * 1024 * 1024, "link_mode": "hardlink"}
+    },
+    "volcengine_styles": {
+        "动漫风": {"req_key": "img2img_cartoon_style"},
+        "国风-水墨": {"req_key": "img2img_pretty_style", "sub_req_key": "img2img_pretty_style_ink"},
+        "写实漫画": {"req_key": "img2img_comic_style"},
+        "通用模型": {"req_key": "img2img_general_style"},
+        "网红日漫风": {"req_key": "img2img_ghibli_style"},
+        "3D风": {"req_key": "img2img_disney_3d_style"},
+        "写实风": {"req_key": "img2img_real_mix_style"},
+        "天使风": {"req_key": "img2img_pastel_boys_style"},
+        "日漫风": {"req_key": "img2img_makoto_style"},
+        "公主风": {"req_key": "img2img_rev_animated_style"},
+        "梦幻风": {"req_key": "img2img_blueline_style"},
+        "水墨风": {"req_key": "img2img_water_ink_style"},
+        "新莫奈花园": {"req_key": "i2i_ai_create_monet"},
+        "水彩风": {"req_key": "img2img_water_paint_style"},
+        "莫奈花园": {"req_key": "img2img_comic_style", "sub_req_key": "img2img_comic_style_monet"},
+        "精致美漫": {"req_key": "img2img_comic_style", "sub_req_key": "img2img_comic_style_marvel"},
+        "赛博机械": {"req_key": "img2img_comic_style", "sub_req_key": "img2img_comic_style_future"},
+        "精致韩漫": {"req_key": "img2img_exquisite_style"},
+        "浪漫光影": {"req_key": "img2img_pretty_style", "sub_req_key": "img2img_pretty_style_light"},
+        "陶瓷娃娃": {"req_key": "img2img_ceramics_style"},
+        "中国红": {"req_key": "img2img_chinese_style"},
+        "丑萌粘土": {"req_key": "img2img_clay_style", "sub_req_key": "img2img_clay_style_3d"},
+        "可爱玩偶": {"req_key": "img2img_clay_style", "sub_req_key": "img2img_clay_style_bubble"},
+        "3D-游戏_Z时代": {"req_key": "img2img_3d_style", "sub_req_key": "img2img_3d_style_era"},
+        "动画电影": {"req_key": "img2img_3d_style", "sub_req_key": "img2img_3d_style_movie"},
+        "玩偶": {"req_key": "img2img_3d_style", "sub_req_key": "img2img_3d_style_doll"}
     }
-    if os.path.exists(CONFIG_FILE):
-        print(f"Attempting to load config from: {CONFIG_FILE}")
-        try:
-            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                loaded_config = json.load(f)
-            CONFIG = {};
-            for key, default_value in default_config.items():
-                if key in loaded_config:
-                    if isinstance(default_value, dict) and isinstance(loaded_config[key], dict):
-                        CONFIG[key] = default_value.copy();
-                        CONFIG[key].update(loaded_config[key])
-                    else:
-                        CONFIG[key] = loaded_config[key]
-                else:
-                    CONFIG[key] = default_value
-            print("--- Successfully loaded CONFIG content (merged with defaults): ---")
-        except Exception as e_load:
-            print(f"加载配置文件时发生错误: {str(e_load)}. 将使用默认配置。"); CONFIG = default_config
+}
+# 校验时只检查取值范围的键路径；类型按 _DEFAULT_CONFIG 中对应默认值检查
+_CONFIG_RULES = {
+    ("api", "timeout"): (lambda value: value > 0, "必须大于 0"),
+    ("api", "call_deadline"): (lambda value: value > 0, "必须大于 0"),
+    ("api", "search_deadline"): (lambda value: value > 0, "必须大于 0"),
+    ("api", "max_retries"): (lambda value: value >= 0, "不能为负数"),
+    ("api", "volcengine", "max_workers"): (lambda value: value >= 1, "必须至少为 1"),
+    ("api", "volcengine", "batch_concurrency"): (lambda value: value >= 1, "必须至少为 1"),
+    ("api", "http_pool", "max_hosts"): (lambda value: value >= 1, "必须至少为 1"),
+    ("api", "http_pool", "per_host_connections"): (lambda value: value >= 1, "必须至少为 1"),
+    ("server", "port"): (lambda value: 0 < value < 65536, "必须在 1-65535 之间"),
+    ("server", "blocking_workers"): (lambda value: value >= 1, "必须至少为 1"),
+    ("image", "max_results"): (lambda value: value >= 1, "必须至少为 1"),
+    ("image", "max_variants"): (lambda value: value >= 1, "必须至少为 1"),
+    ("output", "allowed_extensions"): (lambda value: all(isinstance(ext, str) and ext.startswith(".")
+                                                         for ext in value), "每项必须是以 '.' 开头的扩展名"),
+    ("logging", "level"): (lambda value: isinstance(logging.getLevelName(value.upper()), int), "不是有效的日志级别"),
+    ("config", "watch_interval"): (lambda value: value >= 0, "不能为负数"),
+    ("jobs", "workers"): (lambda value: value >= 1, "必须至少为 1"),
+    ("jobs", "max_queued"): (lambda value: value >= 1, "必须至少为 1"),
+    ("jobs", "max_attempts"): (lambda value: value >= 1, "必须至少为 1"),
+    ("jobs", "lease"): (lambda value: value > 0, "必须大于 0"),
+    ("jobs", "poll_interval"): (lambda value: value > 0, "必须大于 0"),
+}
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def _deep_merge(base: dict, override: dict) -> dict:
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _deep_merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def _freeze(value):
+    if isinstance(value, dict): return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)): return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _thaw(value):
+    if isinstance(value, Mapping): return {key: _thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple): return [_thaw(item) for item in value]
+    return value
+
+
+def _changed_paths(old, new, prefix: str = "") -> set[str]:
+    # 返回取值不同的键路径 (含其所有上级路径)，如 {"api", "api.http_pool", "api.http_pool.max_hosts"}
+    if old == new: return set()
+    changed = {prefix} if prefix else set()
+    if isinstance(old, Mapping) and isinstance(new, Mapping):
+        for key in set(old) | set(new):
+            changed |= _changed_paths(old.get(key), new.get(key), f"{prefix}.{key}" if prefix else str(key))
+    return changed
+
+
+def _type_errors(value, default, path: tuple) -> list[str]:
+    if default is None: return []
+    dotted = ".".join(path)
+    if isinstance(default, bool):
+        return [] if isinstance(value, bool) else [f"{dotted} 应为布尔值"]
+    if isinstance(default, (int, float)):
+        return [] if isinstance(value, (int, float)) and not isinstance(value, bool) else [f"{dotted} 应为数字"]
+    if isinstance(default, str):
+        return [] if isinstance(value, str) else [f"{dotted} 应为字符串"]
+    if isinstance(default, list):
+        return [] if isinstance(value, (list, tuple)) else [f"{dotted} 应为列表"]
+    if isinstance(default, dict):
+        if not isinstance(value, dict): return [f"{dotted} 应为对象"]
+        errors = []
+        for key, item in value.items():
+            if key in default: errors.extend(_type_errors(item, default[key], path + (key,)))
+        return errors
+    return []
+
+
+def _validate_config(config: dict) -> list[str]:
+    errors = []
+    for key, value in config.items():
+        if key in _DEFAULT_CONFIG and key != "volcengine_styles":
+            errors.extend(_type_errors(value, _DEFAULT_CONFIG[key], (key,)))
+    if errors: return errors
+    for path, (check, message) in _CONFIG_RULES.items():
+        value = config
+        for key in path: value = value.get(key) if isinstance(value, dict) else None
+        if value is not None and not check(value): errors.append(f"{'.'.join(path)} {message}: {value!r}")
+    output = config.get("output", {})
+    if output.get("default_extension") not in output.get("allowed_extensions", ()):
+        errors.append(f"output.default_extension 不在 allowed_extensions 中: {output.get('default_extension')!r}")
+    for provider, limit in config.get("api", {}).get("rate_limits", {}).items():
+        if not isinstance(limit, dict):
+            errors.append(f"api.rate_limits.{provider} 应为对象"); continue
+        rate, burst = limit.get("rate", 0), limit.get("burst", 1)
+        if not isinstance(rate, (int, float)) or isinstance(rate, bool) or rate < 0:
+            errors.append(f"api.rate_limits.{provider}.rate 应为非负数字: {rate!r}")
+        if not isinstance(burst, (int, float)) or isinstance(burst, bool) or burst < 1:
+            errors.append(f"api.rate_limits.{provider}.burst 应为不小于 1 的数字: {burst!r}")
+    styles = config.get("volcengine_styles")
+    if not isinstance(styles, dict):
+        errors.append("volcengine_styles 应为对象")
     else:
-        print(f"警告: 配置文件 {CONFIG_FILE} 未找到。将使用默认配置并尝试创建。");
-        CONFIG = default_config
-        try:
-            with open(CONFIG_FILE, 'w', encoding='utf-8') as f_create:
-                json.dump(CONFIG, f_create, indent=4, ensure_ascii=False)
-            print(f"已创建默认配置文件: {CONFIG_FILE}。请检查并填入您的 API 密钥。")
-        except Exception as e_create_conf:
-            print(f"创建默认配置文件失败: {e_create_conf}")
-    api_conf = CONFIG.setdefault("api", default_config["api"])
-    volc_conf_init = api_conf.setdefault("volcengine", default_config["api"]["volcengine"])
-    volc_conf_init.setdefault("access_key_id", default_config["api"]["volcengine"]["access_key_id"])
-    volc_conf_init.setdefault("secret_access_key", default_config["api"]["volcengine"]["secret_access_key"])
-    volc_conf_init.setdefault("region", default_config["api"]["volcengine"]["region"])
-    CONFIG.setdefault("server", default_config["server"]);
-    CONFIG.setdefault("image", default_config["image"])
-    output_config = CONFIG.setdefault("output", default_config["output"])
-    output_config.setdefault("base_folder", default_config["output"]["base_folder"])
-    output_config.setdefault("allowed_extensions", default_config["output"]["allowed_extensions"])
-    VOLCENGINE_STYLES = CONFIG.setdefault("volcengine_styles", default_config["volcengine_styles"])
-    if not os.path.isabs(CONFIG["output"]["base_folder"]):
-        CONFIG["output"]["base_folder"] = os.path.join(os.path.dirname(os.path.abspath(__file__)),
-                                                       CONFIG["output"]["base_folder"])
-    os.makedirs(CONFIG["output"]["base_folder"], exist_ok=True)
+        for style_name, params in styles.items():
+            req_key = params.get("req_key") if isinstance(params, dict) else params
+            if not isinstance(req_key, str) or not req_key:
+                errors.append(f"volcengine_styles.{style_name} 缺少有效的 req_key")
+    return errors
+
+
+def _env_config_overrides() -> dict:
+    overrides = {}
+    for name, raw_value in os.environ.items():
+        if not name.startswith(_CONFIG_ENV_PREFIX): continue
+        path = [part.lower() for part in name[len(_CONFIG_ENV_PREFIX):].split("__") if part]
+        if not path: continue
+        try:
+            value = json.loads(raw_value)
+        except ValueError:
+            value = raw_value
+        section = overrides
+        for key in path[:-1]: section = section.setdefault(key, {})
+        section[path[-1]] = value
+    return overrides
+
+
+def _warn_missing_keys(config: Mapping):
     missing_keys = []
-    volc_conf_startup_check = CONFIG.get("api", {}).get("volcengine", {})
-    if not volc_conf_startup_check.get("access_key_id") or volc_conf_startup_check.get(
-        "access_key_id") == "YOUR_AK_HERE": missing_keys.append("volcengine (access_key_id)")
-    if not volc_conf_startup_check.get("secret_access_key") or volc_conf_startup_check.get(
-        "secret_access_key") == "YOUR_SK_HERE": missing_keys.append("volcengine (secret_access_key)")
-    if missing_keys: print(
-        f"警告 (启动时检查): 以下 API 密钥/配置未在 config.json 中完全配置: {', '.join(missing_keys)}。火山引擎相关功能可能受限。")
+    volc_conf = config.get("api", {}).get("volcengine", {})
+    if not volc_conf.get("access_key_id") or volc_conf.get("access_key_id") == "YOUR_AK_HERE":
+        missing_keys.append("volcengine (access_key_id)")
+    if not volc_conf.get("secret_access_key") or volc_conf.get("secret_access_key") == "YOUR_SK_HERE":
+        missing_keys.append("volcengine (secret_access_key)")
+    if missing_keys: logger.warning(
+        "配置检查: 以下 API 密钥/配置未在 config.json 中完全配置: %s。火山引擎相关功能可能受限。", ", ".join(missing_keys))
+
+
+_PINNED_CONFIG = contextvars.ContextVar("pinned_config", default=None)
+
+
+class _ConfigStore:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._snapshot = _freeze({})
+        self._version = 0
+        self._overrides = {}
+        self._file_config = {}  # 最近一次成功读取的 config.json 内容
+        self._subscribers = []
+        self._file_signature = None
+        self._loaded_at = None
+        self._last_error = None
+        self._stop = threading.Event()
+        self._watcher = None
+
+    def current(self) -> Mapping:
+        # 工具调用期间返回调用开始时固定的快照，其余情况返回最新快照
+        return _PINNED_CONFIG.get() or self._snapshot
+
+    def pin(self) -> contextvars.Token:
+        return _PINNED_CONFIG.set(self._snapshot)
+
+    @staticmethod
+    def unpin(token: contextvars.Token):
+        _PINNED_CONFIG.reset(token)
+
+    def subscribe(self, path: str, callback):
+        # path 对应的配置 (含其下级键) 变化时调用 callback()；在新快照生效后同步调用
+        self._subscribers.append((path, callback))
+
+    @staticmethod
+    def _signature():
+        try:
+            stat = os.stat(CONFIG_FILE)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _read_file(self) -> dict:
+        if not os.path.exists(CONFIG_FILE): return {}
+        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+            loaded = json.load(f)
+        if not isinstance(loaded, dict): raise ConfigError(f"{CONFIG_FILE} 的顶层必须是 JSON 对象")
+        return loaded
+
+    def _build(self, *layers: dict) -> dict:
+        merged = _DEFAULT_CONFIG
+        for layer in layers: merged = _deep_merge(merged, layer)
+        errors = _validate_config(merged)
+        if errors: raise ConfigError("配置校验失败: " + "; ".join(errors))
+        if not os.path.isabs(merged["output"]["base_folder"]):
+            merged["output"] = {**merged["output"], "base_folder": os.path.join(
+                os.path.dirname(os.path.abspath(__file__)), merged["output"]["base_folder"])}
+        return merged
+
+    def reload(self, initial: bool = False, read_file: bool = True) -> dict:
+        # initial=True (加载模块时) 配置无效则回退到默认值；热更新时无效的配置不生效，继续使用旧快照。
+        # read_file=False 时沿用最近一次成功读取的文件内容 (只重新合并环境变量与运行时覆盖)
+        with self._lock:
+            signature = self._signature() if read_file else self._file_signature
+            try:
+                file_config = self._read_file() if read_file else self._file_config
+                merged = self._build(file_config, _env_config_overrides(), self._overrides)
+            except (OSError, ValueError) as e_load:
+                self._file_signature, self._last_error = signature, str(e_load)
+                if not initial:
+                    logger.error("配置热更新失败，继续使用版本 %d: %s", self._version, e_load)
+                    return {"success": False, "version": self._version, "error": str(e_load)}
+                # 忽略无效的配置文件，但保留环境变量与运行时覆盖 (如通过环境变量提供的密钥)；仍无效时才使用默认值
+                logger.error("加载配置时发生错误: %s. 将忽略配置文件。", e_load)
+                file_config = {}
+                try:
+                    merged = self._build(file_config, _env_config_overrides(), self._overrides)
+                except ConfigError as e_overrides:
+                    logger.error("%s. 将使用默认配置。", e_overrides)
+                    merged = self._build()
+            else:
+                self._last_error = None
+            self._file_config, self._file_signature, self._loaded_at = file_config, signature, time.time()
+            new_snapshot = _freeze(merged)
+            changed = _changed_paths(self._snapshot, new_snapshot)
+            if not changed: return {"success": True, "version": self._version, "changed": []}
+            self._snapshot = new_snapshot
+            self._version += 1
+            if initial and signature is None:
+                logger.warning("配置文件 %s 未找到。将使用默认配置，启动服务器时创建该文件。", CONFIG_FILE)
+            if initial or "api.volcengine" in changed: _warn_missing_keys(new_snapshot)
+            if not initial: logger.info("配置已更新到版本 %d: %s", self._version,
+                                        ", ".join(sorted(path for path in changed if "." not in path)))
+            for path, callback in self._subscribers:
+                if path in changed:
+                    try:
+                        callback()
+                    except Exception as e_callback:
+                        logger.error("配置变更回调 %s 失败: %s", path, e_callback)
+            return {"success": True, "version": self._version,
+                    "changed": sorted(path for path in changed if path.count(".") < 2)}
+
+    def apply_overrides(self, overrides: dict) -> dict:
+        # 运行时覆盖 (优先级最高)，供嵌入方与基准测试使用；校验失败时抛出 ConfigError 且不生效
+        with self._lock:
+            previous = self._overrides
+            self._overrides = _deep_merge(previous, overrides)
+            result = self.reload(read_file=False)
+            if not result["success"]:
+                self._overrides = previous
+                raise ConfigError(result["error"])
+            return result
+
+    def _watch(self):
+        while not self._stop.wait(max(0.2, float(self._snapshot["config"]["watch_interval"]) or 5.0)):
+            if not self._snapshot["config"]["watch_interval"]: continue
+            if self._signature() != self._file_signature: self.reload()
+
+    def start_watching(self):
+        with self._lock:
+            if self._watcher is not None and self._watcher.is_alive(): return
+            self._stop.clear()
+            self._watcher = threading.Thread(target=self._watch, name="config-watch", daemon=True)
+            self._watcher.start()
+
+    def stop_watching(self):
+        self._stop.set()
+
+    def status(self) -> dict:
+        return {"version": self._version, "config_file": CONFIG_FILE, "file_exists": self._file_signature is not None,
+                "loaded_at": self._loaded_at, "watching": self._watcher is not None and self._watcher.is_alive(),
+                "watch_interval": self._snapshot["config"]["watch_interval"], "last_error": self._last_error,
+                "env_overrides": sorted(name for name in os.environ if name.startswith(_CONFIG_ENV_PREFIX)),
+                "runtime_overrides": sorted(self._overrides)}
+
+
+class _ConfigView(Mapping):
+    # 只读视图: CONFIG["api"]["timeout"] 等读取总是落到当前 (或本次调用固定的) 快照上
+    def __init__(self, *path: str):
+        self._path = path
+
+    def _section(self) -> Mapping:
+        section = _CONFIG.current()
+        for key in self._path: section = section.get(key, MappingProxyType({}))
+        return section
+
+    def __getitem__(self, key):
+        return self._section()[key]
+
+    def __iter__(self):
+        return iter(self._section())
+
+    def __len__(self):
+        return len(self._section())
+
+    def __repr__(self):
+        return f"<config {'.'.join(self._path) or 'root'} v{_CONFIG.status()['version']}>"
+
+
+_CONFIG = _ConfigStore()
+CONFIG = _ConfigView()
+VOLCENGINE_STYLES = _ConfigView("volcengine_styles")
+
+
+def load_config(config_path="config.json"):
+    # 只读取配置，不写磁盘: 默认配置文件与输出目录分别在启动服务器和首次保存时创建
+    global CONFIG_FILE
+    CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), config_path)
+    logger.info("Attempting to load config from: %s", CONFIG_FILE)
+    return _CONFIG.reload(initial=True)
+
+
+def _configure_logging():
+    # 未由宿主程序配置日志时使用 logging 配置段；level 设为 WARNING 可关闭热路径上的 DEBUG/INFO 输出
+    logging_conf = CONFIG.get("logging", {})
+    if not logging.getLogger().handlers:
+        logging.basicConfig(format=logging_conf.get("format", "%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger.setLevel(str(logging_conf.get("level", "INFO")).upper())
+
+
+def _ensure_config_file():
+    if os.path.exists(CONFIG_FILE): return
+    try:
+        with open(CONFIG_FILE, 'w', encoding='utf-8') as f_create:
+            json.dump(_DEFAULT_CONFIG, f_create, indent=4, ensure_ascii=False)
+        logger.info("已创建默认配置文件: %s。请检查并填入您的 API 密钥。", CONFIG_FILE)
+    except Exception as e_create_conf:
+        logger.error("创建默认配置文件失败: %s", e_create_conf)
+
+
+def _with_context(func):
+    # 线程池中的任务沿用提交方的上下文 (固定的配置快照与指标标签)；每次调用使用独立副本以便并发执行
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
 
 
 load_config()
+_configure_logging()
+_CONFIG.subscribe("logging", _configure_logging)
+_mark_startup("config")
+
+
+# --- 指标 (metrics) ---
+# 每个工具调用与内部阶段 (validate/encode/upstream/decode/save/download) 记录耗时、输入/输出字节数与错误数，
+# 按 (类型, 名称, provider, style) 分序列累积到固定桶直方图中；通过 get_metrics 工具 (JSON) 与
+# 可选的 Prometheus 文本格式 HTTP 路由 (metrics.prometheus_path) 导出。阶段未显式指定的 provider/style
+# 取自当前上下文 (由工具包装器或风格化单元设置)。
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+_BYTES_BUCKETS = tuple(1024 * 4 ** exponent for exponent in range(10))  # 1 KB .. 256 MB
+_METRIC_CONTEXT = contextvars.ContextVar("metric_context", default=(None, None))
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "count", "sum", "max")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count, self.sum, self.max = 0, 0.0, 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max: self.max = value
+
+    def quantile(self, q: float) -> float:
+        # 在命中桶内线性插值；落在最后一个 (+Inf) 桶时返回观测到的最大值
+        if not self.count: return 0.0
+        rank, seen = q * self.count, 0
+        for index, bucket_count in enumerate(self.counts):
+            if bucket_count and seen + bucket_count >= rank:
+                if index == len(self.buckets): return self.max
+                lower = self.buckets[index - 1] if index else 0.0
+                return min(self.max, lower + (self.buckets[index] - lower) * (rank - seen) / bucket_count)
+            seen += bucket_count
+        return self.max
+
+    def summary(self, scale: float = 1.0, digits: int = 2) -> dict:
+        return {"mean": round(self.sum / self.count * scale, digits) if self.count else 0.0,
+                "p50": round(self.quantile(0.5) * scale, digits), "p95": round(self.quantile(0.95) * scale, digits),
+                "p99": round(self.quantile(0.99) * scale, digits), "max": round(self.max * scale, digits)}
+
+
+class _Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+        self._started = time.time()
+
+    @staticmethod
+    def _settings() -> dict:
+        return CONFIG.get("metrics", {})
+
+    def enabled(self) -> bool:
+        return bool(self._settings().get("enabled", True))
+
+    def _get_series(self, key: tuple) -> dict:
+        series = self._series.get(key)
+        if series is None:
+            # 序列数超过上限时把 style 归入 "__other__"，避免任意输入的风格名导致序列无限增长
+            if len(self._series) >= int(self._settings().get("max_series", 2000)):
+                key = key[:3] + ("__other__",)
+                series = self._series.get(key)
+                if series is not None: return series
+            series = self._series[key] = {"calls": 0, "errors": 0, "items": 0, "item_errors": 0,
+                                          "latency": _Histogram(_LATENCY_BUCKETS),
+                                          "bytes_in": _Histogram(_BYTES_BUCKETS),
+                                          "bytes_out": _Histogram(_BYTES_BUCKETS)}
+        return series
+
+    def observe(self, kind: str, name: str, provider: str | None, style: str | None, seconds: float,
+                error: bool = False, bytes_in: int = None, bytes_out: int = None, items: int = 0,
+                item_errors: int = 0):
+        # items/item_errors: 批量工具一次调用中处理/失败的条目数 (部分失败的调用本身不计为错误)
+        if not self.enabled(): return
+        with self._lock:
+            series = self._get_series((kind, name, provider or "", style or ""))
+            series["calls"] += 1
+            if error: series["errors"] += 1
+            series["items"] += items
+            series["item_errors"] += item_errors
+            series["latency"].observe(seconds)
+            if bytes_in is not None: series["bytes_in"].observe(bytes_in)
+            if bytes_out is not None: series["bytes_out"].observe(bytes_out)
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+            self._started = time.time()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            sections = {"tools": [], "stages": []}
+            for (kind, name, provider, style), series in sorted(self._series.items()):
+                item = {"name": name, "provider": provider or None, "style": style or None, "calls": series["calls"],
+                        "errors": series["errors"], "latency_ms": series["latency"].summary(scale=1000.0)}
+                if series["items"]: item.update(items=series["items"], item_errors=series["item_errors"])
+                for field in ("bytes_in", "bytes_out"):
+                    if series[field].count:
+                        item[field] = {"total": int(series[field].sum), **series[field].summary(digits=0)}
+                sections["tools" if kind == "tool" else "stages"].append(item)
+            return {"since": self._started, "uptime_s": round(time.time() - self._started, 1), **sections}
+
+    @staticmethod
+    def _label_value(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def prometheus(self) -> str:
+        # Prometheus 文本格式 (0.0.4)：每种类型一组 duration/bytes_in/bytes_out 直方图与 calls/errors(/items/item_errors) 计数
+        metric_specs = (("duration_seconds", "latency", "耗时 (秒)"), ("bytes_in", "bytes_in", "输入字节数"),
+                        ("bytes_out", "bytes_out", "输出字节数"))
+        lines = []
+        with self._lock:
+            items = sorted(self._series.items())
+            for kind, label_name in (("tool", "tool"), ("stage", "stage")):
+                kind_items = [(key, series) for key, series in items if key[0] == kind]
+                prefix = f"mcp_images_{kind}"
+                for suffix, field, help_text in metric_specs:
+                    lines += [f"# HELP {prefix}_{suffix} 每个{label_name}的{help_text}",
+                              f"# TYPE {prefix}_{suffix} histogram"]
+                    for (_, name, provider, style), series in kind_items:
+                        histogram = series[field]
+                        if field != "latency" and not histogram.count: continue
+                        labels = (f'{label_name}="{self._label_value(name)}",provider="{self._label_value(provider)}",'
+                                  f'style="{self._label_value(style)}"')
+                        cumulative = 0
+                        for bound, bucket_count in zip(histogram.buckets, histogram.counts):
+                            cumulative += bucket_count
+                            lines.append(f'{prefix}_{suffix}_bucket{{{labels},le="{bound:g}"}} {cumulative}')
+                        lines.append(f'{prefix}_{suffix}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                        lines.append(f"{prefix}_{suffix}_sum{{{labels}}} {histogram.sum:g}")
+                        lines.append(f"{prefix}_{suffix}_count{{{labels}}} {histogram.count}")
+                for counter, help_text in (("calls", "调用次数"), ("errors", "错误次数"), ("items", "批量处理的条目数"),
+                                           ("item_errors", "批量中失败的条目数")):
+                    if counter.startswith("item") and not any(series["items"] for _, series in kind_items): continue
+                    lines += [f"# HELP {prefix}_{counter}_total 每个{label_name}的{help_text}",
+                              f"# TYPE {prefix}_{counter}_total counter"]
+                    for (_, name, provider, style), series in kind_items:
+                        lines.append(f'{prefix}_{counter}_total{{{label_name}="{self._label_value(name)}",'
+                                     f'provider="{self._label_value(provider)}",style="{self._label_value(style)}"}} '
+                                     f'{series[counter]}')
+        return "\n".join(lines) + "\n"
+
+
+_METRICS = _Metrics()
+
+
+@contextlib.contextmanager
+def _stage(name: str, provider: str = None, style: str = None):
+    # 用法: with _stage("upstream", "together") as stage: ...; stage["bytes_in"] = n
+    # 抛出异常或设置 stage["error"] = True 时计为错误 (用于以返回值表示失败的调用)
+    context_provider, context_style = _METRIC_CONTEXT.get()
+    stage = {"error": False, "bytes_in": None, "bytes_out": None}
+    started = time.perf_counter()
+    try:
+        yield stage
+    except BaseException:
+        stage["error"] = True
+        raise
+    finally:
+        _METRICS.observe("stage", name, provider or context_provider, style or context_style,
+                         time.perf_counter() - started, stage["error"], stage["bytes_in"], stage["bytes_out"])
+
+
+def _result_status(result) -> tuple[bool, int, int]:
+    # 解析工具返回的 JSON: (是否失败, 条目数, 失败条目数)；批量工具的返回值带 total/failed 字段
+    if not isinstance(result, str): return False, 0, 0
+    try:
+        payload = json.loads(result)
+    except ValueError:
+        return False, 0, 0
+    if not isinstance(payload, dict): return False, 0, 0
+    total, failed = payload.get("total"), payload.get("failed")
+    if not (isinstance(total, int) and isinstance(failed, int)): total = failed = 0
+    return payload.get("success") is False, total, failed
+
+
+def _metered(provider: str = None, provider_arg: str = None, style_arg: str = None):
+    # 工具包装器: 记录整次调用的耗时、返回的 JSON 字节数与失败次数 (解析返回值 success 为 false 或抛出异常)，
+    # 批量工具另按 total/failed 字段累计条目数与失败条目数；
+    # provider_arg/style_arg 指定从哪个参数取标签值，并在调用期间设置阶段指标的默认标签；
+    # 同时在调用期间固定当前配置快照，热更新不影响进行中的调用
+    def decorator(func):
+        signature = inspect.signature(func)
+        names = list(signature.parameters)
+        defaults = {key: param.default for key, param in signature.parameters.items()
+                    if param.default is not inspect.Parameter.empty}
+
+        def argument(arg_name: str | None, args: tuple, kwargs: dict):
+            if arg_name is None: return None
+            index = names.index(arg_name)
+            if arg_name in kwargs:
+                value = kwargs[arg_name]
+            elif index < len(args):
+                value = args[index]
+            else:
+                value = defaults.get(arg_name)
+            return str(value).strip().lower() if arg_name == provider_arg and value is not None else value
+
+        def labels(args: tuple, kwargs: dict) -> tuple:
+            style = argument(style_arg, args, kwargs)
+            return argument(provider_arg, args, kwargs) or provider, style if isinstance(style, str) else None
+
+        def finish(label_values: tuple, started: float, result, error: bool):
+            failed, items, item_errors = _result_status(result)
+            _METRICS.observe("tool", func.__name__, *label_values, time.perf_counter() - started, error or failed,
+                             bytes_out=len(result) if isinstance(result, str) else None, items=items,
+                             item_errors=item_errors)
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                label_values, result, error = labels(args, kwargs), None, False
+                token, config_token = _METRIC_CONTEXT.set(label_values), _CONFIG.pin()
+                started = time.perf_counter()
+                try:
+                    result = await func(*args, **kwargs)
+                    return result
+                except BaseException:
+                    error = True
+                    raise
+                finally:
+                    _METRIC_CONTEXT.reset(token)
+                    _CONFIG.unpin(config_token)
+                    finish(label_values, started, result, error)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            label_values, result, error = labels(args, kwargs), None, False
+            token, config_token = _METRIC_CONTEXT.set(label_values), _CONFIG.pin()
+            started = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+                return result
+            except BaseException:
+                error = True
+                raise
+            finally:
+                _METRIC_CONTEXT.reset(token)
+                _CONFIG.unpin(config_token)
+                finish(label_values, started, result, error)
+
+        return wrapper
+
+    return decorator
+
+
+def _unmetered(tool):
+    # 异步工具委托给同步工具时调用未包装的实现: 外层的异步工具已计量并固定了配置，避免同一次调用被计两次
+    return inspect.unwrap(tool)
+
+
+def _with_metrics_route(asgi_app):
+    # 在同一个 ASGI 应用 (uvicorn) 上挂载 Prometheus 文本格式的指标路由；未配置路径或关闭指标时原样返回
+    path = CONFIG.get("metrics", {}).get("prometheus_path")
+    if not path or not _METRICS.enabled(): return asgi_app
+
+    async def metrics_app(scope, receive, send):
+        if scope["type"] != "http" or scope.get("path") != path:
+            return await asgi_app(scope, receive, send)
+        body = _METRICS.prometheus().encode("utf-8")
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/plain; version=0.0.4; charset=utf-8"),
+                                (b"content-length", str(len(body)).encode("ascii"))]})
+        await send({"type": "http.response.body", "body": body})
+
+    return metrics_app
+
+
+@app.tool()
+def get_metrics(reset: bool = False, format: str = "json") -> str:
+    """返回各工具与内部阶段 (validate/encode/upstream/decode/save/download) 的调用数、错误数、耗时分位数 (毫秒)
+    与输入/输出字节数，按 provider 与 style 分组；format="prometheus" 时返回 Prometheus 文本格式；reset=True 时在返回后清零。"""
+    if format not in ("json", "prometheus"):
+        return json.dumps({"success": False, "error": f"不支持的格式: {format}. 可选: json, prometheus"})
+    payload = _METRICS.prometheus() if format == "prometheus" else None
+    stats = _METRICS.snapshot() if payload is None else None
+    if reset: _METRICS.reset()
+    if payload is not None: return json.dumps({"success": True, "format": "prometheus", "metrics": payload})
+    return json.dumps({"success": True, "enabled": _METRICS.enabled(), "metrics": stats, "reset": bool(reset)},
+                      ensure_ascii=False)
 
 
 def get_volcengine_style_params(style_name: str) -> dict | None:
     style_params = VOLCENGINE_STYLES.get(style_name)
-    if isinstance(style_params, dict):
-        return style_params
+    if isinstance(style_params, Mapping):
+        return dict(style_params)
     elif style_params is not None:
-        print(f"警告: 风格 '{style_name}' 的配置格式不正确 (期望字典，得到 {type(style_params)}). 将尝试适应。")
+        logger.warning("风格 '%s' 的配置格式不正确 (期望字典，得到 %s). 将尝试适应。", style_name, type(style_params))
         if isinstance(style_params, str): return {"req_key": style_params}
     return None
 
 
+# --- 输出文件命名 ---
+# 每个目录只在第一次使用时 scandir 一次，在内存中记录每个 (基础名, 扩展名) 的下一个序号，避免逐个 exists 探测；
+# 是否可用始终由 O_CREAT|O_EXCL 创建空占位文件决定 (删除后的文件名可以再次使用)，保证并发 (包括其他进程)
+# 保存不会互相覆盖。写入方随后以 "临时文件 + os.replace" 或直接覆盖的方式替换占位文件；失败时用 _release_save_path 清理。
+class _SaveNameIndex:
+    def __init__(self, max_folders: int = 256):
+        self._lock = threading.Lock()
+        self._folders = OrderedDict()
+        self._max_folders = max_folders
+
+    @staticmethod
+    def _note(counters: dict, name: str):
+        base, ext = os.path.splitext(name.lower())
+        stem, sep, suffix = base.rpartition("_")
+        if sep and suffix.isdigit():
+            counters[(stem, ext)] = max(counters.get((stem, ext), 1), int(suffix) + 1)
+
+    def _folder(self, folder: str) -> dict:
+        counters = self._folders.get(folder)
+        if counters is not None:
+            self._folders.move_to_end(folder)
+            return counters
+        counters = {}
+        with os.scandir(folder) as entries:
+            for dir_entry in entries:
+                self._note(counters, dir_entry.name)
+        self._folders[folder] = counters
+        while len(self._folders) > self._max_folders:
+            self._folders.popitem(last=False)
+        return counters
+
+    @staticmethod
+    def _create(folder: str, name: str) -> bool:
+        try:
+            os.close(os.open(os.path.join(folder, name), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+            return True
+        except FileExistsError:
+            return False
+
+    def reserve(self, folder: str, file_name: str, base_name: str, ext: str) -> str:
+        with self._lock:
+            counters = self._folder(os.path.normcase(folder))
+            if self._create(folder, file_name):
+                self._note(counters, file_name)
+                return file_name
+            # 请求的文件名已存在: 从记录的序号开始取 {基础名}_{n}{扩展名}
+            counter_key = (base_name.lower(), ext.lower())
+            while True:
+                counter = counters.get(counter_key, 1)
+                counters[counter_key] = counter + 1
+                candidate = f"{base_name}_{counter}{ext}"
+                if self._create(folder, candidate): return candidate
+
+    def clear(self):
+        with self._lock:
+            self._folders.clear()
+
+
+_SAVE_NAMES = _SaveNameIndex()
+
+
+def _normalize_save_name(file_name: str) -> tuple[str, str, str]:
+    # 返回 (带扩展名的文件名, 基础名, 小写扩展名)；扩展名不在允许列表中时抛出 ValueError
+    default_ext, allowed_exts = CONFIG["output"]["default_extension"], CONFIG["output"]["allowed_extensions"]
+    base_name, ext = os.path.splitext(file_name)
+    if not ext: return base_name + default_ext, base_name, default_ext
+    if ext.lower() not in allowed_exts:
+        raise ValueError(f"不支持文件扩展名: {ext}. 允许的扩展名: {', '.join(allowed_exts)}")
+    return file_name, base_name, ext.lower()
+
+
 def _handle_save_path(file_name: str, save_folder: str = None) -> tuple[str, str, str]:
-    # ... (与之前版本相同) ...
+    # 返回 (保存路径, 目录, 最终文件名)；返回时该路径已由空占位文件占用
     current_base_folder = CONFIG["output"]["base_folder"]
     if save_folder is None:
         save_folder_abs = current_base_folder
@@ -163,42 +945,330 @@ def _handle_save_path(file_name: str, save_folder: str = None) -> tuple[str, str
         save_folder_abs = os.path.abspath(save_folder) if os.path.isabs(save_folder) else os.path.abspath(
             os.path.join(os.path.dirname(os.path.abspath(__file__)), save_folder))
     os.makedirs(save_folder_abs, exist_ok=True)
-    default_ext, allowed_exts = CONFIG["output"]["default_extension"], CONFIG["output"]["allowed_extensions"]
-    base_name, ext = os.path.splitext(file_name)
-    if not ext:
-        file_name_with_ext, actual_ext = base_name + default_ext, default_ext
-    elif ext.lower() not in allowed_exts:
-        raise ValueError(f"不支持文件扩展名: {ext}. 允许的扩展名: {', '.join(allowed_exts)}")
-    else:
-        file_name_with_ext, actual_ext = file_name, ext.lower()
-    final_file_name, counter, save_path = file_name_with_ext, 1, os.path.join(save_folder_abs, file_name_with_ext)
-    while os.path.exists(save_path):
-        final_file_name = f"{base_name}_{counter}{actual_ext}";
-        save_path = os.path.join(save_folder_abs, final_file_name);
-        counter += 1
-        if counter > 100: raise OverflowError("尝试生成唯一文件名失败次数过多。")
-    return save_path, save_folder_abs, final_file_name
-
-
-def _validate_image_for_volcengine(image_path: str) -> tuple[bool, str, str | None]:
-    # ... (与之前版本相同) ...
-    if not os.path.exists(image_path): return False, f"图片文件不存在: {image_path}", None
+    file_name_with_ext, base_name, actual_ext = _normalize_save_name(file_name)
+    final_file_name = _SAVE_NAMES.reserve(save_folder_abs, file_name_with_ext, base_name, actual_ext)
+    return os.path.join(save_folder_abs, final_file_name), save_folder_abs, final_file_name
+
+
+def _release_save_path(save_path: str):
+    # 仅删除仍为空的占位文件，不会误删已经写入内容的结果
+    try:
+        if save_path and os.path.getsize(save_path) == 0: os.remove(save_path)
+    except OSError:
+        pass
+
+
+_SAME_FORMAT_EXTS = {".jpg": ".jpeg"}  # 同一种格式的不同扩展名视为一致，保留调用方的文件名
+
+
+def _ext_matches_format(file_name: str, image_format: str) -> bool:
+    ext = os.path.splitext(file_name)[1].lower()
+    new_ext = f".{image_format.lower().lstrip('.')}"
+    return _SAME_FORMAT_EXTS.get(ext, ext) == _SAME_FORMAT_EXTS.get(new_ext, new_ext)
+
+
+def _retarget_save_path(save_path: str, final_file_name: str, image_format: str) -> tuple[str, str]:
+    # 输出格式与预留文件名的扩展名不一致时，按新扩展名重新预留并释放原占位文件
+    if _ext_matches_format(final_file_name, image_format): return save_path, final_file_name
+    base_name = os.path.splitext(final_file_name)[0]
+    new_ext = f".{image_format.lower().lstrip('.')}"
+    folder = os.path.dirname(save_path)
+    new_file_name = _SAVE_NAMES.reserve(folder, f"{base_name}{new_ext}", base_name, new_ext)
+    _release_save_path(save_path)
+    return os.path.join(folder, new_file_name), new_file_name
+
+
+# --- 输入图片预处理 (一次读取: 头部嗅探 + 内存映射 + base64) ---
+# 格式与分辨率只从文件头解析，不做完整解码；文件内容通过 mmap 映射，摘要与 base64 编码都直接基于同一个缓冲区，
+# 之后的缓存查找、请求构造等阶段复用该对象而不再读盘。
+VOLCENGINE_MIN_RESOLUTION = (50, 50)
+VOLCENGINE_MAX_RESOLUTION = (4096, 4096)
+VOLCENGINE_MAX_BYTES = 5 * 1024 * 1024
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _sniff_image_header(buffer) -> tuple[str, int, int] | None:
+    # 返回 (格式, 宽, 高)；仅支持 PNG 与 JPEG (火山引擎接受的输入格式)
+    if buffer[:8] == b"\x89PNG\r\n\x1a\n" and len(buffer) >= 24 and buffer[12:16] == b"IHDR":
+        width, height = struct.unpack(">II", buffer[16:24])
+        return "png", width, height
+    if buffer[:2] == b"\xff\xd8":
+        offset, length = 2, len(buffer)
+        while offset + 4 <= length:
+            if buffer[offset] != 0xFF:
+                offset += 1
+                continue
+            marker = buffer[offset + 1]
+            if marker == 0xFF:
+                offset += 1
+                continue
+            if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+                offset += 2
+                continue
+            segment_length = struct.unpack(">H", buffer[offset + 2:offset + 4])[0]
+            if marker in _JPEG_SOF_MARKERS and offset + 9 <= length:
+                height, width = struct.unpack(">HH", buffer[offset + 5:offset + 9])
+                return "jpeg", width, height
+            if marker == 0xDA: break
+            offset += 2 + segment_length
+    return None
+
+
+class _PreparedImage:
+    __slots__ = ("path", "format", "width", "height", "size", "output_format", "original_size", "_buffer", "_file",
+                 "_b64", "_digest", "_lock")
+
+    def __init__(self, path: str, image_format: str, width: int, height: int, buffer, file_obj=None,
+                 output_format: str = None, original_size: tuple[int, int] = None):
+        self.path = path
+        self.format = image_format
+        self.width = width
+        self.height = height
+        self.size = len(buffer)
+        # 自动缩放/重新压缩过的输入: 输出仍按原始格式保存，original_size 记录缩放前的尺寸
+        self.output_format = output_format or image_format
+        self.original_size = original_size
+        self._buffer = buffer
+        self._file = file_obj
+        self._b64 = None
+        self._digest = None
+        self._lock = threading.Lock()
+
+    # base64 与摘要只在首次访问时计算 (缓存命中时不编码)，映射须保持打开到请求构造完成；
+    # 批量模式下多个单元共用同一对象，加锁避免重复编码
+    @property
+    def b64(self) -> str:
+        if self._b64 is None:
+            with self._lock:
+                if self._b64 is None:
+                    with _stage("encode", "volcengine") as stage:
+                        self._b64 = base64.b64encode(self._buffer).decode('ascii')
+                        stage["bytes_in"], stage["bytes_out"] = self.size, len(self._b64)
+        return self._b64
+
+    @property
+    def digest(self) -> str:
+        if self._digest is None:
+            with self._lock:
+                if self._digest is None: self._digest = hashlib.sha256(self._buffer).hexdigest()
+        return self._digest
+
+    def close(self):
+        if self._file is None: return
+        self._buffer.close()
+        self._file.close()
+        self._buffer, self._file = b"", None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _encode_within_budget(image, source_format: str, has_alpha: bool, target_bytes: int, quality: int,
+                          min_quality: int) -> tuple[bytes, str] | None:
+    # PNG 输入先尝试保持 PNG；超出预算 (或原本就是 JPEG) 时按质量从高到低尝试 JPEG
+    if source_format == "png":
+        buffer = BytesIO()
+        image.save(buffer, "PNG", compress_level=6)
+        if buffer.tell() <= target_bytes: return buffer.getvalue(), "png"
+    if has_alpha:
+        flattened = Image.new("RGB", image.size, (255, 255, 255))
+        flattened.paste(image, mask=image.getchannel("A"))
+        image = flattened
+    for jpeg_quality in range(quality, min_quality - 1, -10):
+        buffer = BytesIO()
+        image.save(buffer, "JPEG", quality=jpeg_quality, optimize=False)
+        if buffer.tell() <= target_bytes: return buffer.getvalue(), "jpeg"
+    return None
+
+
+def _fit_image_for_volcengine(image_path: str, source_format: str, width: int, height: int) -> _PreparedImage:
+    # 超出火山引擎限制 (5 MB / 4096x4096) 的输入: 快速缩小到限制以内并在字节预算内重新压缩
+    image_conf = CONFIG.get("image", {})
+    max_side = min(int(image_conf.get("fit_max_side", 4096)), *VOLCENGINE_MAX_RESOLUTION)
+    target_bytes = min(int(image_conf.get("fit_target_bytes", 4 * 1024 * 1024)), VOLCENGINE_MAX_BYTES)
+    quality = int(image_conf.get("fit_quality", 90))
+    min_quality = min(quality, int(image_conf.get("fit_min_quality", 60)))
+    scale = min(1.0, max_side / max(width, height))
+    target = (max(1, int(width * scale)), max(1, int(height * scale)))
+    with Image.open(image_path) as img:
+        # JPEG 在 DCT 域直接按 1/2、1/4、1/8 缩小解码，避免解码全分辨率
+        if img.format == "JPEG" and scale < 1: img.draft("RGB", target)
+        has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+        working = img.convert("RGBA" if has_alpha else "RGB")
+    min_res_w, min_res_h = VOLCENGINE_MIN_RESOLUTION
+    while True:
+        if working.size != target: working = working.resize(target, Image.Resampling.BILINEAR, reducing_gap=2.0)
+        encoded = _encode_within_budget(working, source_format, has_alpha, target_bytes, quality, min_quality)
+        if encoded is not None: break
+        target = (int(target[0] * 0.8), int(target[1] * 0.8))
+        if target[0] < min_res_w or target[1] < min_res_h:
+            raise ValueError(f"图片无法在 {target_bytes / (1024 * 1024):.2f} MB 预算内压缩到有效分辨率")
+    data, encoded_format = encoded
+    logger.debug("输入图片已自动适配: %dx%d -> %dx%d, %d bytes (%s)", width, height, target[0], target[1], len(data),
+                 encoded_format)
+    return _PreparedImage(image_path, encoded_format, target[0], target[1], data, output_format=source_format,
+                          original_size=(width, height))
+
+
+def _prepare_image_for_volcengine(image_path: str) -> _PreparedImage:
+    # 验证失败时抛出 ValueError，消息与原有验证逻辑一致；超出大小/分辨率上限时若开启 image.auto_fit_inputs 则自动适配
+    if not os.path.exists(image_path): raise ValueError(f"图片文件不存在: {image_path}")
     _, ext = os.path.splitext(image_path)
     allowed_formats = ['.jpg', '.jpeg', '.png'];
-    if ext.lower() not in allowed_formats: return False, f"不支持的图片格式: {ext}. 仅支持 JPG, JPEG, PNG。", None
+    if ext.lower() not in allowed_formats: raise ValueError(f"不支持的图片格式: {ext}. 仅支持 JPG, JPEG, PNG。")
+    auto_fit = bool(CONFIG.get("image", {}).get("auto_fit_inputs", True))
     file_size_bytes = os.path.getsize(image_path)
-    max_size_bytes = 5 * 1024 * 1024
-    if file_size_bytes > max_size_bytes: return False, f"图片文件过大: {file_size_bytes / (1024 * 1024):.2f} MB. 最大允许 5 MB。", None
-    min_res_w, min_res_h = 50, 50;
-    max_res_w, max_res_h = 4096, 4096
-    try:
-        with Image.open(image_path) as img:
-            width, height = img.size
-            if not (min_res_w <= width <= max_res_w and min_res_h <= height <= max_res_h):
-                return False, f"图片分辨率 ({width}x{height}) 不符合要求。示例范围: 最小 {min_res_w}x{min_res_h}，最大 {max_res_w}x{max_res_h}。", None
-            return True, "图片验证通过", img.format.lower() if img.format else ext.lower().lstrip('.')
-    except Exception as e:
-        return False, f"读取图片分辨率失败: {e}", None
+    if file_size_bytes > VOLCENGINE_MAX_BYTES and not auto_fit:
+        raise ValueError(f"图片文件过大: {file_size_bytes / (1024 * 1024):.2f} MB. 最大允许 5 MB。")
+    if file_size_bytes == 0: raise ValueError("读取图片分辨率失败: 文件为空")
+    file_obj = open(image_path, "rb")
+    try:
+        buffer = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        file_obj.close()
+        raise
+    prepared = None
+    try:
+        header = _sniff_image_header(buffer)
+        if header is None: raise ValueError("读取图片分辨率失败: 无法从文件头识别 PNG/JPEG 格式与尺寸")
+        image_format, width, height = header
+        (min_res_w, min_res_h), (max_res_w, max_res_h) = VOLCENGINE_MIN_RESOLUTION, VOLCENGINE_MAX_RESOLUTION
+        too_large = width > max_res_w or height > max_res_h
+        if width < min_res_w or height < min_res_h or (too_large and not auto_fit):
+            raise ValueError(f"图片分辨率 ({width}x{height}) 不符合要求。示例范围: 最小 {min_res_w}x{min_res_h}，最大 {max_res_w}x{max_res_h}。")
+        if not too_large and file_size_bytes <= VOLCENGINE_MAX_BYTES:
+            prepared = _PreparedImage(image_path, image_format, width, height, buffer, file_obj)
+            return prepared
+    finally:
+        if prepared is None:
+            buffer.close()
+            file_obj.close()
+    return _fit_image_for_volcengine(image_path, image_format, width, height)
+
+
+def _restore_output_size(file_path: str, size: tuple[int, int]):
+    with Image.open(file_path) as img:
+        if img.size == tuple(size): return
+        image_format = img.format
+        restored = img.resize(tuple(size), Image.Resampling.BICUBIC)
+    save_kwargs = {"quality": 95} if image_format == "JPEG" else {}
+    restored.save(file_path, image_format, **save_kwargs)
+
+
+def _image_format_from_magic(header: bytes) -> str | None:
+    if header[:8] == b"\x89PNG\r\n\x1a\n": return "png"
+    if header[:3] == b"\xff\xd8\xff": return "jpeg"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP": return "webp"
+    if header[:6] in (b"GIF87a", b"GIF89a"): return "gif"
+    return None
+
+
+def _normalize_image_format(image_format: str) -> str:
+    image_format = image_format.lower().lstrip('.')
+    return "jpeg" if image_format in ("jpg", "jpeg") else image_format
+
+
+def _write_base64_to_file(base64_string: str, file_path: str, chunk_chars: int = 4 * 256 * 1024):
+    # 分块解码 (块长为 4 的倍数) 直接写入临时文件后原子替换，不在内存中保留完整的解码结果
+    if any(ch in base64_string for ch in " \r\n"): base64_string = "".join(base64_string.split())
+    tmp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            for offset in range(0, len(base64_string), chunk_chars):
+                f.write(base64.b64decode(base64_string[offset:offset + chunk_chars]))
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+
+
+def _has_alpha(image) -> bool:
+    return image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+
+
+# --- 水印 (watermark) ---
+# 字体按 (路径, 字号) 缓存；每个 (文字, 字体, 字号, 透明度, 颜色) 或 (Logo 图片, 尺寸, 透明度) 只渲染一次为 RGBA 贴片，
+# 之后每张图只需一次 alpha 合成，不再重复排版。缓存的贴片是共享对象，只读使用。
+WATERMARK_POSITIONS = ("bottom-right", "bottom-left", "top-left", "top-right", "center")
+
+
+@functools.lru_cache(maxsize=32)
+def _load_font(font_path: str | None, font_size: int):
+    if font_path and os.path.exists(font_path):
+        try:
+            return ImageFont.truetype(font_path, font_size)
+        except IOError:
+            logger.warning("字体 '%s' 加载失败，使用默认字体。", font_path)
+    return ImageFont.load_default()
+
+
+@functools.lru_cache(maxsize=128)
+def _text_watermark_tile(text: str, font_path: str | None, font_size: int, opacity: int,
+                         color: tuple[int, int, int] = (255, 255, 255)):
+    font = _load_font(font_path, int(font_size))
+    left, top, right, bottom = font.getbbox(text)
+    mask = Image.new("L", (max(1, right - left), max(1, bottom - top)), 0)
+    ImageDraw.Draw(mask).text((-left, -top), text, font=font, fill=255)
+    opacity = max(0, min(255, int(opacity)))
+    tile = Image.new("RGBA", mask.size, tuple(color) + (0,))
+    tile.putalpha(mask.point(lambda value: value * opacity // 255))
+    return tile
+
+
+@functools.lru_cache(maxsize=32)
+def _image_watermark_tile(logo_path: str, logo_mtime: float, width: int, opacity: int):
+    with Image.open(logo_path) as logo:
+        logo = logo.convert("RGBA")
+    if width and logo.width != width:
+        logo = logo.resize((width, max(1, round(logo.height * width / logo.width))), Image.Resampling.LANCZOS)
+    if opacity < 255:
+        logo.putalpha(logo.getchannel("A").point(lambda value: value * max(0, int(opacity)) // 255))
+    return logo
+
+
+def _watermark_offset(image_size: tuple[int, int], tile_size: tuple[int, int], position: str,
+                      margin: int = 10) -> tuple[int, int]:
+    img_width, img_height = image_size
+    tile_width, tile_height = tile_size
+    positions = {
+        "bottom-right": (img_width - tile_width - margin, img_height - tile_height - margin),
+        "bottom-left": (margin, img_height - tile_height - margin),
+        "top-left": (margin, margin),
+        "top-right": (img_width - tile_width - margin, margin),
+        "center": ((img_width - tile_width) // 2, (img_height - tile_height) // 2),
+    }
+    x, y = positions.get(position, positions["bottom-right"])
+    return max(x, 0), max(y, 0)
+
+
+def _composite_watermark(image, tile, position: str = "bottom-right", margin: int = 10):
+    # 就地合成: RGBA 底图用 alpha_composite，其余 (RGB) 用贴片自身的 alpha 作为蒙版混合
+    offset = _watermark_offset(image.size, tile.size, position, margin)
+    if tile.width > image.width or tile.height > image.height:
+        tile = tile.crop((0, 0, min(tile.width, image.width - offset[0]), min(tile.height, image.height - offset[1])))
+    if image.mode == "RGBA":
+        image.alpha_composite(tile, dest=offset)
+    else:
+        image.paste(tile, offset, tile)
+    return image
+
+
+def _watermark_file(source_path: str, dest_path: str, tiles: list, position: str, margin: int):
+    with Image.open(source_path) as img:
+        image_format = img.format or "PNG"
+        image = img.convert("RGBA") if _has_alpha(img) else img.convert("RGB")
+    for tile in tiles:
+        _composite_watermark(image, tile, position, margin)
+    if image_format == "JPEG" and image.mode != "RGB": image = image.convert("RGB")
+    tmp_path = f"{dest_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        image.save(tmp_path, image_format, **({"quality": 95} if image_format == "JPEG" else {}))
+        os.replace(tmp_path, dest_path)
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
 
 
 def save_image_from_base64(
@@ -207,195 +1277,1986 @@ def save_image_from_base64(
         logo_font_size: int = 20, logo_position: str = "bottom-right", logo_opacity: int = 128,
         image_format: str = "png"
 ) -> str:
-    # ... (与之前版本相同) ...
     try:
         if not os.path.exists(save_folder): os.makedirs(save_folder, exist_ok=True)
-        base_name, _ = os.path.splitext(file_name)
-        actual_file_name = f"{base_name}.{image_format.lower().lstrip('.')}"
+        # 扩展名已对应目标格式 (如 .jpg 与 jpeg) 时按原名写入，保证写的就是调用方预留的那个文件
+        actual_file_name = file_name
+        if not _ext_matches_format(file_name, image_format):
+            actual_file_name = f"{os.path.splitext(file_name)[0]}.{image_format.lower().lstrip('.')}"
         file_path = os.path.join(save_folder, actual_file_name)
-        image_data = base64.b64decode(base64_string);
-        image = Image.open(BytesIO(image_data))
-        if image.mode != 'RGBA': image = image.convert('RGBA')
-        if add_logo and logo_text_content:
-            draw = ImageDraw.Draw(image)
+        target_format = _normalize_image_format(image_format)
+        needs_logo = bool(add_logo and logo_text_content)
+
+        # 快速路径: 不加水印且数据本身就是目标格式时，直接把解码后的字节流式写盘，不经过 PIL
+        if not needs_logo:
+            try:
+                source_format = _image_format_from_magic(base64.b64decode(base64_string[:64]))
+            except ValueError:
+                source_format = None
+            if source_format == target_format:
+                with _stage("save") as stage:
+                    stage["bytes_in"] = len(base64_string)
+                    _write_base64_to_file(base64_string, file_path)
+                    stage["bytes_out"] = os.path.getsize(file_path)
+                logger.debug("Image successfully saved to: %s", file_path)
+                return file_path
+
+        with _stage("decode") as stage:
+            stage["bytes_in"] = len(base64_string)
+            image_bytes = base64.b64decode(base64_string)
+            image = Image.open(BytesIO(image_bytes))
+            image.load()
+            stage["bytes_out"] = len(image_bytes)
+        has_alpha = _has_alpha(image)
+        if needs_logo:
+            if image.mode not in ("RGB", "RGBA"): image = image.convert("RGBA" if has_alpha else "RGB")
             _logo_font_path = logo_font_path if logo_font_path else CONFIG.get("output", {}).get("logo_font_path")
             _logo_font_size = logo_font_size if logo_font_size > 0 else CONFIG.get("output", {}).get("logo_font_size",
                                                                                                      20)
-            try:
-                font = ImageFont.truetype(_logo_font_path, _logo_font_size) if _logo_font_path and os.path.exists(
-                    _logo_font_path) else ImageFont.load_default()
-            except IOError:
-                font = ImageFont.load_default(); print(f"警告: 字体 '{_logo_font_path}' 加载失败，使用默认字体。")
-            text_bbox = draw.textbbox((0, 0), logo_text_content, font=font);
-            text_width = text_bbox[2] - text_bbox[0];
-            text_height = text_bbox[3] - text_bbox[1]
-            margin = 10;
-            img_width, img_height = image.size
-            positions = {
-                "bottom-right": (img_width - text_width - margin, img_height - text_height - margin),
-                "bottom-left": (margin, img_height - text_height - margin),
-                "top-left": (margin, margin),
-                "top-right": (img_width - text_width - margin, margin)
-            }
-            x, y = positions.get(logo_position, positions["bottom-right"])
-            x = max(x, 0);
-            y = max(y, 0);
-            text_color_rgb = (255, 255, 255);
-            final_text_color = text_color_rgb + (logo_opacity,)
-            draw.text((x, y), logo_text_content, font=font, fill=final_text_color)
+            tile = _text_watermark_tile(logo_text_content, _logo_font_path, _logo_font_size, int(logo_opacity))
+            _composite_watermark(image, tile, logo_position)
         image_to_save = image;
-        save_format_upper = image_format.upper()
-        if save_format_upper in ["JPEG", "JPG"]:
-            if image_to_save.mode == 'RGBA':
-                rgb_image = Image.new("RGB", image_to_save.size, (255, 255, 255)); rgb_image.paste(image_to_save, mask=
-                image_to_save.split()[3]); image_to_save = rgb_image
+        save_format_upper = target_format.upper()
+        if save_format_upper == "JPEG":
+            if has_alpha:
+                rgba_image = image_to_save.convert("RGBA")
+                rgb_image = Image.new("RGB", rgba_image.size, (255, 255, 255))
+                rgb_image.paste(rgba_image, mask=rgba_image.getchannel("A"))
+                image_to_save = rgb_image
             elif image_to_save.mode != 'RGB':
                 image_to_save = image_to_save.convert('RGB')
-            save_format_upper = "JPEG"
-        image_to_save.save(file_path, save_format_upper)
-        print(f"Image successfully saved to: {file_path}")
+        tmp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with _stage("save") as stage:
+                image_to_save.save(tmp_path, save_format_upper)
+                os.replace(tmp_path, file_path)
+                stage["bytes_out"] = os.path.getsize(file_path)
+        finally:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+        logger.debug("Image successfully saved to: %s", file_path)
         return file_path
     except Exception as e:
-        print(f"Error in save_image_from_base64: {e}"); traceback.print_exc(); return None
+        logger.exception("Error in save_image_from_base64: %s", e); return None
 
 
-# --- 其他工具函数 (search_images, download_image, generate_icon_togetherai) ---
-@app.tool()
-def search_images(query: str, source: str = "unsplash", max_results: str = "10") -> str:
-    # ... (与您提供的代码相同) ...
-    try:
-        max_results_int = int(max_results)
-    except (TypeError, ValueError):
-        return json.dumps({"success": False, "error": "max_results必须是有效的数字"})
-    results = [];
-    max_results_int = min(max(1, max_results_int), CONFIG["image"]["max_results"]);
-    api_timeout = CONFIG["api"].get("timeout", 30)
-    try:
-        if source.lower() == "unsplash":  # ... (Unsplash logic) ...
-            if not CONFIG["api"]["unsplash_access_key"]: return json.dumps(
-                {"success": False, "error": "Unsplash API key未配置"})
-            api_url, headers, params = "https://api.unsplash.com/search/photos", {
-                "Authorization": f"Client-ID {CONFIG['api']['unsplash_access_key']}"}, {"query": query,
-                                                                                        "per_page": max_results_int}
-            response = requests.get(api_url, headers=headers, params=params, timeout=api_timeout)
-            if response.status_code == 200:
-                data = response.json(); [results.append({"id": item.get("id"), "url": item.get("urls", {}).get("small"),
-                                                         "thumb": item.get("urls", {}).get("thumb"),
-                                                         "source": "unsplash",
-                                                         "author": item.get("user", {}).get("name"),
-                                                         "download_url": item.get("urls", {}).get("raw")}) for item in
-                                         data.get("results", [])]
-            else:
-                return json.dumps(
-                    {"success": False, "error": f"Unsplash API错误: {response.status_code} - {response.text[:200]}"})
-        elif source.lower() == "pexels":  # ... (Pexels logic) ...
-            if not CONFIG["api"]["pexels_api_key"]: return json.dumps(
-                {"success": False, "error": "Pexels API key未配置"})
-            api_url, headers, params = "https://api.pexels.com/v1/search", {
-                "Authorization": CONFIG['api']['pexels_api_key']}, {"query": query, "per_page": max_results_int}
-            response = requests.get(api_url, headers=headers, params=params, timeout=api_timeout)
-            if response.status_code == 200:
-                data = response.json(); [results.append(
-                    {"id": str(item.get("id")), "url": item.get("src", {}).get("medium"),
-                     "thumb": item.get("src", {}).get("tiny"), "source": "pexels", "author": item.get("photographer"),
-                     "download_url": item.get("src", {}).get("original")}) for item in data.get("photos", [])]
-            else:
-                return json.dumps(
-                    {"success": False, "error": f"Pexels API错误: {response.status_code} - {response.text[:200]}"})
-        elif source.lower() == "pixabay":  # ... (Pixabay logic) ...
-            if not CONFIG["api"]["pixabay_api_key"]: return json.dumps(
-                {"success": False, "error": "Pixabay API key未配置"})
-            api_url, params = "https://pixabay.com/api/", {"key": CONFIG['api']['pixabay_api_key'], "q": query,
-                                                           "per_page": max_results_int, "image_type": "photo"}
-            response = requests.get(api_url, params=params, timeout=api_timeout)
-            if response.status_code == 200:
-                data = response.json(); [results.append(
-                    {"id": str(item.get("id")), "url": item.get("webformatURL"), "thumb": item.get("previewURL"),
-                     "source": "pixabay", "author": item.get("user"), "download_url": item.get("largeImageURL")}) for
-                                         item in data.get("hits", [])]
-            else:
-                return json.dumps(
-                    {"success": False, "error": f"Pixabay API错误: {response.status_code} - {response.text[:200]}"})
-        else:
-            return json.dumps(
-                {"success": False, "error": f"不支持图片源: {source}. 支持的源: unsplash, pexels, pixabay"})
-    except requests.exceptions.RequestException as e_req:
-        return json.dumps({"success": False, "error": f"搜索时网络请求错误: {e_req}"})
-    except Exception as e:
-        return json.dumps({"success": False, "error": f"搜索时未知错误: {e}"})
-    return json.dumps({"success": True, "results": results})
+# --- 内容寻址存储 (content-addressed store) ---
+# 文件按内容/请求摘要存放在 <base_folder>/.cache/<name>/<前两位>/<摘要><扩展名>，总大小超过上限时按 LRU 淘汰。
+# 命中时通过硬链接 (link_mode="hardlink"，失败时回退为复制) 或复制放到目标路径。
+class _ContentStore:
+    def __init__(self, name: str, settings_key: str):
+        self._name = name
+        self._settings_key = settings_key
+        self._lock = threading.Lock()
+        self._index = None
+        self._indexed_root = None
+        self._total_bytes = 0
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
 
+    def _settings(self) -> dict:
+        return CONFIG.get("cache", {}).get(self._settings_key, {})
 
-@app.tool()
-def download_image(url: str, file_name: str, save_folder: str = None) -> str:
-    # ... (与您提供的代码相同) ...
-    try:
-        save_path, _, final_file_name = _handle_save_path(file_name, save_folder)
-        response = requests.get(url, stream=True, timeout=CONFIG["api"].get("timeout", 60))
-        if response.status_code == 200:
-            with open(save_path, 'wb') as f:
-                [f.write(chunk) for chunk in response.iter_content(8192)]
-            return json.dumps(
-                {"success": True, "message": f"图片 '{final_file_name}' 已保存到: {os.path.dirname(save_path)}",
-                 "file_path": save_path, "file_name": final_file_name})
-        else:
-            return json.dumps({"success": False, "error": f"下载失败，状态码: {response.status_code}, URL: {url}"})
-    except ValueError as ve:
-        return json.dumps({"success": False, "error": str(ve)})
-    except requests.exceptions.RequestException as e_req:
-        return json.dumps({"success": False, "error": f"下载时网络请求错误: {e_req}"})
-    except OverflowError as oe:
-        return json.dumps({"success": False, "error": str(oe)})
-    except Exception as e:
-        return json.dumps({"success": False, "error": f"下载时未知错误: {e}"})
+    def enabled(self) -> bool:
+        return bool(self._settings().get("enabled", True))
 
+    def _root(self) -> str:
+        return os.path.join(CONFIG["output"]["base_folder"], ".cache", self._name)
 
-@app.tool()
-def generate_icon_togetherai(prompt: str, file_name: str, save_folder: str = None, width: int = None,
-                             height: int = None) -> str:
-    # ... (与您提供的代码相同) ...
-    try:
-        save_path, _, final_file_name = _handle_save_path(file_name, save_folder)
-        actual_width = width if width is not None else CONFIG["image"]["default_width"];
-        actual_height = height if height is not None else CONFIG["image"]["default_height"]
-        together_api_key = CONFIG["api"].get("together_api_key")
-        if not together_api_key: return json.dumps({"success": False, "error": "Together AI API key 未配置。"})
-        api_url = "https://api.together.xyz/v1/images/generations";
-        headers = {"Authorization": f"Bearer {together_api_key}", "Content-Type": "application/json",
-                   "Accept": "application/json"}
-        payload = {"model": "black-forest-labs/FLUX.1-dev", "prompt": prompt, "n": 1, "width": actual_width,
-                   "height": actual_height, "response_format": "b64_json"}
-        response = requests.post(api_url, headers=headers, json=payload, timeout=CONFIG["api"].get("timeout", 120));
-        response_text_for_debug = response.text
-        if response.status_code == 200:
+    def _ensure_index(self):
+        # 首次使用时扫描一次目录，按修改时间恢复 LRU 顺序
+        root = self._root()
+        if self._index is not None and self._indexed_root == root: return
+        entries = []
+        for dir_path, _, files in os.walk(root):
+            for entry_name in files:
+                if entry_name.endswith(".tmp"): continue
+                path = os.path.join(dir_path, entry_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, os.path.splitext(entry_name)[0], path, stat.st_size))
+        entries.sort()
+        self._index = OrderedDict((key, (path, size)) for _, key, path, size in entries)
+        self._total_bytes = sum(size for _, size in self._index.values())
+        self._indexed_root = root
+
+    def _link_or_copy(self, src_path: str, dest_path: str):
+        if self._settings().get("link_mode", "hardlink") == "hardlink":
             try:
-                data = json.loads(response_text_for_debug);
-                image_data_b64 = data.get("data", [{}])[0].get("b64_json")
-                if image_data_b64:
-                    with open(save_path, 'wb') as f:
-                        f.write(base64.b64decode(image_data_b64))
-                    return json.dumps({"success": True,
-                                       "message": f"图标 '{final_file_name}' 已生成并保存到: {os.path.dirname(save_path)}",
-                                       "file_path": save_path, "file_name": final_file_name})
+                os.link(src_path, dest_path)
+                return
+            except OSError:
+                pass
+        shutil.copyfile(src_path, dest_path)
+
+    def _evict(self):
+        max_bytes = int(self._settings().get("max_bytes", 1024 * 1024 * 1024))
+        while self._total_bytes > max_bytes and len(self._index) > 1:
+            _, (path, size) = self._index.popitem(last=False)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self._total_bytes -= size
+            self._stats["evictions"] += 1
+
+    def lookup(self, key: str) -> str | None:
+        with self._lock:
+            self._ensure_index()
+            entry = self._index.get(key)
+            if entry is not None and os.path.exists(entry[0]):
+                self._index.move_to_end(key)
+                self._stats["hits"] += 1
+                return entry[0]
+            if entry is not None:
+                del self._index[key]
+                self._total_bytes -= entry[1]
+            self._stats["misses"] += 1
+            return None
+
+    def _register(self, key: str, path: str):
+        size = os.path.getsize(path)
+        with self._lock:
+            self._ensure_index()
+            previous = self._index.pop(key, None)
+            if previous is not None: self._total_bytes -= previous[1]
+            self._index[key] = (path, size)
+            self._total_bytes += size
+            self._stats["stores"] += 1
+            self._evict()
+
+    def _entry_path(self, key: str, ext: str) -> str:
+        folder = os.path.join(self._root(), key[:2])
+        os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, f"{key}{ext.lower()}")
+
+    def put_file(self, key: str, src_path: str) -> str:
+        entry_path = self._entry_path(key, os.path.splitext(src_path)[1])
+        tmp_path = f"{entry_path}.{uuid.uuid4().hex}.tmp"
+        self._link_or_copy(src_path, tmp_path)
+        os.replace(tmp_path, entry_path)
+        self._register(key, entry_path)
+        return entry_path
+
+    def materialize(self, entry_path: str, dest_path: str) -> str:
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        tmp_path = f"{dest_path}.{uuid.uuid4().hex}.tmp"
+        self._link_or_copy(entry_path, tmp_path)
+        os.replace(tmp_path, dest_path)
+        return dest_path
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._ensure_index()
+            return {**self._stats, "entries": len(self._index), "total_bytes": self._total_bytes,
+                    "max_bytes": int(self._settings().get("max_bytes", 1024 * 1024 * 1024))}
+
+
+_STYLIZE_STORE = _ContentStore("stylize", "stylize")
+
+
+# --- 客户端限流 (令牌桶) 与重试 ---
+# 每个上游服务一个共享令牌桶，速率与突发量来自 config.json 的 api.rate_limits.<provider>；
+# 可重试的失败 (429/5xx/连接错误/火山引擎限流码) 按 api.max_retries 与 api.retry_delay 做指数退避 + 抖动，
+# 优先遵循 Retry-After，且不超过单次调用的截止时间 (api.call_deadline)。
+class RateLimitError(Exception):
+    pass
+
+
+class _TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = max(float(rate), 1e-6)
+        self.burst = max(1, int(burst))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, deadline: float = None) -> float | None:
+        # 预占一个令牌，返回需要等待的秒数 (令牌可以透支，等待时间按透支量计算，保证先到先得)；
+        # 等待会超过截止时间时不预占，返回 None
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(float(self.burst), self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait_seconds = 0.0 if self._tokens >= 1.0 else (1.0 - self._tokens) / self.rate
+            if deadline is not None and now + wait_seconds > deadline: return None
+            self._tokens -= 1.0
+            return wait_seconds
+
+    def _refund(self):
+        # 退还 _reserve 预占的令牌 (用于多个令牌桶中有一个未能在截止时间内预占的情况)
+        with self._lock:
+            self._tokens = min(float(self.burst), self._tokens + 1.0)
+
+    def acquire(self, deadline: float = None) -> bool:
+        wait_seconds = self._reserve(deadline)
+        if wait_seconds is None: return False
+        if wait_seconds > 0: time.sleep(wait_seconds)
+        return True
+
+    async def acquire_async(self, deadline: float = None) -> bool:
+        wait_seconds = self._reserve(deadline)
+        if wait_seconds is None: return False
+        if wait_seconds > 0: await asyncio.sleep(wait_seconds)
+        return True
+
+
+class _LimiterChain:
+    # 从每个令牌桶各取一个令牌: 调用方指定的速率 (如批量的 qps) 只能进一步限速，不能绕过进程级的共享限流；
+    # 先在所有令牌桶预占，任一个赶不上截止时间就退还已预占的令牌，再按最长的等待时间休眠
+    def __init__(self, *limiters: _TokenBucket | None):
+        self._limiters = [limiter for limiter in limiters if limiter is not None]
+
+    def _reserve(self, deadline: float = None) -> float | None:
+        reserved, longest_wait = [], 0.0
+        for limiter in self._limiters:
+            wait_seconds = limiter._reserve(deadline)
+            if wait_seconds is None:
+                for earlier in reserved: earlier._refund()
+                return None
+            reserved.append(limiter)
+            longest_wait = max(longest_wait, wait_seconds)
+        return longest_wait
+
+    def acquire(self, deadline: float = None) -> bool:
+        wait_seconds = self._reserve(deadline)
+        if wait_seconds is None: return False
+        if wait_seconds > 0: time.sleep(wait_seconds)
+        return True
+
+    async def acquire_async(self, deadline: float = None) -> bool:
+        wait_seconds = self._reserve(deadline)
+        if wait_seconds is None: return False
+        if wait_seconds > 0: await asyncio.sleep(wait_seconds)
+        return True
+
+
+_RATE_LIMITERS = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+_RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+# 非幂等请求 (如 Together 的生成 POST，按次计费) 只在请求确定未发出 (连接失败) 或被限流 (429) 时重试：
+# 读超时或 5xx 时上游往往已经执行，重试会重复计费并放大负载
+_IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+_NON_IDEMPOTENT_RETRYABLE_STATUS_CODES = {429}
+
+
+def _retryable_status_codes(method: str) -> set[int]:
+    return _RETRYABLE_STATUS_CODES if method.upper() in _IDEMPOTENT_METHODS else _NON_IDEMPOTENT_RETRYABLE_STATUS_CODES
+
+
+def _connect_failed(error: Exception) -> bool:
+    # requests 的 ConnectionError 也包括请求发出后连接被断开的情况，只有建立连接失败才能确定请求未发出
+    if isinstance(error, requests.exceptions.ConnectTimeout): return True
+    from urllib3.exceptions import NewConnectionError
+
+    reason = getattr(error.args[0], "reason", error.args[0]) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def _rate_limiter(provider: str) -> _TokenBucket | None:
+    settings = CONFIG["api"].get("rate_limits", {}).get(provider)
+    if not settings or not settings.get("rate"): return None
+    rate, burst = float(settings["rate"]), int(settings.get("burst", max(1, int(settings["rate"]))))
+    with _RATE_LIMITERS_LOCK:
+        limiter = _RATE_LIMITERS.get(provider)
+        if limiter is None or (limiter.rate, limiter.burst) != (max(rate, 1e-6), max(1, burst)):
+            limiter = _RATE_LIMITERS[provider] = _TokenBucket(rate, burst)
+        return limiter
+
+
+def _call_deadline(deadline: float = None) -> float:
+    return deadline if deadline is not None else time.monotonic() + float(CONFIG["api"].get("call_deadline", 180))
+
+
+def _parse_retry_after(value) -> float | None:
+    if value is None: return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    from email.utils import parsedate_to_datetime
+
+    try:
+        return max(0.0, parsedate_to_datetime(str(value)).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def _backoff_delay(attempt: int, retry_after: float = None) -> float:
+    max_delay = float(CONFIG["api"].get("retry_max_delay", 60))
+    if retry_after is not None: return min(retry_after, max_delay)
+    ceiling = min(max_delay, float(CONFIG["api"].get("retry_delay", 5)) * (2 ** attempt))
+    return random.uniform(ceiling / 2, ceiling)
+
+
+def _rate_limit_error(provider: str) -> RateLimitError:
+    return RateLimitError(f"{provider} 本地限流: 在截止时间内未能获得请求配额，请稍后重试")
+
+
+# --- 请求合并 (single-flight) ---
+# 参数规范化后相同的上游调用同时进行时只发出一次，其余调用等待并共享同一结果 (或同一异常)。
+# 同步调用按线程合并；异步调用按事件循环合并 (future 不能跨事件循环共享)。
+class _SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._futures = {}
+        self._stats = {"calls": 0, "shared": 0}
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader: self._calls[key] = call = {"event": threading.Event(), "result": None, "error": None}
+            self._stats["calls" if leader else "shared"] += 1
+        if not leader:
+            call["event"].wait()
+            if call["error"] is not None: raise call["error"]
+            return call["result"]
+        try:
+            call["result"] = func(*args, **kwargs)
+            return call["result"]
+        except BaseException as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call["event"].set()
+
+    async def do_async(self, key, func, *args, **kwargs):
+        # 共享的调用作为独立任务运行，所有调用方 (包括发起者) 都通过 shield 等待：
+        # 任何一个调用方被取消或断开只影响它自己，不会取消共享调用或让其他等待者失败
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            task = self._futures.get((loop, key))
+            leader = task is None
+            if leader:
+                self._futures[(loop, key)] = task = loop.create_task(func(*args, **kwargs))
+                task.add_done_callback(functools.partial(self._finish_async, (loop, key)))
+            self._stats["calls" if leader else "shared"] += 1
+        return await asyncio.shield(task)
+
+    def _finish_async(self, key, task: asyncio.Task):
+        with self._lock:
+            if self._futures.get(key) is task: self._futures.pop(key)
+        # 标记异常为已读取: 所有等待者都已取消时不产生 "exception was never retrieved" 警告
+        if not task.cancelled(): task.exception()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "in_flight": len(self._calls) + len(self._futures)}
+
+
+_SINGLE_FLIGHT = _SingleFlight()
+
+
+# --- HTTP 连接池 (所有工具共用的 keep-alive 会话) ---
+# 每个 host 一个 requests.Session，复用 TCP+TLS 连接；参数来自 config.json 的 api.http_pool
+class _HttpPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._retired = {"new_connections": 0, "requests": 0}
+
+    @staticmethod
+    def _settings() -> dict:
+        return CONFIG.get("api", {}).get("http_pool", {})
+
+    def _new_session(self) -> "requests.Session":
+        settings = self._settings()
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=int(settings.get("pool_connections", 4)),
+                              pool_maxsize=int(settings.get("per_host_connections", 10)),
+                              pool_block=bool(settings.get("block", False)))
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if not settings.get("keep_alive", True): session.headers["Connection"] = "close"
+        return session
+
+    @staticmethod
+    def _connection_pools(session: "requests.Session") -> list:
+        pools = []
+        for adapter in {id(a): a for a in session.adapters.values()}.values():
+            manager = getattr(adapter, "poolmanager", None)
+            if manager is None: continue
+            pools.extend(manager.pools[key] for key in list(manager.pools.keys()) if key in manager.pools)
+        return pools
+
+    def _retire(self, session: "requests.Session"):
+        for pool in self._connection_pools(session):
+            self._retired["new_connections"] += getattr(pool, "num_connections", 0)
+            self._retired["requests"] += getattr(pool, "num_requests", 0)
+        session.close()
+
+    def session_for(self, url: str) -> "requests.Session":
+        parts = urlsplit(url)
+        host_key = f"{parts.scheme}://{parts.netloc}".lower()
+        with self._lock:
+            session = self._sessions.get(host_key)
+            if session is not None:
+                self._hits += 1
+                self._sessions.move_to_end(host_key)
+                return session
+            self._misses += 1
+            session = self._sessions[host_key] = self._new_session()
+            while len(self._sessions) > max(1, int(self._settings().get("max_hosts", 16))):
+                _, evicted = self._sessions.popitem(last=False)
+                self._retire(evicted)
+            return session
+
+    def request(self, method: str, url: str, **kwargs) -> "requests.Response":
+        return self.session_for(url).request(method, url, **kwargs)
+
+    def reset(self):
+        with self._lock:
+            for session in self._sessions.values(): self._retire(session)
+            self._sessions.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            new_connections, total_requests = self._retired["new_connections"], self._retired["requests"]
+            hosts = {}
+            for host_key, session in self._sessions.items():
+                pools = self._connection_pools(session)
+                host_new = sum(getattr(pool, "num_connections", 0) for pool in pools)
+                host_requests = sum(getattr(pool, "num_requests", 0) for pool in pools)
+                hosts[host_key] = {"new_connections": host_new, "requests": host_requests,
+                                   "idle_connections": sum(1 for pool in pools if pool.pool
+                                                           for conn in list(pool.pool.queue) if conn is not None)}
+                new_connections += host_new
+                total_requests += host_requests
+            return {"hits": self._hits, "misses": self._misses, "new_connections": new_connections,
+                    "requests": total_requests, "reused_connections": max(0, total_requests - new_connections),
+                    "hosts": hosts}
+
+
+_HTTP_POOL = _HttpPool()
+_CONFIG.subscribe("api.http_pool", _HTTP_POOL.reset)
+
+
+def _http_request(method: str, url: str, provider: str = None, deadline: float = None,
+                  **kwargs) -> "requests.Response":
+    # provider 对应 api.rate_limits 中的令牌桶；可重试的状态码/连接错误按退避策略重试，最后一次的响应原样返回
+    max_retries, deadline = int(CONFIG["api"].get("max_retries", 3)), _call_deadline(deadline)
+    limiter = _rate_limiter(provider) if provider else None
+    idempotent, retryable_codes = method.upper() in _IDEMPOTENT_METHODS, _retryable_status_codes(method)
+    attempt = 0
+    while True:
+        if limiter is not None and not limiter.acquire(deadline): raise _rate_limit_error(provider)
+        try:
+            response = _HTTP_POOL.request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e_request:
+            delay = _backoff_delay(attempt)
+            if not (idempotent or _connect_failed(e_request)): raise
+            if attempt >= max_retries or time.monotonic() + delay > deadline: raise
+        else:
+            if response.status_code not in retryable_codes or attempt >= max_retries: return response
+            delay = _backoff_delay(attempt, _parse_retry_after(response.headers.get("Retry-After")))
+            if time.monotonic() + delay > deadline: return response
+            response.close()
+        logger.debug("%s %s 第 %d 次重试，等待 %.2fs", method, urlsplit(url).netloc, attempt + 1, delay)
+        attempt += 1
+        time.sleep(delay)
+
+
+@app.tool()
+def get_http_pool_stats() -> str:
+    """返回共享 HTTP 连接池的统计: 会话命中/未命中、新建连接数、连接复用数及各 host 明细，以及请求合并的统计。"""
+    return json.dumps({"success": True, "stats": _HTTP_POOL.stats(), "single_flight": _SINGLE_FLIGHT.stats()})
+
+
+# --- 图片搜索源 (search providers) ---
+# 每个图片源由 (构造请求, 解析响应, 显示名) 组成，search_images 的单源与多源模式共用这些定义。
+class SearchProviderError(Exception):
+    pass
+
+
+_DEFAULT_ENDPOINTS = {"unsplash": "https://api.unsplash.com", "pexels": "https://api.pexels.com",
+                      "pixabay": "https://pixabay.com", "together": "https://api.together.xyz"}
+
+
+def _api_endpoint(provider: str, path: str) -> str:
+    # 上游服务的根地址可在 api.endpoints 中覆盖 (如代理或 benchmark.py 的本地模拟服务)
+    base_url = CONFIG["api"].get("endpoints", {}).get(provider) or _DEFAULT_ENDPOINTS[provider]
+    return base_url.rstrip("/") + path
+
+
+def _unsplash_request(query: str, per_page: int) -> tuple[str, dict, dict]:
+    if not CONFIG["api"].get("unsplash_access_key"): raise SearchProviderError("Unsplash API key未配置")
+    return _api_endpoint("unsplash", "/search/photos"), {
+        "Authorization": f"Client-ID {CONFIG['api']['unsplash_access_key']}"}, {"query": query, "per_page": per_page}
+
+
+def _unsplash_results(data: dict) -> list[dict]:
+    return [{"id": item.get("id"), "url": item.get("urls", {}).get("small"), "thumb": item.get("urls", {}).get("thumb"),
+             "source": "unsplash", "author": item.get("user", {}).get("name"),
+             "download_url": item.get("urls", {}).get("raw")} for item in data.get("results", [])]
+
+
+def _pexels_request(query: str, per_page: int) -> tuple[str, dict, dict]:
+    if not CONFIG["api"].get("pexels_api_key"): raise SearchProviderError("Pexels API key未配置")
+    return _api_endpoint("pexels", "/v1/search"), {"Authorization": CONFIG['api']['pexels_api_key']}, {
+        "query": query, "per_page": per_page}
+
+
+def _pexels_results(data: dict) -> list[dict]:
+    return [{"id": str(item.get("id")), "url": item.get("src", {}).get("medium"),
+             "thumb": item.get("src", {}).get("tiny"), "source": "pexels", "author": item.get("photographer"),
+             "download_url": item.get("src", {}).get("original")} for item in data.get("photos", [])]
+
+
+def _pixabay_request(query: str, per_page: int) -> tuple[str, dict, dict]:
+    if not CONFIG["api"].get("pixabay_api_key"): raise SearchProviderError("Pixabay API key未配置")
+    return _api_endpoint("pixabay", "/api/"), {}, {"key": CONFIG['api']['pixabay_api_key'], "q": query,
+                                            "per_page": per_page, "image_type": "photo"}
+
+
+def _pixabay_results(data: dict) -> list[dict]:
+    return [{"id": str(item.get("id")), "url": item.get("webformatURL"), "thumb": item.get("previewURL"),
+             "source": "pixabay", "author": item.get("user"), "download_url": item.get("largeImageURL")}
+            for item in data.get("hits", [])]
+
+
+_SEARCH_PROVIDERS = {
+    "unsplash": (_unsplash_request, _unsplash_results, "Unsplash", "unsplash_access_key"),
+    "pexels": (_pexels_request, _pexels_results, "Pexels", "pexels_api_key"),
+    "pixabay": (_pixabay_request, _pixabay_results, "Pixabay", "pixabay_api_key"),
+}
+_SEARCH_EXECUTOR = None
+
+
+# --- 搜索结果缓存 (内存 TTL/LRU + 可选的磁盘持久层) ---
+# 以 (source, query) 为键并记录抓取时的 per_page；请求更少结果时直接从更大的缓存结果集中截取
+class _SearchCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "expired": 0, "stores": 0}
+
+    @staticmethod
+    def _settings() -> dict:
+        return CONFIG.get("cache", {}).get("search", {})
+
+    @staticmethod
+    def _key(source: str, query: str) -> tuple[str, str]:
+        return source, " ".join(query.lower().split())
+
+    def _disk_path(self, key: tuple[str, str]) -> str | None:
+        if not self._settings().get("persist", True): return None
+        digest = hashlib.sha256(json.dumps(key, ensure_ascii=False).encode("utf-8")).hexdigest()
+        return os.path.join(CONFIG["output"]["base_folder"], ".cache", "search", f"{digest}.json")
+
+    @staticmethod
+    def _serves(entry: dict, per_page: int) -> bool:
+        # 缓存的结果集足够大，或者上游返回的结果本就少于当时请求的数量 (已是全部结果)
+        return entry["per_page"] >= per_page or len(entry["results"]) < entry["per_page"]
+
+    def _load_from_disk(self, key: tuple[str, str]) -> dict | None:
+        path = self._disk_path(key)
+        if not path or not os.path.exists(path): return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            if entry.get("key") != list(key): return None
+            return {"stored_at": float(entry["stored_at"]), "per_page": int(entry["per_page"]),
+                    "results": entry["results"]}
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _store_in_memory(self, key: tuple[str, str], entry: dict):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > max(1, int(self._settings().get("max_entries", 512))):
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def get(self, source: str, query: str, per_page: int) -> list[dict] | None:
+        settings = self._settings()
+        if not settings.get("enabled", True): return None
+        key, ttl, now = self._key(source, query), float(settings.get("ttl", 3600)), time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry["stored_at"] > ttl:
+                del self._entries[key]
+                self._stats["expired"] += 1
+                entry = None
+            if entry is not None and self._serves(entry, per_page):
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return entry["results"][:per_page]
+        disk_entry = self._load_from_disk(key)
+        with self._lock:
+            if disk_entry is not None and now - disk_entry["stored_at"] <= ttl and self._serves(disk_entry, per_page):
+                self._store_in_memory(key, disk_entry)
+                self._stats["disk_hits"] += 1
+                return disk_entry["results"][:per_page]
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, source: str, query: str, per_page: int, results: list[dict]):
+        if not self._settings().get("enabled", True): return
+        key = self._key(source, query)
+        entry = {"stored_at": time.time(), "per_page": per_page, "results": results}
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None and current["per_page"] > per_page and self._serves(current, per_page):
+                return
+            self._store_in_memory(key, entry)
+            self._stats["stores"] += 1
+        path = self._disk_path(key)
+        if path:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump({"key": list(key), **entry}, f, ensure_ascii=False)
+                os.replace(tmp_path, path)
+            except OSError as e_write:
+                logger.warning("写入搜索缓存文件失败: %s", e_write)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["disk_hits"] + self._stats["misses"]
+            return {**self._stats, "entries": len(self._entries),
+                    "hit_ratio": round((self._stats["hits"] + self._stats["disk_hits"]) / lookups, 4) if lookups else 0.0}
+
+
+_SEARCH_CACHE = _SearchCache()
+
+
+def _search_flight_key(source: str, query: str, per_page: int) -> tuple:
+    return ("search", *_SearchCache._key(source, query), per_page)
+
+
+def _search_source(source: str, query: str, per_page: int, timeout: float, deadline: float = None) -> list[dict]:
+    cached = _SEARCH_CACHE.get(source, query, per_page)
+    if cached is not None: return cached
+    return _SINGLE_FLIGHT.do(_search_flight_key(source, query, per_page), _fetch_search, source, query, per_page,
+                             timeout, deadline)
+
+
+def _fetch_search(source: str, query: str, per_page: int, timeout: float, deadline: float = None) -> list[dict]:
+    api_url, headers, params = _SEARCH_PROVIDERS[source][0](query, per_page)
+    with _stage("upstream", source) as stage:
+        response = _http_request("GET", api_url, provider=source, deadline=deadline, headers=headers, params=params,
+                                 timeout=timeout)
+        stage["bytes_in"], stage["error"] = len(response.content), response.status_code != 200
+    return _finish_search(source, query, per_page, response)
+
+
+def _finish_search(source: str, query: str, per_page: int, response) -> list[dict]:
+    # 同步 (requests) 与异步 (httpx) 的响应对象接口一致，解析与缓存逻辑共用
+    _, parse_results, label, _ = _SEARCH_PROVIDERS[source]
+    if response.status_code != 200:
+        raise SearchProviderError(f"{label} API错误: {response.status_code} - {response.text[:200]}")
+    results = parse_results(response.json())
+    _SEARCH_CACHE.put(source, query, per_page, results)
+    return results
+
+
+def _parse_search_sources(source: str) -> list[str]:
+    # "all" 表示所有已配置 API key 的图片源；也可以传逗号分隔的列表，如 "unsplash,pexels"
+    if source.strip().lower() == "all":
+        return [name for name, spec in _SEARCH_PROVIDERS.items() if CONFIG["api"].get(spec[3])]
+    sources = []
+    for name in source.split(","):
+        name = name.strip().lower()
+        if not name: continue
+        if name not in _SEARCH_PROVIDERS:
+            raise ValueError(f"不支持图片源: {name}. 支持的源: {', '.join(_SEARCH_PROVIDERS)}, all")
+        if name not in sources: sources.append(name)
+    if not sources: raise ValueError(f"未指定图片源. 支持的源: {', '.join(_SEARCH_PROVIDERS)}, all")
+    return sources
+
+
+def _search_params(source: str, max_results) -> tuple[list[str], int, float, bool]:
+    try:
+        max_results_int = int(max_results)
+    except (TypeError, ValueError):
+        raise ValueError("max_results必须是有效的数字")
+    max_results_int = min(max(1, max_results_int), CONFIG["image"]["max_results"]);
+    sources = _parse_search_sources(source)
+    if not sources: raise ValueError("没有已配置 API key 的图片源")
+    fan_out = len(sources) > 1 or source.strip().lower() == "all"
+    return sources, max_results_int, CONFIG["api"].get("timeout", 30), fan_out
+
+
+def _get_search_executor() -> ThreadPoolExecutor:
+    global _SEARCH_EXECUTOR
+    if _SEARCH_EXECUTOR is None:
+        _SEARCH_EXECUTOR = ThreadPoolExecutor(max_workers=4 * len(_SEARCH_PROVIDERS), thread_name_prefix="search")
+    return _SEARCH_EXECUTOR
+
+
+def _result_dedup_keys(item: dict) -> list[tuple]:
+    keys = [("id", item.get("source"), item.get("id"))] if item.get("id") else []
+    for field in ("download_url", "url"):
+        if item.get(field): keys.append(("url", item[field].split("?", 1)[0]))
+    return keys
+
+
+def _merge_search_results(per_source: dict[str, list[dict]], sources: list[str], limit: int) -> list[dict]:
+    # 按各源自身的相关度排名轮流取结果 (第1名们, 第2名们, ...)，并按 id / 去掉查询参数的 URL 去重
+    merged, seen = [], set()
+    depth = max((len(items) for items in per_source.values()), default=0)
+    for rank in range(depth):
+        for name in sources:
+            items = per_source.get(name, [])
+            if rank >= len(items): continue
+            keys = _result_dedup_keys(items[rank])
+            if any(key in seen for key in keys): continue
+            seen.update(keys)
+            merged.append(items[rank])
+            if len(merged) >= limit: return merged
+    return merged
+
+
+def _search_error_message(exc: BaseException) -> str:
+    if isinstance(exc, (SearchProviderError, RateLimitError)): return str(exc)
+    if isinstance(exc, requests.exceptions.RequestException) or (httpx and isinstance(exc, httpx.HTTPError)):
+        return f"搜索时网络请求错误: {exc}"
+    return f"搜索时未知错误: {exc}"
+
+
+def _search_summary(sources: list[str], outcomes: dict, per_page: int, deadline: float, started: float) -> dict:
+    # outcomes: 源名 -> 结果列表 | 异常 | None (超过截止时间)
+    per_source, status = {}, {}
+    for name in sources:
+        outcome = outcomes.get(name)
+        if outcome is None:
+            status[name] = {"success": False, "error": f"超过截止时间 {deadline}s 未返回"}
+        elif isinstance(outcome, BaseException):
+            status[name] = {"success": False, "error": _search_error_message(outcome)}
+        else:
+            per_source[name] = outcome
+            status[name] = {"success": True, "count": len(outcome)}
+    results = _merge_search_results(per_source, sources, per_page)
+    elapsed_ms = int((time.monotonic() - started) * 1000)
+    if not per_source:
+        return {"success": False, "error": "所有图片源均搜索失败", "sources": status, "elapsed_ms": elapsed_ms}
+    return {"success": True, "results": results, "sources": status, "elapsed_ms": elapsed_ms}
+
+
+def _search_many(sources: list[str], query: str, per_page: int, api_timeout: float) -> dict:
+    # 并发查询所有源；每个源有独立的截止时间，超时或失败只丢弃该源自己的结果
+    deadline = float(CONFIG["api"].get("search_deadline", api_timeout))
+    started = time.monotonic()
+    search_source = _with_context(_search_source)
+    futures = {_get_search_executor().submit(search_source, name, query, per_page, min(api_timeout, deadline),
+                                             started + deadline): name for name in sources}
+    _, not_done = wait(futures, timeout=deadline)
+    outcomes = {}
+    for future, name in futures.items():
+        if future in not_done:
+            future.cancel()
+            continue
+        try:
+            outcomes[name] = future.result()
+        except Exception as e:
+            outcomes[name] = e
+    return _search_summary(sources, outcomes, per_page, deadline, started)
+
+
+@app.tool()
+def get_search_cache_stats(clear: bool = False) -> str:
+    """返回 search_images 结果缓存的命中/未命中/淘汰统计；clear=True 时在统计后清空内存缓存。"""
+    stats = _SEARCH_CACHE.stats()
+    if clear: _SEARCH_CACHE.clear()
+    return json.dumps({"success": True, "stats": stats, "cleared": bool(clear)})
+
+
+@app.tool()
+@_metered()
+def watermark_images(
+        image_paths: list[str],
+        text: str = None,
+        logo_image_path: str = None,
+        position: str = "bottom-right",
+        opacity: int = 128,
+        font_path: str = None,
+        font_size: int = None,
+        logo_width: int = None,
+        margin: int = 10,
+        save_folder: str = None,
+        suffix: str = "_wm",
+        in_place: bool = False,
+        max_workers: int = None
+) -> str:
+    """批量给已有图片加文字和/或图片 Logo 水印。position: bottom-right/bottom-left/top-left/top-right/center；
+    opacity 0-255。默认输出为 <原文件名><suffix><扩展名>，in_place=True 时覆盖原文件。"""
+    if isinstance(image_paths, str): image_paths = [image_paths]
+    if not image_paths: return json.dumps({"success": False, "error": "image_paths 不能为空"})
+    if not text and not logo_image_path: return json.dumps({"success": False, "error": "text 与 logo_image_path 至少提供一个"})
+    if position not in WATERMARK_POSITIONS:
+        return json.dumps({"success": False, "error": f"不支持的位置: {position}. 可选: {', '.join(WATERMARK_POSITIONS)}"})
+    output_conf = CONFIG.get("output", {})
+    tiles = []
+    try:
+        if logo_image_path:
+            if not os.path.exists(logo_image_path):
+                return json.dumps({"success": False, "error": f"Logo 图片不存在: {logo_image_path}"})
+            tiles.append(_image_watermark_tile(logo_image_path, os.path.getmtime(logo_image_path), int(logo_width or 0),
+                                               int(opacity)))
+        if text:
+            tiles.append(_text_watermark_tile(text, font_path or output_conf.get("logo_font_path"),
+                                              int(font_size or output_conf.get("logo_font_size", 20)), int(opacity)))
+    except Exception as e_tile:
+        return json.dumps({"success": False, "error": f"渲染水印失败: {e_tile}"})
+    # 同一位置同时有 Logo 与文字时，文字放在 Logo 的内侧 (上方) 以免重叠
+    if len(tiles) == 2 and position != "center":
+        combined = Image.new("RGBA", (max(t.width for t in tiles), tiles[0].height + tiles[1].height + 4), (0, 0, 0, 0))
+        align_right = position.endswith("right")
+        for tile, top in ((tiles[1], 0), (tiles[0], tiles[1].height + 4)):
+            combined.alpha_composite(tile, dest=(combined.width - tile.width if align_right else 0, top))
+        tiles = [combined]
+
+    def run(index: int, source_path: str) -> dict:
+        item, dest_path = {"index": index, "input_path": source_path}, None
+        try:
+            if not os.path.exists(source_path): raise ValueError(f"图片文件不存在: {source_path}")
+            if in_place:
+                dest_path = source_path
+            else:
+                base_name, ext = os.path.splitext(os.path.basename(source_path))
+                dest_folder = save_folder or os.path.dirname(os.path.abspath(source_path))
+                dest_path, _, _ = _handle_save_path(f"{base_name}{suffix}{ext}", dest_folder)
+            _watermark_file(source_path, dest_path, tiles, position, int(margin))
+            item.update({"success": True, "file_path": dest_path})
+        except Exception as e:
+            if not in_place and dest_path: _release_save_path(dest_path)
+            item.update({"success": False, "error": str(e)})
+        return item
+
+    workers = max(1, int(max_workers or os.cpu_count() or 4))
+    with ThreadPoolExecutor(max_workers=min(workers, len(image_paths)), thread_name_prefix="watermark") as executor:
+        results = list(executor.map(_with_context(lambda pair: run(*pair)), enumerate(image_paths)))
+    succeeded = sum(1 for item in results if item["success"])
+    return json.dumps({"success": succeeded > 0, "total": len(results), "succeeded": succeeded,
+                       "failed": len(results) - succeeded, "results": results})
+
+
+# --- 多尺寸衍生图 (derivatives) ---
+# 保存成功后可选地生成 64/128/256/512 等尺寸的 PNG/WebP 版本: 在进程池中只解码一次原图，
+# 从大到小逐级缩小 (每级以上一级结果为源)，避免每个尺寸都从全尺寸原图重采样。
+# 衍生图命名为 {原文件名}@{尺寸} (如 icon@64.png)：用 "@" 而不是 "_"，免得 _SAVE_NAMES 把尺寸当成重名序号。
+DERIVATIVE_FORMATS = {"png": ("PNG", ".png"), "webp": ("WEBP", ".webp")}
+_DERIVATIVE_EXECUTOR = None
+_DERIVATIVE_EXECUTOR_LOCK = threading.Lock()
+
+
+def _derivative_settings() -> dict:
+    settings = dict(CONFIG.get("output", {}).get("derivatives") or {})
+    sizes = sorted({int(size) for size in settings.get("sizes") or [] if int(size) > 0}, reverse=True)
+    formats = [str(fmt).lower().lstrip(".") for fmt in settings.get("formats") or ["png"]]
+    unknown = [fmt for fmt in formats if fmt not in DERIVATIVE_FORMATS]
+    if unknown: raise ValueError(f"不支持的衍生图格式: {', '.join(unknown)}. 可选: {', '.join(DERIVATIVE_FORMATS)}")
+    if not sizes: raise ValueError("output.derivatives.sizes 未配置有效尺寸")
+    settings.update({"sizes": sizes, "formats": list(dict.fromkeys(formats))})
+    return settings
+
+
+def _render_derivatives(source_path: str, targets: dict[int, list[tuple[str, str]]], webp_quality: int) -> list[dict]:
+    # 在子进程中执行: 一次解码，按尺寸从大到小逐级缩小；targets 为 {尺寸: [(格式, 已预留的目标路径), ...]}
+    sizes = sorted(targets, reverse=True)
+    with Image.open(source_path) as img:
+        img.draft("RGB", (sizes[0], sizes[0]))
+        current = img.convert("RGBA" if _has_alpha(img) else "RGB")
+    generated = []
+    for size in sizes:
+        # 先用盒式滤波按整数倍快速缩小到目标的 2 倍以内，再用 LANCZOS 精确缩放
+        while max(current.size) >= size * 4:
+            current = current.reduce(2)
+        if max(current.size) > size:
+            scale = size / max(current.size)
+            current = current.resize((max(1, round(current.width * scale)), max(1, round(current.height * scale))),
+                                     Image.Resampling.LANCZOS)
+        for fmt, dest_path in targets[size]:
+            pil_format = DERIVATIVE_FORMATS[fmt][0]
+            tmp_path = f"{dest_path}.{uuid.uuid4().hex}.tmp"
+            try:
+                current.save(tmp_path, pil_format, **({"quality": int(webp_quality)} if pil_format == "WEBP" else {}))
+                os.replace(tmp_path, dest_path)
+            finally:
+                if os.path.exists(tmp_path): os.remove(tmp_path)
+            generated.append({"size": size, "format": fmt, "width": current.width, "height": current.height,
+                              "file_path": dest_path})
+    return generated
+
+
+def _get_derivative_executor() -> "ProcessPoolExecutor":
+    global _DERIVATIVE_EXECUTOR
+    with _DERIVATIVE_EXECUTOR_LOCK:
+        if _DERIVATIVE_EXECUTOR is None:
+            from concurrent.futures import ProcessPoolExecutor
+
+            workers = CONFIG.get("output", {}).get("derivatives", {}).get("max_workers") or os.cpu_count() or 2
+            _DERIVATIVE_EXECUTOR = ProcessPoolExecutor(max_workers=max(1, int(workers)))
+        return _DERIVATIVE_EXECUTOR
+
+
+def _reset_derivative_executor(shutdown: bool = False):
+    # shutdown=True (配置变更) 时旧进程池在已提交的任务完成后退出
+    global _DERIVATIVE_EXECUTOR
+    with _DERIVATIVE_EXECUTOR_LOCK:
+        executor, _DERIVATIVE_EXECUTOR = _DERIVATIVE_EXECUTOR, None
+    if shutdown and executor is not None: executor.shutdown(wait=False)
+
+
+_CONFIG.subscribe("output.derivatives.max_workers", functools.partial(_reset_derivative_executor, shutdown=True))
+
+
+def _derivatives_requested(derivatives: bool | None) -> bool:
+    if derivatives is None: return bool(CONFIG.get("output", {}).get("derivatives", {}).get("enabled"))
+    return bool(derivatives)
+
+
+def _submit_derivatives(file_path: str):
+    # 目标文件名与主文件一样经 _SAVE_NAMES 预留 ({stem}@{size} 已存在时取下一个序号)，子进程只替换这些占位文件
+    settings = _derivative_settings()
+    dest_folder = os.path.dirname(file_path)
+    if settings.get("subfolder"): dest_folder = os.path.join(dest_folder, settings["subfolder"])
+    os.makedirs(dest_folder, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    targets, reserved = {}, []
+
+    def release(future=None):
+        if future is None or future.cancelled() or future.exception() is not None:
+            for path in reserved: _release_save_path(path)
+
+    try:
+        for size in settings["sizes"]:
+            for fmt in settings["formats"]:
+                ext = DERIVATIVE_FORMATS[fmt][1]
+                dest_path = os.path.join(dest_folder, _SAVE_NAMES.reserve(dest_folder, f"{stem}@{size}{ext}",
+                                                                          f"{stem}@{size}", ext))
+                reserved.append(dest_path)
+                targets.setdefault(size, []).append((fmt, dest_path))
+        future = _get_derivative_executor().submit(_render_derivatives, file_path, targets,
+                                                   settings.get("webp_quality", 90))
+    except BaseException:
+        release()
+        raise
+    future.add_done_callback(release)
+    return future
+
+
+def _attach_derivatives_result(result: dict, future=None, error: BaseException = None) -> dict:
+    # 衍生图失败不影响主文件的成功状态，只在结果中附带错误信息
+    if error is None:
+        try:
+            result["derivatives"] = future.result()
+            return result
+        except Exception as e:
+            error = e
+    from concurrent.futures.process import BrokenProcessPool
+
+    if isinstance(error, BrokenProcessPool): _reset_derivative_executor()
+    result["derivatives"] = []
+    result["derivatives_error"] = f"生成衍生图失败: {error}"
+    return result
+
+
+def _with_derivatives(result: dict, derivatives: bool | None) -> dict:
+    if not result.get("success") or not _derivatives_requested(derivatives): return result
+    try:
+        future = _submit_derivatives(result["file_path"])
+    except Exception as e:
+        return _attach_derivatives_result(result, error=e)
+    return _attach_derivatives_result(result, future)
+
+
+async def _with_derivatives_async(result: dict, derivatives: bool | None) -> dict:
+    if not result.get("success") or not _derivatives_requested(derivatives): return result
+    try:
+        future = _submit_derivatives(result["file_path"])
+        await asyncio.wrap_future(future)
+    except Exception as e:
+        return _attach_derivatives_result(result, error=e)
+    return _attach_derivatives_result(result, future)
+
+
+# --- 其他工具函数 (search_images, download_image, generate_icon_togetherai) ---
+@app.tool()
+@_metered(provider_arg="source")
+def search_images(query: str, source: str = "unsplash", max_results: str = "10") -> str:
+    # source 可以是单个图片源、逗号分隔的多个源或 "all"；多源时并发查询并合并去重
+    try:
+        sources, max_results_int, api_timeout, fan_out = _search_params(source, max_results)
+    except ValueError as ve:
+        return json.dumps({"success": False, "error": str(ve)})
+    if fan_out:
+        return json.dumps(_search_many(sources, query, max_results_int, api_timeout))
+    try:
+        results = _search_source(sources[0], query, max_results_int, api_timeout)
+    except Exception as e:
+        return json.dumps({"success": False, "error": _search_error_message(e)})
+    return json.dumps({"success": True, "results": results})
+
+
+class DownloadError(Exception):
+    pass
+
+
+class _IncompleteDownload(DownloadError):
+    pass
+
+
+# --- 下载引擎: 临时文件 + 断点续传 + 校验 + 原子替换 ---
+# 数据先写入目标目录下按 URL 命名的 .<摘要>.part 文件 (旁边的 .part.json 记录 ETag/Last-Modified)，
+# 连接中断时用 Range/If-Range 从已写入的位置继续；长度 (Content-Length/Content-Range) 与可选的 sha256 校验通过后
+# 才 os.replace 到最终路径。因网络原因失败且有校验标识时保留 .part，之后同一 URL 下载到同一目录可继续。
+_ACTIVE_PARTS_LOCK = threading.Lock()
+_ACTIVE_PARTS = set()  # 正在被某个下载使用的 .part 路径，下载结束时移除
+
+
+class _PartialDownload:
+    def __init__(self, url: str, save_path: str, expected_sha256: str = None):
+        download_conf = CONFIG.get("download", {})
+        self.url, self.save_path = url, save_path
+        self.expected_sha256 = expected_sha256.lower() if expected_sha256 else None
+        self.max_bytes = int(download_conf.get("max_bytes") or 0)
+        self.min_chunk = int(download_conf.get("min_chunk_size", 64 * 1024))
+        self.max_chunk = int(download_conf.get("max_chunk_size", 1024 * 1024))
+        url_key = hashlib.sha256(url.encode("utf-8")).hexdigest()[:32]
+        self.part_path = os.path.join(os.path.dirname(save_path), f".{url_key}.part")
+        # 同一 URL 同时下载到同一目录时，后来者使用独立的临时文件 (不参与续传)
+        with _ACTIVE_PARTS_LOCK:
+            self._owns_part = self.part_path not in _ACTIVE_PARTS
+            if self._owns_part: _ACTIVE_PARTS.add(self.part_path)
+        if not self._owns_part:
+            self.part_path = os.path.join(os.path.dirname(save_path), f".{url_key}.{uuid.uuid4().hex}.part")
+        self.meta_path = f"{self.part_path}.json"
+        self.validator, self.total, self.offset, self.resumed = None, None, 0, False
+        self._file, self._hash = None, hashlib.sha256()
+        self._load_partial()
+
+    def _load_partial(self):
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get("url") == self.url and meta.get("validator") and os.path.exists(self.part_path):
+                self.validator, self.total = meta["validator"], meta.get("total")
+                self.offset = os.path.getsize(self.part_path)
+        except (OSError, ValueError):
+            self.offset = 0
+        if self.offset:
+            with open(self.part_path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    self._hash.update(block)
+
+    def request_headers(self) -> dict:
+        if not self.offset: return {}
+        headers = {"Range": f"bytes={self.offset}-"}
+        if self.validator: headers["If-Range"] = self.validator
+        return headers
+
+    def _restart(self):
+        self.offset, self.total, self.resumed, self._hash = 0, None, False, hashlib.sha256()
+
+    def _save_meta(self):
+        try:
+            with open(self.meta_path, 'w', encoding='utf-8') as f:
+                json.dump({"url": self.url, "validator": self.validator, "total": self.total}, f)
+        except OSError:
+            pass
+
+    def begin(self, status_code: int, headers) -> int:
+        # 根据响应状态准备写入，返回本次响应体的块大小；0 表示无需读取响应体 (已完整)
+        if self._file is not None: self._file.close(); self._file = None
+        content_range = headers.get("Content-Range") or ""
+        if status_code == 416 and self.offset:
+            total = content_range.rpartition("/")[2]
+            if total.isdigit() and int(total) == self.offset:
+                self.total = self.offset
+                return 0
+            self._restart()
+            raise _IncompleteDownload("续传位置无效，重新下载")
+        if status_code == 206 and self.offset:
+            start = content_range.partition(" ")[2].partition("-")[0]
+            if start != str(self.offset):
+                self._restart()
+                raise _IncompleteDownload("服务器返回的续传范围不匹配，重新下载")
+            total = content_range.rpartition("/")[2]
+            self.total, self.resumed = (int(total) if total.isdigit() else None), True
+            mode = 'ab'
+        elif status_code == 200:
+            self._restart()
+            length = headers.get("Content-Length")
+            self.total = int(length) if length and length.isdigit() and not headers.get("Content-Encoding") else None
+            mode = 'wb'
+        else:
+            raise DownloadError(f"下载失败，状态码: {status_code}, URL: {self.url}")
+        if self.max_bytes and self.total and self.total > self.max_bytes:
+            raise DownloadError(f"文件过大: {self.total} 字节，超过上限 download.max_bytes={self.max_bytes}")
+        if not self.resumed:
+            # If-Range 只接受强 ETag 或 Last-Modified
+            etag = headers.get("ETag")
+            self.validator = etag if etag and not etag.startswith("W/") else headers.get("Last-Modified")
+            if self.validator: self._save_meta()
+        self._file = open(self.part_path, mode)
+        remaining = (self.total - self.offset) if self.total else None
+        return self.max_chunk // 4 if remaining is None else max(self.min_chunk, min(self.max_chunk, remaining // 32))
+
+    def write(self, chunk: bytes):
+        if self.max_bytes and self.offset + len(chunk) > self.max_bytes:
+            raise DownloadError(f"文件过大: 已超过上限 download.max_bytes={self.max_bytes}")
+        self._file.write(chunk)
+        self._hash.update(chunk)
+        self.offset += len(chunk)
+
+    def finish(self) -> dict:
+        if self._file is not None: self._file.close(); self._file = None
+        if self.total is not None and self.offset < self.total:
+            raise _IncompleteDownload(f"下载不完整: 已接收 {self.offset}/{self.total} 字节")
+        if self.total is not None and self.offset > self.total:
+            raise DownloadError(f"下载长度不符: 接收 {self.offset} 字节，预期 {self.total} 字节")
+        digest = self._hash.hexdigest()
+        if self.expected_sha256 and digest != self.expected_sha256:
+            raise DownloadError(f"sha256 校验失败: 预期 {self.expected_sha256}，实际 {digest}")
+        if not os.path.exists(self.part_path): open(self.part_path, 'wb').close()
+        os.replace(self.part_path, self.save_path)
+        _remove_quietly(self.meta_path)
+        return {"bytes": self.offset, "sha256": digest, "resumed": self.resumed}
+
+    def close(self, keep_partial: bool = False):
+        if self._file is not None: self._file.close(); self._file = None
+        if not (keep_partial and self.validator and self.offset and self._owns_part):
+            _remove_quietly(self.part_path)
+            _remove_quietly(self.meta_path)
+        if self._owns_part:
+            with _ACTIVE_PARTS_LOCK:
+                _ACTIVE_PARTS.discard(self.part_path)
+            self._owns_part = False
+
+
+# --- 下载去重: URL -> 内容摘要索引 + 内容寻址存储 ---
+# 下载完成后按 sha256 存入 .cache/downloads (与下载结果硬链接，磁盘上只占一份)，并记录 URL -> sha256；
+# 再次下载同一 URL 时直接从存储链接/复制出来，不再访问网络；不同 URL 得到相同内容时也只保留一份。
+# URL 索引以追加写的 JSONL 持久化 (.cache/download_urls.jsonl)，重复记录过多时压缩重写。
+class _UrlContentIndex:
+    def __init__(self, file_name: str, settings_key: str):
+        self._file_name = file_name
+        self._settings_key = settings_key
+        self._lock = threading.Lock()
+        self._entries = None
+        self._loaded_path = None
+        self._lines = 0
+
+    def _path(self) -> str:
+        return os.path.join(CONFIG["output"]["base_folder"], ".cache", self._file_name)
+
+    def _ensure_loaded(self):
+        path = self._path()
+        if self._entries is not None and self._loaded_path == path: return
+        self._entries, self._lines, self._loaded_path = {}, 0, path
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        self._entries[record["url"]] = (record["sha256"], record.get("time", 0))
+                    except (ValueError, KeyError, TypeError):
+                        continue  # 损坏或缺字段的行直接跳过
+                    self._lines += 1
+        except OSError:
+            pass
+
+    def get(self, url: str) -> str | None:
+        ttl = float(CONFIG.get("cache", {}).get(self._settings_key, {}).get("url_ttl") or 0)
+        with self._lock:
+            self._ensure_loaded()
+            entry = self._entries.get(url)
+        if entry is None or (ttl and time.time() - entry[1] > ttl): return None
+        return entry[0]
+
+    def put(self, url: str, sha256: str):
+        with self._lock:
+            self._ensure_loaded()
+            now = time.time()
+            self._entries[url] = (sha256, now)
+            path = self._path()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                if self._lines > 2 * len(self._entries) + 1000:
+                    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+                    with open(tmp_path, 'w', encoding='utf-8') as f:
+                        for entry_url, (entry_sha, entry_time) in self._entries.items():
+                            f.write(json.dumps({"url": entry_url, "sha256": entry_sha, "time": entry_time}) + "\n")
+                    os.replace(tmp_path, path)
+                    self._lines = len(self._entries)
                 else:
-                    raise Exception("API响应成功(200)，但在 'data[0].b64_json' 未找到图像数据。")
-            except (json.JSONDecodeError, IndexError, KeyError, Exception) as inner_e:
-                return json.dumps({"success": False,
-                                   "error": f"处理API成功响应时出错: {inner_e}. 响应(部分): {response_text_for_debug[:500]}"})
+                    with open(path, 'a', encoding='utf-8') as f:
+                        f.write(json.dumps({"url": url, "sha256": sha256, "time": now}) + "\n")
+                    self._lines += 1
+            except OSError as e_index:
+                logger.warning("写入下载 URL 索引失败: %s", e_index)
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._ensure_loaded()
+            return {"urls": len(self._entries)}
+
+
+_DOWNLOAD_STORE = _ContentStore("downloads", "downloads")
+_DOWNLOAD_URLS = _UrlContentIndex("download_urls.jsonl", "downloads")
+
+
+def _download_from_store(url: str, save_path: str, sha256: str = None) -> dict | None:
+    # URL 曾下载过且内容仍在存储中时直接放到目标路径，返回与 _stream_download 相同结构的信息
+    if not _DOWNLOAD_STORE.enabled(): return None
+    digest = _DOWNLOAD_URLS.get(url)
+    if not digest or (sha256 and digest != sha256.lower()): return None
+    entry_path = _DOWNLOAD_STORE.lookup(digest)
+    if not entry_path: return None
+    _DOWNLOAD_STORE.materialize(entry_path, save_path)
+    return {"bytes": os.path.getsize(save_path), "sha256": digest, "resumed": False, "dedup": "url"}
+
+
+def _store_download(url: str, save_path: str, info: dict) -> dict:
+    # 新下载的内容已存在 (其他 URL 下载过) 时改为链接到已有副本，否则把本文件登记进存储
+    if not _DOWNLOAD_STORE.enabled(): return info
+    digest = info["sha256"]
+    try:
+        entry_path = _DOWNLOAD_STORE.lookup(digest)
+        if entry_path:
+            _DOWNLOAD_STORE.materialize(entry_path, save_path)
+            info = {**info, "dedup": "content"}
+        else:
+            _DOWNLOAD_STORE.put_file(digest, save_path)
+        _DOWNLOAD_URLS.put(url, digest)
+    except OSError as e_store:
+        logger.warning("写入下载去重存储失败: %s", e_store)
+    return info
+
+
+def _fetch_download(url: str, save_path: str, timeout: float, sha256: str = None) -> dict:
+    info = _download_from_store(url, save_path, sha256)
+    if info is not None: return info
+    with _stage("download") as stage:
+        info = _stream_download(url, save_path, timeout, sha256)
+        stage["bytes_in"] = info["bytes"]
+    return _store_download(url, save_path, info)
+
+
+async def _fetch_download_async(url: str, save_path: str, timeout: float, sha256: str = None) -> dict:
+    info = await _run_blocking(_download_from_store, url, save_path, sha256)
+    if info is not None: return info
+    with _stage("download") as stage:
+        info = await _stream_download_async(url, save_path, timeout, sha256)
+        stage["bytes_in"] = info["bytes"]
+    return await _run_blocking(_store_download, url, save_path, info)
+
+
+@app.tool()
+def get_download_cache_stats() -> str:
+    """返回下载去重存储 (URL 索引 + 内容寻址存储) 的命中/未命中/淘汰统计与占用空间。"""
+    return json.dumps({"success": True, "stats": {**_DOWNLOAD_STORE.stats(), **_DOWNLOAD_URLS.stats()}})
+
+
+def _resume_attempts() -> int:
+    return max(0, int(CONFIG.get("download", {}).get("resume_attempts", 3)))
+
+
+def _stream_download(url: str, save_path: str, timeout: float, sha256: str = None) -> dict:
+    # 边接收边写入临时文件，不在内存中缓存整个文件；连接中断时按 Range 续传
+    part, keep_partial = _PartialDownload(url, save_path, sha256), False
+    try:
+        attempt = 0
+        while True:
+            try:
+                with _http_request("GET", url, stream=True, timeout=timeout, headers=part.request_headers()) as response:
+                    chunk_size = part.begin(response.status_code, response.headers)
+                    if chunk_size:
+                        for chunk in response.iter_content(chunk_size):
+                            part.write(chunk)
+                return part.finish()
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout, _IncompleteDownload) as e_drop:
+                keep_partial = True
+                if attempt >= _resume_attempts(): raise
+                attempt += 1
+                logger.debug("下载中断 (%s)，从 %d 字节处第 %d 次续传: %s", e_drop, part.offset, attempt, url)
+            except Exception:
+                keep_partial = False
+                raise
+    finally:
+        part.close(keep_partial)
+
+
+def _download_error_message(exc: BaseException) -> str:
+    if isinstance(exc, (DownloadError, RateLimitError, ValueError)): return str(exc)
+    if isinstance(exc, requests.exceptions.RequestException) or (httpx and isinstance(exc, httpx.HTTPError)):
+        return f"下载时网络请求错误: {exc}"
+    return f"下载时未知错误: {exc}"
+
+
+def _remove_quietly(path: str):
+    try:
+        if path and os.path.exists(path): os.remove(path)
+    except OSError:
+        pass
+
+
+def _download_success(save_path: str, final_file_name: str, info: dict = None) -> dict:
+    return {"success": True, "message": f"图片 '{final_file_name}' 已保存到: {os.path.dirname(save_path)}",
+            "file_path": save_path, "file_name": final_file_name, **(info or {})}
+
+
+@app.tool()
+@_metered()
+def download_image(url: str, file_name: str, save_folder: str = None, derivatives: bool = None,
+                   sha256: str = None) -> str:
+    # derivatives: 是否生成多尺寸衍生图，None 时取 output.derivatives.enabled；sha256: 可选的内容校验值
+    save_path = None
+    try:
+        save_path, _, final_file_name = _handle_save_path(file_name, save_folder)
+        info = _fetch_download(url, save_path, CONFIG["api"].get("timeout", 60), sha256)
+        return json.dumps(_with_derivatives(_download_success(save_path, final_file_name, info), derivatives))
+    except Exception as e:
+        _remove_quietly(save_path)
+        return json.dumps({"success": False, "error": _download_error_message(e)})
+
+
+def _file_name_from_url(url: str, stem: str) -> str:
+    _, ext = os.path.splitext(urlsplit(url).path)
+    if ext.lower() not in CONFIG["output"]["allowed_extensions"]: ext = CONFIG["output"]["default_extension"]
+    return f"{stem}{ext.lower()}"
+
+
+def _parse_download_items(items) -> list[tuple[str, str]]:
+    # 支持: [[url, file_name], ...]、[{"url": ..., "file_name": ...}, ...] 或 search_images 返回的 JSON
+    if isinstance(items, str):
+        try:
+            items = json.loads(items)
+        except json.JSONDecodeError as e_json:
+            raise ValueError(f"items 不是有效的 JSON: {e_json}")
+    if isinstance(items, dict):
+        if "results" not in items: raise ValueError("items 为对象时必须是 search_images 的返回结果 (包含 results)")
+        items = items["results"]
+    if not isinstance(items, list): raise ValueError("items 必须是列表")
+    parsed, used_names = [], set()
+    for index, item in enumerate(items):
+        if isinstance(item, (list, tuple)) and len(item) == 2:
+            url, file_name = item
+        elif isinstance(item, dict) and "file_name" in item:
+            url, file_name = item.get("url"), item["file_name"]
+        elif isinstance(item, dict):
+            # search_images 结果项: 优先下载原图，文件名取 "<source>_<id>"
+            url = item.get("download_url") or item.get("url")
+            file_name = _file_name_from_url(url or "", f"{item.get('source') or 'image'}_{item.get('id') or index}")
+        else:
+            raise ValueError(f"第 {index} 项格式不正确: {item!r}")
+        if not url or not file_name: raise ValueError(f"第 {index} 项缺少 url 或 file_name")
+        # 同一批次内的重名文件加序号，避免并发下载时互相覆盖
+        base_name, ext = os.path.splitext(str(file_name))
+        candidate, counter = str(file_name), 1
+        while candidate.lower() in used_names:
+            candidate, counter = f"{base_name}_{counter}{ext}", counter + 1
+        used_names.add(candidate.lower())
+        parsed.append((str(url), candidate))
+    return parsed
+
+
+def _finish_download_item(result: dict, save_path: str, error: BaseException | None, started: float) -> dict:
+    if error is None:
+        result.update({"success": True, "file_path": save_path})
+    else:
+        result.update({"success": False, "error": _download_error_message(error)})
+        _remove_quietly(save_path)
+    result["elapsed_ms"] = int((time.monotonic() - started) * 1000)
+    return result
+
+
+def _download_one(index: int, url: str, save_path: str, final_file_name: str, host_slots: dict,
+                  timeout: float) -> dict:
+    started, error, result = time.monotonic(), None, {"index": index, "url": url, "file_name": final_file_name}
+    try:
+        with host_slots[urlsplit(url).netloc.lower()]:
+            result.update(_fetch_download(url, save_path, timeout))
+    except Exception as e:
+        error = e
+    return _finish_download_item(result, save_path, error, started)
+
+
+def _plan_downloads(items, save_folder: str, max_workers: int, per_host_limit: int) -> tuple[list, list, int, int]:
+    parsed_items = _parse_download_items(items)
+    if not parsed_items: raise ValueError("items 为空")
+    download_conf = CONFIG.get("download", {})
+    workers = max(1, int(max_workers or download_conf.get("max_workers", 8)))
+    host_limit = max(1, int(per_host_limit or download_conf.get("per_host_limit", 4)))
+    jobs, failed = [], []
+    for index, (url, file_name) in enumerate(parsed_items):
+        try:
+            save_path, _, final_file_name = _handle_save_path(file_name, save_folder)
+            jobs.append((index, url, save_path, final_file_name))
+        except (ValueError, OSError) as e_path:
+            failed.append({"index": index, "url": url, "file_name": file_name, "success": False, "error": str(e_path)})
+    return jobs, failed, workers, host_limit
+
+
+def _download_summary(results: list[dict], started: float) -> str:
+    results.sort(key=lambda item: item["index"])
+    succeeded = sum(1 for item in results if item["success"])
+    return json.dumps({"success": succeeded > 0, "total": len(results), "succeeded": succeeded,
+                       "failed": len(results) - succeeded, "elapsed_ms": int((time.monotonic() - started) * 1000),
+                       "results": results})
+
+
+@app.tool()
+@_metered()
+def download_images(items: str, save_folder: str = None, max_workers: int = None, per_host_limit: int = None) -> str:
+    """批量并发下载图片。items 为 [[url, file_name], ...]、[{"url", "file_name"}, ...] 或 search_images 的返回 JSON。"""
+    started = time.monotonic()
+    try:
+        jobs, results, workers, host_limit = _plan_downloads(items, save_folder, max_workers, per_host_limit)
+    except ValueError as ve:
+        return json.dumps({"success": False, "error": str(ve)})
+    timeout = CONFIG["api"].get("timeout", 60)
+    host_slots = {netloc: threading.BoundedSemaphore(host_limit)
+                  for netloc in {urlsplit(job[1]).netloc.lower() for job in jobs}}
+    if jobs:
+        with ThreadPoolExecutor(max_workers=min(workers, len(jobs)), thread_name_prefix="download") as executor:
+            download_one = _with_context(_download_one)
+            futures = [executor.submit(download_one, *job, host_slots, timeout) for job in jobs]
+            results.extend(future.result() for future in futures)
+    return _download_summary(results, started)
+
+
+class GenerationError(Exception):
+    pass
+
+
+TOGETHER_RESPONSE_FORMATS = ("b64_json", "url")
+
+
+def _together_request(prompt: str, width: int = None, height: int = None, n: int = 1,
+                      response_format: str = "b64_json", seed: int = None) -> tuple[str, dict, dict]:
+    together_api_key = CONFIG["api"].get("together_api_key")
+    if not together_api_key: raise ValueError("Together AI API key 未配置。")
+    actual_width = width if width is not None else CONFIG["image"]["default_width"];
+    actual_height = height if height is not None else CONFIG["image"]["default_height"]
+    api_url = _api_endpoint("together", "/v1/images/generations")
+    headers = {"Authorization": f"Bearer {together_api_key}", "Content-Type": "application/json",
+               "Accept": "application/json"}
+    payload = {"model": "black-forest-labs/FLUX.1-dev", "prompt": prompt, "n": int(n),
+               "width": actual_width, "height": actual_height, "response_format": response_format}
+    if seed is not None: payload["seed"] = int(seed)
+    return api_url, headers, payload
+
+
+# --- 生成结果缓存 ---
+# 只有指定 seed 的请求结果是可复现的: 按 (模型, 提示词, 宽, 高, seed, n, 变体序号) 存入内容寻址存储
+# (.cache/generations，按总大小 LRU 淘汰)，相同请求再次出现时直接取出，不再调用付费接口。
+# 键中的提示词折叠了连续空白；发给上游的提示词保持原样。
+_GENERATION_STORE = _ContentStore("generations", "generations")
+
+
+def _generation_cache_keys(payload: dict) -> list[str] | None:
+    if payload.get("seed") is None or not _GENERATION_STORE.enabled(): return None
+    fields = [payload["model"], " ".join(payload["prompt"].split()), payload["width"], payload["height"], payload["seed"], payload["n"]]
+    return [hashlib.sha256(json.dumps(fields + [index], ensure_ascii=False).encode("utf-8")).hexdigest()
+            for index in range(int(payload["n"]))]
+
+
+def _cached_generation(payload: dict) -> list[dict] | None:
+    # 所有变体都在缓存中时返回 [{"cache_path": ..., "cache_key": ...}, ...]
+    keys = _generation_cache_keys(payload)
+    if not keys: return None
+    outputs = []
+    for key in keys:
+        entry_path = _GENERATION_STORE.lookup(key)
+        if not entry_path: return None
+        outputs.append({"cache_path": entry_path, "cache_key": key})
+    return outputs
+
+
+def _cache_generation_output(output: dict, save_path: str):
+    if not output.get("cache_key") or output.get("cache_path"): return
+    try:
+        _GENERATION_STORE.put_file(output["cache_key"], save_path)
+    except OSError as e_cache:
+        logger.warning("写入生成结果缓存失败: %s", e_cache)
+
+
+@app.tool()
+def get_generation_cache_stats() -> str:
+    """返回 generate_icon_togetherai 生成结果缓存 (仅缓存指定 seed 的请求) 的命中/未命中/淘汰统计与占用空间。"""
+    return json.dumps({"success": True, "stats": _GENERATION_STORE.stats()})
+
+
+def _together_flight_key(payload: dict) -> tuple:
+    return "together", json.dumps(payload, sort_keys=True, ensure_ascii=False)
+
+
+def _together_call(api_url: str, headers: dict, payload: dict) -> tuple[int, str]:
+    # 相同参数的并发生成请求只调用一次上游，所有调用方共享 (状态码, 响应文本) 后各自保存
+    def call() -> tuple[int, str]:
+        with _stage("upstream", "together") as stage:
+            response = _http_request("POST", api_url, provider="together", headers=headers, json=payload,
+                                     timeout=CONFIG["api"].get("timeout", 120))
+            stage["bytes_in"], stage["error"] = len(response.content), response.status_code != 200
+        return response.status_code, response.text
+
+    return _SINGLE_FLIGHT.do(_together_flight_key(payload), call)
+
+
+async def _together_call_async(api_url: str, headers: dict, payload: dict) -> tuple[int, str]:
+    async def call() -> tuple[int, str]:
+        with _stage("upstream", "together") as stage:
+            response = await _http_request_async("POST", api_url, provider="together", headers=headers,
+                                                 json=payload, timeout=CONFIG["api"].get("timeout", 120))
+            stage["bytes_in"], stage["error"] = len(response.content), response.status_code != 200
+        return response.status_code, response.text
+
+    return await _SINGLE_FLIGHT.do_async(_together_flight_key(payload), call)
+
+
+def _together_plan(prompt: str, prompts: list[str], n: int, response_format: str, file_name: str) -> list[str]:
+    # 校验参数并返回要生成的提示词列表；在调用付费接口前发现文件名/参数错误
+    prompt_list = [prompts] if isinstance(prompts, str) else list(prompts or [])
+    if not prompt_list: prompt_list = [prompt]
+    if not all(isinstance(item, str) and item.strip() for item in prompt_list): raise ValueError("提示词不能为空")
+    max_variants = int(CONFIG["image"].get("max_variants", 4))
+    if not 1 <= int(n) <= max_variants: raise ValueError(f"n 必须在 1 到 {max_variants} 之间")
+    if response_format not in TOGETHER_RESPONSE_FORMATS:
+        raise ValueError(f"不支持的 response_format: {response_format}. 可选: {', '.join(TOGETHER_RESPONSE_FORMATS)}")
+    _normalize_save_name(file_name)
+    return prompt_list
+
+
+def _together_outputs(status_code: int, response_text: str, response_format: str,
+                      cache_keys: list[str] = None) -> list[dict]:
+    # 返回每张图片的 {"b64_json": ...} 或 {"url": ...}，指定 seed 时附带对应的缓存键
+    if status_code != 200:
+        raise GenerationError(f"Together AI API请求失败，状态码: {status_code}, 响应: {response_text}")
+    try:
+        items = json.loads(response_text).get("data") or []
+        outputs = [item.get(response_format) for item in items]
+    except (ValueError, AttributeError) as inner_e:
+        raise GenerationError(f"处理API成功响应时出错: {inner_e}. 响应(部分): {response_text[:500]}")
+    if not outputs or not all(outputs):
+        raise GenerationError(f"处理API成功响应时出错: API响应成功(200)，但在 'data[].{response_format}' 未找到图像数据。"
+                              f" 响应(部分): {response_text[:500]}")
+    return [{response_format: output, **({"cache_key": cache_keys[index]} if cache_keys else {})}
+            for index, output in enumerate(outputs)]
+
+
+def _together_output_name(file_name: str, prompt_index: int, variant_index: int, prompt_count: int, n: int) -> str:
+    # 单张输出保持原文件名；多提示词加 _p<序号>，多变体加 _v<序号>
+    file_name_with_ext, base_name, ext = _normalize_save_name(file_name)
+    if prompt_count == 1 and n == 1: return file_name_with_ext
+    suffix = (f"_p{prompt_index + 1}" if prompt_count > 1 else "") + (f"_v{variant_index + 1}" if n > 1 else "")
+    return f"{base_name}{suffix}{ext}"
+
+
+def _generation_success(save_path: str, final_file_name: str, output: dict) -> dict:
+    result = {"success": True, "message": f"图标 '{final_file_name}' 已生成并保存到: {os.path.dirname(save_path)}",
+              "file_path": save_path, "file_name": final_file_name}
+    if output.get("cache_key"): result["cache_hit"] = bool(output.get("cache_path"))
+    return result
+
+
+def _save_together_output(output: dict, file_name: str, save_folder: str, derivatives: bool | None) -> dict:
+    save_path, final_file_name = None, file_name
+    try:
+        save_path, _, final_file_name = _handle_save_path(file_name, save_folder)
+        if output.get("cache_path"):
+            _GENERATION_STORE.materialize(output["cache_path"], save_path)
+        elif output.get("url"):
+            with _stage("download", "together") as stage:
+                stage["bytes_in"] = _stream_download(output["url"], save_path, CONFIG["api"].get("timeout", 60))["bytes"]
         else:
-            return json.dumps({"success": False,
-                               "error": f"Together AI API请求失败，状态码: {response.status_code}, 响应: {response_text_for_debug}"})
+            with _stage("save", "together") as stage:
+                stage["bytes_in"] = len(output["b64_json"])
+                _write_base64_to_file(output["b64_json"], save_path)
+                stage["bytes_out"] = os.path.getsize(save_path)
+        _cache_generation_output(output, save_path)
+        result = _generation_success(save_path, final_file_name, output)
+    except Exception as e:
+        _release_save_path(save_path)
+        return {"success": False, "file_name": final_file_name, "error": f"保存生成的图片时出错: {e}"}
+    return _with_derivatives(result, derivatives)
+
+
+def _together_error_message(exc: BaseException) -> str:
+    if isinstance(exc, (RateLimitError, ValueError, GenerationError)): return str(exc)
+    if isinstance(exc, requests.exceptions.RequestException) or (httpx and isinstance(exc, httpx.HTTPError)):
+        return f"生成图标时网络请求错误: {exc}"
+    return f"生成图标时未知错误: {exc}"
+
+
+def _together_jobs(prompt_list: list[str], n: int, file_name: str, outcomes: list) -> tuple[list, list]:
+    # outcomes[i] 为第 i 个提示词的输出列表或异常；返回 (待保存任务, 失败项)
+    jobs, failed = [], []
+    for prompt_index, outcome in enumerate(outcomes):
+        if isinstance(outcome, BaseException):
+            failed.append({"prompt_index": prompt_index, "prompt": prompt_list[prompt_index], "success": False,
+                           "error": _together_error_message(outcome)})
+            continue
+        for variant_index, output in enumerate(outcome):
+            name = _together_output_name(file_name, prompt_index, variant_index, len(prompt_list), n)
+            jobs.append(({"prompt_index": prompt_index, "variant_index": variant_index,
+                          "prompt": prompt_list[prompt_index]}, output, name))
+    return jobs, failed
+
+
+def _together_summary(prompt_list: list[str], n: int, results: list[dict]) -> str:
+    # 单提示词单张时保持原有返回结构，否则返回汇总与每张图片的结果
+    if len(prompt_list) == 1 and n == 1:
+        result = dict(results[0])
+        for key in ("prompt_index", "variant_index", "prompt"): result.pop(key, None)
+        return json.dumps(result)
+    results.sort(key=lambda item: (item["prompt_index"], item.get("variant_index", -1)))
+    succeeded = [item for item in results if item["success"]]
+    return json.dumps({"success": bool(succeeded), "total": len(results), "succeeded": len(succeeded),
+                       "failed": len(results) - len(succeeded), "file_paths": [item["file_path"] for item in succeeded],
+                       "results": results})
+
+
+def _generation_workers() -> int:
+    return max(1, int(CONFIG["image"].get("generation_workers", 4)))
+
+
+@app.tool()
+@_metered(provider="together")
+def generate_icon_togetherai(prompt: str, file_name: str, save_folder: str = None, width: int = None,
+                             height: int = None, derivatives: bool = None, n: int = 1, prompts: list[str] = None,
+                             response_format: str = "b64_json", seed: int = None) -> str:
+    # n: 每个提示词生成的变体数 (使用接口的 n 参数)；prompts: 多个提示词并发生成；
+    # response_format: "b64_json" 或 "url" (大批量时由服务端返回图片 URL，避免响应体中的 base64 膨胀)；
+    # seed: 固定随机种子，结果可复现并会被缓存，相同请求再次调用时直接返回缓存的图片
+    try:
+        prompt_list = _together_plan(prompt, prompts, n, response_format, file_name)
+        requests_list = [_together_request(item, width, height, n, response_format, seed) for item in prompt_list]
     except ValueError as ve:
         return json.dumps({"success": False, "error": str(ve)})
-    except requests.exceptions.RequestException as e_req:
-        return json.dumps({"success": False, "error": f"生成图标时网络请求错误: {e_req}"})
-    except OverflowError as oe:
-        return json.dumps({"success": False, "error": str(oe)})
-    except Exception as e:
-        return json.dumps({"success": False, "error": f"生成图标时未知错误: {e}"})
+
+    def generate(request: tuple):
+        try:
+            cached = _cached_generation(request[2])
+            if cached: return cached
+            return _together_outputs(*_together_call(*request), response_format, _generation_cache_keys(request[2]))
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=min(_generation_workers(), len(requests_list) * int(n)),
+                            thread_name_prefix="together") as executor:
+        outcomes = list(executor.map(_with_context(generate), requests_list))
+        jobs, results = _together_jobs(prompt_list, int(n), file_name, outcomes)
+        # 各张图片的 base64 解码/下载与写盘并行进行
+        save = _with_context(lambda job: {**job[0], **_save_together_output(job[1], job[2], save_folder, derivatives)})
+        saved = executor.map(save, jobs)
+        results.extend(saved)
+    return _together_summary(prompt_list, int(n), results)
+
+
+# --- 火山引擎客户端管理 ---
+# 按 (ak, region) 懒加载并复用 CV20240606Api 及其底层 ApiClient/连接池；每个客户端持有自己的 Configuration，
+# 不再调用会修改进程全局状态的 Configuration.set_default。SK 或连接池大小变化时重建。
+class _VolcengineClientManager:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+
+    def get(self, ak: str, sk: str, region: str):
+        pool_size = int(CONFIG["api"].get("volcengine", {}).get("max_workers", 32))
+        fingerprint = (hashlib.sha256(sk.encode("utf-8")).hexdigest(), pool_size)
+        with self._lock:
+            entry = self._clients.get((ak, region))
+            if entry is not None and entry[0] == fingerprint: return entry[1]
+            sdk = _volcengine_sdk()
+            configuration = sdk.core.Configuration()
+            configuration.ak = ak
+            configuration.sk = sk
+            configuration.region = region
+            configuration.client_side_validation = True
+            configuration.connection_pool_maxsize = pool_size
+            api_instance = sdk.cv.CV20240606Api(sdk.core.ApiClient(configuration))
+            self._clients[(ak, region)] = (fingerprint, api_instance)
+            logger.debug("Volcengine API client created for AK='%s...', Region='%s'", ak[:5], region)
+            return api_instance
+
+    def invalidate(self):
+        with self._lock:
+            self._clients.clear()
+
+
+_VOLCENGINE_CLIENTS = _VolcengineClientManager()
+_CONFIG.subscribe("api.volcengine", _VOLCENGINE_CLIENTS.invalidate)
+
+
+def _stylize_cache_key(image_digest: str, style_params: dict, output_format: str, add_logo: bool,
+                       logo_position: int, logo_language: int, logo_opacity: float, logo_text_content: str,
+                       restore_size: tuple[int, int] = None) -> str:
+    digest = hashlib.sha256(image_digest.encode("ascii"))
+    logo = [int(logo_position), int(logo_language), round(float(logo_opacity), 4), logo_text_content] if add_logo else None
+    digest.update(json.dumps([style_params.get("req_key"), style_params.get("sub_req_key"), output_format.lower(), logo,
+                              list(restore_size) if restore_size else None], ensure_ascii=False).encode("utf-8"))
+    return digest.hexdigest()
+
+
+@app.tool()
+def get_stylize_cache_stats() -> str:
+    """返回 volcengine_style_transfer 结果缓存 (内容寻址存储) 的命中/未命中/淘汰统计与占用空间。"""
+    return json.dumps({"success": True, "stats": _STYLIZE_STORE.stats()})
+
+
+def _volcengine_credentials() -> tuple[str, str, str]:
+    volc_conf = CONFIG.get('api', {}).get('volcengine', {})
+    if not volc_conf: raise ValueError("Volcengine API configuration not found in CONFIG.")
+
+    ak_check = volc_conf.get("access_key_id")
+    sk_check = volc_conf.get("secret_access_key")
+    region = volc_conf.get("region", "cn-beijing")
+
+    if not (isinstance(ak_check, str) and ak_check and ak_check not in ["", "YOUR_AK_HERE"]):
+        raise ValueError("火山引擎 Access Key ID 未在 config.json 中正确配置。")
+    if not (isinstance(sk_check, str) and sk_check and sk_check not in ["", "YOUR_SK_HERE"]):
+        raise ValueError("火山引擎 Secret Access Key 未在 config.json 中正确配置。")
+    return ak_check, sk_check, region
+
+
+def _resolve_volcengine_style(style_name: str) -> dict:
+    selected_style_params = get_volcengine_style_params(style_name)
+    if not selected_style_params:
+        valid_styles = ", ".join(VOLCENGINE_STYLES.keys())
+        raise ValueError(f"无效的风格名称或配置错误: '{style_name}'. 可选风格: {valid_styles}")
+    if not selected_style_params.get("req_key"):
+        raise ValueError(f"内部错误：风格 '{style_name}' 缺少有效的 req_key 配置。")
+    return selected_style_params
+
+
+def _volcengine_response_request_id(api_response) -> str:
+    request_id_str = "N/A"
+    # 尝试从不同位置获取 request_id
+    if hasattr(api_response, 'result') and api_response.result and \
+            hasattr(api_response.result, 'algorithm_base_resp') and api_response.result.algorithm_base_resp and \
+            hasattr(api_response.result.algorithm_base_resp,
+                    'request_id') and api_response.result.algorithm_base_resp.request_id:
+        request_id_str = api_response.result.algorithm_base_resp.request_id
+    elif hasattr(api_response, 'request_id') and api_response.request_id:
+        request_id_str = api_response.request_id
+    # 您的日志显示成功时顶层有 code=10000, 和 data.request_id
+    elif hasattr(api_response, 'data') and api_response.data and hasattr(api_response.data,
+                                                                         'request_id') and api_response.data.request_id:
+        request_id_str = api_response.data.request_id
+    return request_id_str
+
+
+def _volcengine_response_error(api_response) -> str:
+    # 如果不符合成功结构，则尝试提取错误信息
+    error_detail = "火山引擎API未返回预期的成功状态或图像数据。"
+    # 尝试从 result.algorithm_base_resp 获取错误 (常见于业务失败但HTTP成功)
+    if hasattr(api_response, 'result') and api_response.result and \
+            hasattr(api_response.result, 'algorithm_base_resp') and api_response.result.algorithm_base_resp:
+        algo_resp = api_response.result.algorithm_base_resp
+        algo_status_code = getattr(algo_resp, 'status_code', -1)
+        algo_status_message = getattr(algo_resp, 'status_message', "N/A")
+        if algo_status_code != 0:  # 假设0是内部算法成功码
+            error_detail = f"算法处理错误: StatusCode={algo_status_code}, StatusMessage='{algo_status_message}'"
+    # 尝试从顶层 code 和 message 获取错误 (如果存在且 code 不是成功码)
+    elif hasattr(api_response, 'code') and hasattr(api_response, 'message'):
+        top_code = getattr(api_response, 'code', -1)
+        top_message = getattr(api_response, 'message', 'N/A')
+        if top_code != 10000:  # 假设10000是通用成功码
+            error_detail = f"火山引擎API业务错误: Code={top_code}, Message='{top_message}'"
+    return error_detail
+
+
+def _volcengine_output_b64(api_response) -> str | None:
+    # 检查成功条件 (基于您的成功日志结构)
+    if hasattr(api_response, 'code') and getattr(api_response, 'code', -1) == 10000 and \
+            hasattr(api_response, 'data') and api_response.data and \
+            hasattr(api_response.data, 'binary_data_base64') and api_response.data.binary_data_base64 and \
+            isinstance(api_response.data.binary_data_base64, list) and len(
+        api_response.data.binary_data_base64) > 0 and \
+            isinstance(api_response.data.binary_data_base64[0], str) and api_response.data.binary_data_base64[0]:
+        return api_response.data.binary_data_base64[0]
+    return None
+
+
+def _volcengine_api_exception_message(e) -> str:
+    error_message_detail = str(e.body) if e.body else str(e)
+    try:
+        error_body_json = json.loads(e.body); error_message_detail = error_body_json.get("Error", {}).get("Message",
+                                                                                                          error_message_detail)
+    except:
+        pass
+    logger.error("Volcengine API Exception: Status=%s, Code=%s, Message='%s'", e.status, getattr(e, 'code', None),
+                 error_message_detail)
+    return f"火山引擎API异常: Status={e.status}, Code={getattr(e, 'code', None)}, Msg='{error_message_detail}'"
+
+
+_VOLCENGINE_THROTTLE_CODES = {50429, 50430}
+
+
+def _is_volcengine_throttled(e) -> bool:
+    if getattr(e, "status", None) == 429: return True
+    body = e.body.decode("utf-8", "replace") if isinstance(e.body, bytes) else str(e.body or "")
+    return any(str(code) in body for code in _VOLCENGINE_THROTTLE_CODES)
+
+
+def _call_volcengine_with_retry(api_instance, aigc_stylize_image_request, rate_limiter=None):
+    # 火山引擎限流 (HTTP 429 或业务码 50429/50430) 时按退避策略重试，其余错误直接返回/抛出
+    max_retries, deadline = int(CONFIG["api"].get("max_retries", 3)), _call_deadline()
+    attempt = 0
+    while True:
+        if rate_limiter is not None and not rate_limiter.acquire(deadline): raise _rate_limit_error("volcengine")
+        try:
+            api_response = api_instance.a_igc_stylize_image(aigc_stylize_image_request)
+            if getattr(api_response, 'code', None) not in _VOLCENGINE_THROTTLE_CODES or attempt >= max_retries:
+                return api_response
+            delay = _backoff_delay(attempt)
+            if time.monotonic() + delay > deadline: return api_response
+        except _volcengine_api_exception() as e:
+            if not _is_volcengine_throttled(e) or attempt >= max_retries: raise
+            delay = _backoff_delay(attempt, _parse_retry_after((e.headers or {}).get("Retry-After")))
+            if time.monotonic() + delay > deadline: raise
+        logger.debug("Volcengine API 被限流，第 %d 次重试，等待 %.2fs", attempt + 1, delay)
+        attempt += 1
+        time.sleep(delay)
+
+
+def _build_stylize_request(style_params: dict, binary_data_base64_str: str, add_logo: bool, logo_position: int,
+                           logo_language: int, logo_opacity: float, logo_text_content: str):
+    aigc_stylize_image_request = _volcengine_sdk().cv.AIGCStylizeImageRequest(
+        req_key=style_params.get("req_key"), binary_data_base64=[binary_data_base64_str]
+    )
+    sub_req_key_value = style_params.get("sub_req_key")
+    if sub_req_key_value:
+        aigc_stylize_image_request.sub_req_key = sub_req_key_value
+
+    if add_logo:
+        try:
+            from volcenginesdkcv20240606.models.logo_info_for_aigc_stylize_image_input import \
+                LogoInfoForAIGCStylizeImageInput as LogoInfoParam
+        except ImportError:
+            try:
+                from volcenginesdkcv20240606.models.logo_info_param import LogoInfoParam
+            except ImportError:
+                raise ValueError("无法导入火山引擎LogoInfo模型。")
+
+        logo_info_obj = LogoInfoParam()
+        logo_info_obj.add_logo = add_logo
+        logo_info_obj.position = int(logo_position)
+        logo_info_obj.language = int(logo_language)
+        logo_info_obj.opacity = float(logo_opacity)
+        if logo_text_content: logo_info_obj.logo_text_content = logo_text_content
+        aigc_stylize_image_request.logo_info = logo_info_obj
+    return aigc_stylize_image_request
+
+
+def _stylize_one(credentials: tuple[str, str, str], prepared: _PreparedImage, style_name: str,
+                 style_params: dict, save_path: str, final_file_name: str, add_logo: bool = False,
+                 logo_position: int = 0, logo_language: int = 0, logo_opacity: float = 0.3,
+                 logo_text_content: str = None, rate_limiter=None) -> dict:
+    output_format_to_save = prepared.output_format if prepared.output_format else "png"
+    try:
+        save_path, final_file_name = _retarget_save_path(save_path, final_file_name, output_format_to_save)
+    except OSError as e_path:
+        _release_save_path(save_path)
+        return {"success": False, "error": f"处理保存路径时出错: {e_path}"}
+    # 批量模式下各单元在线程池中执行，这里显式设置阶段指标的 provider/style 标签
+    token = _METRIC_CONTEXT.set(("volcengine", style_name))
+    try:
+        result = _stylize_cell(credentials, prepared, style_name, style_params, save_path, final_file_name,
+                               output_format_to_save, add_logo, logo_position, logo_language, logo_opacity,
+                               logo_text_content, rate_limiter)
+    finally:
+        _METRIC_CONTEXT.reset(token)
+    if not result.get("success"): _release_save_path(save_path)
+    return result
+
+
+def _stylize_cell(credentials: tuple[str, str, str], prepared: _PreparedImage, style_name: str,
+                  style_params: dict, save_path: str, final_file_name: str, output_format_to_save: str,
+                  add_logo: bool, logo_position: int, logo_language: int, logo_opacity: float,
+                  logo_text_content: str, rate_limiter) -> dict:
+    # 单个 (图片, 风格) 单元的完整流程: 缓存查找 -> 构造请求 -> 调用 API -> 保存结果；错误以字典返回，不抛出
+    restore_size = prepared.original_size if CONFIG["image"].get("restore_output_size", False) else None
+    try:
+        # 相同输入图片 + 相同风格/水印参数的结果直接从内容寻址缓存取出，不再调用 API
+        cache_key = None
+        if _STYLIZE_STORE.enabled():
+            cache_key = _stylize_cache_key(prepared.digest, style_params, output_format_to_save, add_logo,
+                                           logo_position, logo_language, logo_opacity, logo_text_content,
+                                           restore_size)
+            cached_path = _STYLIZE_STORE.lookup(cache_key)
+            if cached_path:
+                saved_path_final = _STYLIZE_STORE.materialize(cached_path, save_path)
+                return {
+                    "success": True,
+                    "message": f"图片风格化成功 ('{style_name}', 缓存命中). '{final_file_name}' 已保存到: {os.path.dirname(save_path)}",
+                    "file_path": saved_path_final, "file_name": final_file_name,
+                    "style_applied": style_name, "request_id": "N/A", "cache_hit": True
+                }
+
+        api_instance = _VOLCENGINE_CLIENTS.get(*credentials)
+        aigc_stylize_image_request = _build_stylize_request(style_params, prepared.b64, add_logo, logo_position,
+                                                            logo_language, logo_opacity, logo_text_content)
+
+        logger.debug("Calling Volcengine API: a_igc_stylize_image (req_key=%s)...", style_params.get('req_key'))
+        with _stage("upstream", "volcengine", style_name) as stage:
+            stage["bytes_out"] = len(prepared.b64)
+            api_response = _call_volcengine_with_retry(api_instance, aigc_stylize_image_request, rate_limiter)
+            output_image_b64 = _volcengine_output_b64(api_response)
+            stage["error"] = output_image_b64 is None
+            stage["bytes_in"] = len(output_image_b64) if output_image_b64 else None
+        logger.debug("API call completed.")
+        # logger.debug("Full API Response content: %s", api_response)  # 非常重要！！！调试时务必取消注释查看此输出
+
+        request_id_str = _volcengine_response_request_id(api_response)
+        if output_image_b64 is None:
+            error_detail = _volcengine_response_error(api_response)
+            logger.error("%s", error_detail)
+            logger.debug("API Response for error diagnosis: %s", api_response)
+            return {"success": False, "error": error_detail, "request_id": request_id_str}
+
+        saved_path_final = save_image_from_base64(
+            output_image_b64, final_file_name, os.path.dirname(save_path),
+            image_format=output_format_to_save
+        )
+        if not saved_path_final:
+            return {"success": False, "error": "风格化成功但保存输出图片失败。", "request_id": request_id_str}
+        if saved_path_final != save_path:
+            # 不应发生 (保存时沿用预留的文件名)；万一写到了别处，释放占位文件并如实返回实际文件名
+            logger.warning("风格化结果写入了 %s 而不是预留的 %s", saved_path_final, save_path)
+            _release_save_path(save_path)
+            final_file_name = os.path.basename(saved_path_final)
+        if restore_size: _restore_output_size(saved_path_final, restore_size)
+        if cache_key:
+            try:
+                _STYLIZE_STORE.put_file(cache_key, saved_path_final)
+            except OSError as e_cache:
+                logger.warning("写入风格化结果缓存失败: %s", e_cache)
+        result = {
+            "success": True,
+            "message": f"图片风格化成功 ('{style_name}'). '{final_file_name}' 已保存到: {os.path.dirname(save_path)}",
+            "file_path": saved_path_final, "file_name": final_file_name,
+            "style_applied": style_name, "request_id": request_id_str, "cache_hit": False
+        }
+        if prepared.original_size:
+            result["input_resized"] = {"from": list(prepared.original_size), "to": [prepared.width, prepared.height],
+                                       "uploaded_bytes": prepared.size, "output_restored": bool(restore_size)}
+        return result
+    except _volcengine_api_exception() as e:
+        return {"success": False, "error": _volcengine_api_exception_message(e)}
+    except (RateLimitError, ValueError, BackendUnavailableError) as ve:
+        return {"success": False, "error": str(ve)}
+    except Exception as e_gen:
+        logger.exception("火山引擎风格化时发生未知错误: %s", e_gen)
+        return {"success": False, "error": f"火山引擎风格化时发生未知错误: {str(e_gen)}"}
 
 
 @app.tool()
+@_metered(provider="volcengine", style_arg="style_name")
 def volcengine_style_transfer(
         input_image_path: str,
         style_name: str,
@@ -407,162 +3268,704 @@ def volcengine_style_transfer(
         logo_opacity: float = 0.3,
         logo_text_content: str = None
 ) -> str:
-    print("--- Inside volcengine_style_transfer ---")
     try:
-        volc_conf = CONFIG.get('api', {}).get('volcengine', {})
-        if not volc_conf: return json.dumps(
-            {"success": False, "error": "Volcengine API configuration not found in CONFIG."})
+        credentials = _volcengine_credentials()
+        _volcengine_sdk()
+    except (ValueError, BackendUnavailableError) as ve:
+        return json.dumps({"success": False, "error": str(ve)})
+    logger.debug("Using AK='%s...', Region='%s'", credentials[0][:5], credentials[2])
+
+    try:
+        with _stage("validate", "volcengine", style_name) as stage:
+            stage["bytes_in"] = os.path.getsize(input_image_path) if os.path.exists(input_image_path) else None
+            prepared = _prepare_image_for_volcengine(input_image_path)
+            stage["bytes_out"] = prepared.size
+    except (OSError, ValueError) as e_validate:
+        return json.dumps({"success": False, "error": f"输入图片验证失败: {e_validate}"})
+
+    with prepared:
+        try:
+            selected_style_params = _resolve_volcengine_style(style_name)
+        except ValueError as ve:
+            return json.dumps({"success": False, "error": str(ve)})
+        logger.debug("Using req_key: %s for style '%s'", selected_style_params.get('req_key'), style_name)
 
-        ak_check = volc_conf.get("access_key_id")
-        sk_check = volc_conf.get("secret_access_key")
-        region = volc_conf.get("region", "cn-beijing")
+        try:
+            save_path, _, final_file_name = _handle_save_path(file_name, save_folder)
+        except Exception as e_path:
+            return json.dumps({"success": False, "error": f"处理保存路径时出错: {e_path}"})
 
-        if not (isinstance(ak_check, str) and ak_check and ak_check not in ["", "YOUR_AK_HERE"]):
-            return json.dumps({"success": False, "error": "火山引擎 Access Key ID 未在 config.json 中正确配置。"})
-        if not (isinstance(sk_check, str) and sk_check and sk_check not in ["", "YOUR_SK_HERE"]):
-            return json.dumps({"success": False, "error": "火山引擎 Secret Access Key 未在 config.json 中正确配置。"})
-        print(f"DEBUG: Using AK='{ak_check[:5]}...', Region='{region}'")
+        return json.dumps(_stylize_one(
+            credentials, prepared, style_name, selected_style_params, save_path, final_file_name, add_logo,
+            logo_position, logo_language, logo_opacity, logo_text_content, rate_limiter=_rate_limiter("volcengine")))
 
-        is_valid, validation_msg, image_original_format = _validate_image_for_volcengine(input_image_path)
-        if not is_valid: return json.dumps({"success": False, "error": f"输入图片验证失败: {validation_msg}"})
 
-        selected_style_params = get_volcengine_style_params(style_name)
-        if not selected_style_params:
-            valid_styles = ", ".join(VOLCENGINE_STYLES.keys())
-            return json.dumps(
-                {"success": False, "error": f"无效的风格名称或配置错误: '{style_name}'. 可选风格: {valid_styles}"})
+def _safe_file_stem(text: str) -> str:
+    return "".join("_" if ch in '\\/:*?"<>| ' else ch for ch in text).strip("._") or "image"
 
-        req_key_value = selected_style_params.get("req_key")
-        if not req_key_value: return json.dumps(
-            {"success": False, "error": f"内部错误：风格 '{style_name}' 缺少有效的 req_key 配置。"})
-        print(f"DEBUG: Using req_key: {req_key_value} for style '{style_name}'")
 
+@app.tool()
+@_metered(provider="volcengine")
+def volcengine_style_transfer_batch(
+        input_image_paths: list[str],
+        style_names: list[str],
+        save_folder: str = None,
+        file_name_template: str = "{image}_{style}",
+        max_concurrency: int = None,
+        qps: float = None,
+        progress_file: str = None,
+        add_logo: bool = False,
+        logo_position: int = 0,
+        logo_language: int = 0,
+        logo_opacity: float = 0.3,
+        logo_text_content: str = None
+) -> str:
+    """批量风格化: 多张图片 × 多种风格，每张图片只验证并 base64 编码一次，各单元并发执行且失败互不影响。
+    file_name_template 可使用 {image} (输入文件名) 与 {style} (风格名)；progress_file 指定时每完成一个单元即追加一行 JSON。"""
+    if isinstance(input_image_paths, str): input_image_paths = [input_image_paths]
+    if isinstance(style_names, str): style_names = [style_names]
+    if not input_image_paths or not style_names:
+        return json.dumps({"success": False, "error": "input_image_paths 与 style_names 均不能为空"})
+    if qps is not None:
         try:
-            save_path, _, final_file_name = _handle_save_path(file_name, save_folder)
+            qps = float(qps)
+        except (TypeError, ValueError):
+            return json.dumps({"success": False, "error": "qps 必须是数字"})
+        if not 0 < qps < float("inf"): return json.dumps({"success": False, "error": "qps 必须是大于 0 的有限数"})
+    try:
+        credentials = _volcengine_credentials()
+        _volcengine_sdk()
+    except (ValueError, BackendUnavailableError) as ve:
+        return json.dumps({"success": False, "error": str(ve)})
+    started = time.monotonic()
+
+    # 每张图片只验证、读取、编码一次 (映射在所有单元完成后才关闭)；每种风格只解析一次
+    images, image_errors = [], {}
+    open_images = contextlib.ExitStack()
+    for image_index, image_path in enumerate(input_image_paths):
+        try:
+            with _stage("validate", "volcengine") as stage:
+                prepared = open_images.enter_context(_prepare_image_for_volcengine(image_path))
+                stage["bytes_in"], stage["bytes_out"] = os.path.getsize(image_path), prepared.size
+            images.append(prepared)
+        except (OSError, ValueError) as e_validate:
+            image_errors[image_index] = f"输入图片验证失败: {e_validate}"
+            images.append(None)
+    styles, style_errors = [], {}
+    for style_index, style_name in enumerate(style_names):
+        try:
+            styles.append(_resolve_volcengine_style(style_name))
+        except ValueError as ve:
+            style_errors[style_index] = str(ve)
+            styles.append(None)
+
+    batch_conf = CONFIG["api"].get("volcengine", {})
+    concurrency = max(1, int(max_concurrency or batch_conf.get("batch_concurrency", 4)))
+    limiter = _LimiterChain(_TokenBucket(qps, max(1, int(qps))) if qps else None, _rate_limiter("volcengine"))
+    progress_lock = threading.Lock()
+    if progress_file and not os.path.isabs(progress_file):
+        progress_file = os.path.join(CONFIG["output"]["base_folder"], progress_file)
+    if progress_file: os.makedirs(os.path.dirname(os.path.abspath(progress_file)), exist_ok=True)
+
+    def report(cell: dict) -> dict:
+        if progress_file:
+            with progress_lock, open(progress_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(cell, ensure_ascii=False) + "\n")
+        return cell
+
+    def run_cell(image_index: int, style_index: int) -> dict:
+        cell = {"image_index": image_index, "style_index": style_index,
+                "input_image_path": input_image_paths[image_index], "style_name": style_names[style_index]}
+        if image_index in image_errors: return report({**cell, "success": False, "error": image_errors[image_index]})
+        if style_index in style_errors: return report({**cell, "success": False, "error": style_errors[style_index]})
+        image_stem = os.path.splitext(os.path.basename(input_image_paths[image_index]))[0]
+        try:
+            cell_file_name = file_name_template.format(image=image_stem, style=style_names[style_index])
+            save_path, _, final_file_name = _handle_save_path(_safe_file_stem(cell_file_name), save_folder)
         except Exception as e_path:
-            return json.dumps({"success": False, "error": f"处理保存路径时出错: {e_path}"})
+            return report({**cell, "success": False, "error": f"处理保存路径时出错: {e_path}"})
+        result = _stylize_one(credentials, images[image_index], style_names[style_index], styles[style_index],
+                              save_path, final_file_name, add_logo, logo_position, logo_language, logo_opacity,
+                              logo_text_content, rate_limiter=limiter)
+        return report({**cell, **result})
 
-        configuration = volcenginesdkcore.Configuration()
-        configuration.ak = ak_check;
-        configuration.sk = sk_check;
-        configuration.region = region
-        configuration.client_side_validation = True
-        volcenginesdkcore.Configuration.set_default(configuration)
-        api_instance = volcenginesdkcv20240606.CV20240606Api()
-        print(f"DEBUG: API instance created: {type(api_instance)}")
+    cells = [(i, j) for i in range(len(input_image_paths)) for j in range(len(style_names))]
+    with open_images, ThreadPoolExecutor(max_workers=min(concurrency, len(cells)),
+                                         thread_name_prefix="stylize") as executor:
+        results = list(executor.map(_with_context(lambda cell: run_cell(*cell)), cells))
+    succeeded = sum(1 for cell in results if cell.get("success"))
+    return json.dumps({"success": succeeded > 0, "total": len(results), "succeeded": succeeded,
+                       "failed": len(results) - succeeded, "elapsed_ms": int((time.monotonic() - started) * 1000),
+                       "progress_file": progress_file, "results": results})
 
-        with open(input_image_path, "rb") as image_file:
-            binary_data_base64_str = base64.b64encode(image_file.read()).decode('utf-8')
 
-        aigc_stylize_image_request = volcenginesdkcv20240606.AIGCStylizeImageRequest(
-            req_key=req_key_value, binary_data_base64=[binary_data_base64_str]
-        )
-        sub_req_key_value = selected_style_params.get("sub_req_key")
-        if sub_req_key_value:
-            aigc_stylize_image_request.sub_req_key = sub_req_key_value
+# --- 异步工具 (async variants) ---
+# 供 SSE 等并发会话使用，避免慢调用阻塞事件循环：REST 源使用 httpx 异步客户端 (每个事件循环一个，复用连接)，
+# 火山引擎 SDK 的阻塞调用放入独立的定长线程池；未安装 httpx 时在通用线程池中执行对应的同步实现。
+_ASYNC_CLIENTS = weakref.WeakKeyDictionary()
+_BLOCKING_EXECUTOR = None
+_VOLCENGINE_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def _get_blocking_executor() -> ThreadPoolExecutor:
+    global _BLOCKING_EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _BLOCKING_EXECUTOR is None:
+            _BLOCKING_EXECUTOR = ThreadPoolExecutor(max_workers=int(CONFIG["server"].get("blocking_workers", 32)),
+                                                    thread_name_prefix="blocking")
+        return _BLOCKING_EXECUTOR
+
+
+def _get_volcengine_executor() -> ThreadPoolExecutor:
+    global _VOLCENGINE_EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _VOLCENGINE_EXECUTOR is None:
+            workers = int(CONFIG["api"].get("volcengine", {}).get("max_workers", 32))
+            _VOLCENGINE_EXECUTOR = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="volcengine")
+        return _VOLCENGINE_EXECUTOR
+
+
+def _reset_blocking_executor():
+    # 配置变更后按新的线程数重建；旧线程池在已提交的任务完成后退出
+    global _BLOCKING_EXECUTOR
+    with _EXECUTOR_LOCK:
+        executor, _BLOCKING_EXECUTOR = _BLOCKING_EXECUTOR, None
+    if executor is not None: executor.shutdown(wait=False)
+
+
+def _reset_volcengine_executor():
+    global _VOLCENGINE_EXECUTOR
+    with _EXECUTOR_LOCK:
+        executor, _VOLCENGINE_EXECUTOR = _VOLCENGINE_EXECUTOR, None
+    if executor is not None: executor.shutdown(wait=False)
 
-        if add_logo:
+
+_CONFIG.subscribe("server.blocking_workers", _reset_blocking_executor)
+_CONFIG.subscribe("api.volcengine.max_workers", _reset_volcengine_executor)
+# 进行中的请求继续持有旧客户端，新请求按新的连接池设置创建客户端
+_CONFIG.subscribe("api.http_pool", _ASYNC_CLIENTS.clear)
+
+
+async def _run_blocking(func, *args, executor: ThreadPoolExecutor = None, **kwargs):
+    loop = asyncio.get_running_loop()
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    return await loop.run_in_executor(executor or _get_blocking_executor(), call)
+
+
+def _get_async_client() -> "httpx.AsyncClient":
+    loop = asyncio.get_running_loop()
+    client = _ASYNC_CLIENTS.get(loop)
+    if client is None:
+        settings = CONFIG["api"].get("http_pool", {})
+        max_connections = int(settings.get("per_host_connections", 10)) * int(settings.get("max_hosts", 16))
+        keep_alive = bool(settings.get("keep_alive", True))
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_connections if keep_alive else 0),
+            headers=None if keep_alive else {"Connection": "close"}, follow_redirects=True)
+        _ASYNC_CLIENTS[loop] = client
+    return client
+
+
+async def _http_request_async(method: str, url: str, provider: str = None, deadline: float = None,
+                              stream: bool = False, **kwargs) -> "httpx.Response":
+    # 与 _http_request 相同的限流/重试策略；stream=True 时调用方负责 await response.aclose()
+    client = _get_async_client()
+    max_retries, deadline = int(CONFIG["api"].get("max_retries", 3)), _call_deadline(deadline)
+    limiter = _rate_limiter(provider) if provider else None
+    idempotent, retryable_codes = method.upper() in _IDEMPOTENT_METHODS, _retryable_status_codes(method)
+    attempt = 0
+    while True:
+        if limiter is not None and not await limiter.acquire_async(deadline): raise _rate_limit_error(provider)
+        try:
+            response = await client.send(client.build_request(method, url, **kwargs), stream=stream)
+        except httpx.TransportError as e_request:
+            delay = _backoff_delay(attempt)
+            # ConnectError/ConnectTimeout/PoolTimeout 时请求尚未发出
+            if not (idempotent or isinstance(e_request, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))):
+                raise
+            if attempt >= max_retries or time.monotonic() + delay > deadline: raise
+        else:
+            if response.status_code not in retryable_codes or attempt >= max_retries: return response
+            delay = _backoff_delay(attempt, _parse_retry_after(response.headers.get("Retry-After")))
+            if time.monotonic() + delay > deadline: return response
+            await response.aclose()
+        logger.debug("%s %s 第 %d 次重试，等待 %.2fs", method, urlsplit(url).netloc, attempt + 1, delay)
+        attempt += 1
+        await asyncio.sleep(delay)
+
+
+async def _search_source_async(source: str, query: str, per_page: int, timeout: float,
+                               deadline: float = None) -> list[dict]:
+    cached = _SEARCH_CACHE.get(source, query, per_page)
+    if cached is not None: return cached
+    return await _SINGLE_FLIGHT.do_async(_search_flight_key(source, query, per_page), _fetch_search_async, source,
+                                         query, per_page, timeout, deadline)
+
+
+async def _fetch_search_async(source: str, query: str, per_page: int, timeout: float,
+                              deadline: float = None) -> list[dict]:
+    api_url, headers, params = _SEARCH_PROVIDERS[source][0](query, per_page)
+    with _stage("upstream", source) as stage:
+        response = await _http_request_async("GET", api_url, provider=source, deadline=deadline, headers=headers,
+                                             params=params, timeout=timeout)
+        stage["bytes_in"], stage["error"] = len(response.content), response.status_code != 200
+    return _finish_search(source, query, per_page, response)
+
+
+async def _search_many_async(sources: list[str], query: str, per_page: int, api_timeout: float) -> dict:
+    deadline = float(CONFIG["api"].get("search_deadline", api_timeout))
+    started = time.monotonic()
+
+    async def run(name: str):
+        try:
+            return await asyncio.wait_for(
+                _search_source_async(name, query, per_page, min(api_timeout, deadline), started + deadline), deadline)
+        except asyncio.TimeoutError:
+            return None
+        except Exception as e:
+            return e
+
+    outcomes = dict(zip(sources, await asyncio.gather(*(run(name) for name in sources))))
+    return _search_summary(sources, outcomes, per_page, deadline, started)
+
+
+@app.tool()
+@_metered(provider_arg="source")
+async def search_images_async(query: str, source: str = "unsplash", max_results: str = "10") -> str:
+    """search_images 的异步版本，参数与返回值相同。"""
+    if httpx is None: return await _run_blocking(_unmetered(search_images), query, source, max_results)
+    try:
+        sources, max_results_int, api_timeout, fan_out = _search_params(source, max_results)
+    except ValueError as ve:
+        return json.dumps({"success": False, "error": str(ve)})
+    if fan_out:
+        return json.dumps(await _search_many_async(sources, query, max_results_int, api_timeout))
+    try:
+        results = await _search_source_async(sources[0], query, max_results_int, api_timeout)
+    except Exception as e:
+        return json.dumps({"success": False, "error": _search_error_message(e)})
+    return json.dumps({"success": True, "results": results})
+
+
+async def _stream_download_async(url: str, save_path: str, timeout: float, sha256: str = None) -> dict:
+    # 网络读取在事件循环上进行，读取续传文件、写盘、计算摘要与替换文件都放到线程池中
+    part, keep_partial = await _run_blocking(_PartialDownload, url, save_path, sha256), False
+    try:
+        attempt = 0
+        while True:
             try:
-                from volcenginesdkcv20240606.models.logo_info_for_aigc_stylize_image_input import \
-                    LogoInfoForAIGCStylizeImageInput as LogoInfoParam
-            except ImportError:
+                response = await _http_request_async("GET", url, stream=True, timeout=timeout,
+                                                     headers=part.request_headers())
                 try:
-                    from volcenginesdkcv20240606.models.logo_info_param import LogoInfoParam
-                except ImportError:
-                    return json.dumps({"success": False, "error": "无法导入火山引擎LogoInfo模型。"})
-
-            logo_info_obj = LogoInfoParam()
-            logo_info_obj.add_logo = add_logo
-            logo_info_obj.position = int(logo_position)
-            logo_info_obj.language = int(logo_language)
-            logo_info_obj.opacity = float(logo_opacity)
-            if logo_text_content: logo_info_obj.logo_text_content = logo_text_content
-            aigc_stylize_image_request.logo_info = logo_info_obj
-
-        print("DEBUG: Calling Volcengine API: a_igc_stylize_image...")
-        api_response = api_instance.a_igc_stylize_image(aigc_stylize_image_request)
-        print("DEBUG: API call completed.")
-        # print(f"DEBUG: Full API Response content: {api_response}") # 非常重要！！！调试时务必取消注释查看此输出
-
-        # --- MODIFIED RESPONSE HANDLING ---
-        request_id_str = "N/A"
-        # 尝试从不同位置获取 request_id
-        if hasattr(api_response, 'result') and api_response.result and \
-                hasattr(api_response.result, 'algorithm_base_resp') and api_response.result.algorithm_base_resp and \
-                hasattr(api_response.result.algorithm_base_resp,
-                        'request_id') and api_response.result.algorithm_base_resp.request_id:
-            request_id_str = api_response.result.algorithm_base_resp.request_id
-        elif hasattr(api_response, 'request_id') and api_response.request_id:
-            request_id_str = api_response.request_id
-        # 您的日志显示成功时顶层有 code=10000, 和 data.request_id
-        elif hasattr(api_response, 'data') and api_response.data and hasattr(api_response.data,
-                                                                             'request_id') and api_response.data.request_id:
-            request_id_str = api_response.data.request_id
-
-        # 检查成功条件 (基于您的成功日志结构)
-        if hasattr(api_response, 'code') and getattr(api_response, 'code', -1) == 10000 and \
-                hasattr(api_response, 'data') and api_response.data and \
-                hasattr(api_response.data, 'binary_data_base64') and api_response.data.binary_data_base64 and \
-                isinstance(api_response.data.binary_data_base64, list) and len(
-            api_response.data.binary_data_base64) > 0 and \
-                isinstance(api_response.data.binary_data_base64[0], str) and api_response.data.binary_data_base64[0]:
-
-            output_image_b64 = api_response.data.binary_data_base64[0]
-            output_format_to_save = image_original_format if image_original_format else "png"
-
-            saved_path_final = save_image_from_base64(
-                output_image_b64, final_file_name, os.path.dirname(save_path),
-                image_format=output_format_to_save
-            )
-
-            if saved_path_final:
-                return json.dumps({
-                    "success": True,
-                    "message": f"图片风格化成功 ('{style_name}'). '{final_file_name}' 已保存到: {os.path.dirname(save_path)}",
-                    "file_path": saved_path_final, "file_name": final_file_name,
-                    "style_applied": style_name, "request_id": request_id_str
-                })
-            else:
-                return json.dumps(
-                    {"success": False, "error": "风格化成功但保存输出图片失败。", "request_id": request_id_str})
+                    chunk_size = await _run_blocking(part.begin, response.status_code, response.headers)
+                    if chunk_size:
+                        async for chunk in response.aiter_bytes(chunk_size):
+                            await _run_blocking(part.write, chunk)
+                finally:
+                    await response.aclose()
+                return await _run_blocking(part.finish)
+            except (httpx.TransportError, _IncompleteDownload) as e_drop:
+                keep_partial = True
+                if attempt >= _resume_attempts(): raise
+                attempt += 1
+                logger.debug("下载中断 (%s)，从 %d 字节处第 %d 次续传: %s", e_drop, part.offset, attempt, url)
+            except Exception:
+                keep_partial = False
+                raise
+    finally:
+        await _run_blocking(part.close, keep_partial)
+
+
+@app.tool()
+@_metered()
+async def download_image_async(url: str, file_name: str, save_folder: str = None, derivatives: bool = None,
+                               sha256: str = None) -> str:
+    """download_image 的异步版本，参数与返回值相同。"""
+    if httpx is None:
+        return await _run_blocking(_unmetered(download_image), url, file_name, save_folder, derivatives, sha256)
+    save_path = None
+    try:
+        save_path, _, final_file_name = _handle_save_path(file_name, save_folder)
+        info = await _fetch_download_async(url, save_path, CONFIG["api"].get("timeout", 60), sha256)
+        return json.dumps(await _with_derivatives_async(_download_success(save_path, final_file_name, info),
+                                                        derivatives))
+    except Exception as e:
+        _remove_quietly(save_path)
+        return json.dumps({"success": False, "error": _download_error_message(e)})
+
+
+@app.tool()
+@_metered()
+async def download_images_async(items: str, save_folder: str = None, max_workers: int = None,
+                                per_host_limit: int = None) -> str:
+    """download_images 的异步版本，参数与返回值相同。"""
+    if httpx is None:
+        return await _run_blocking(_unmetered(download_images), items, save_folder, max_workers, per_host_limit)
+    started = time.monotonic()
+    try:
+        jobs, results, workers, host_limit = _plan_downloads(items, save_folder, max_workers, per_host_limit)
+    except ValueError as ve:
+        return json.dumps({"success": False, "error": str(ve)})
+    timeout = CONFIG["api"].get("timeout", 60)
+    worker_slots = asyncio.Semaphore(workers)
+    host_slots = {netloc: asyncio.Semaphore(host_limit) for netloc in {urlsplit(job[1]).netloc.lower() for job in jobs}}
+
+    async def run(index: int, url: str, save_path: str, final_file_name: str) -> dict:
+        item_started, error, result = time.monotonic(), None, {"index": index, "url": url, "file_name": final_file_name}
+        try:
+            async with worker_slots, host_slots[urlsplit(url).netloc.lower()]:
+                result.update(await _fetch_download_async(url, save_path, timeout))
+        except Exception as e:
+            error = e
+        return _finish_download_item(result, save_path, error, item_started)
+
+    results.extend(await asyncio.gather(*(run(*job) for job in jobs)))
+    return _download_summary(results, started)
+
+
+@app.tool()
+@_metered(provider="together")
+async def generate_icon_togetherai_async(prompt: str, file_name: str, save_folder: str = None, width: int = None,
+                                         height: int = None, derivatives: bool = None, n: int = 1,
+                                         prompts: list[str] = None, response_format: str = "b64_json",
+                                         seed: int = None) -> str:
+    """generate_icon_togetherai 的异步版本，参数与返回值相同。"""
+    if httpx is None:
+        return await _run_blocking(_unmetered(generate_icon_togetherai), prompt, file_name, save_folder, width,
+                                   height, derivatives, n, prompts, response_format, seed)
+    try:
+        prompt_list = _together_plan(prompt, prompts, n, response_format, file_name)
+        requests_list = [_together_request(item, width, height, n, response_format, seed) for item in prompt_list]
+    except ValueError as ve:
+        return json.dumps({"success": False, "error": str(ve)})
+
+    async def generate(request: tuple):
+        try:
+            cached = await _run_blocking(_cached_generation, request[2])
+            if cached: return cached
+            return _together_outputs(*await _together_call_async(*request), response_format,
+                                     _generation_cache_keys(request[2]))
+        except Exception as e:
+            return e
+
+    async def save(job: tuple) -> dict:
+        # base64 解码与写盘放到线程池，避免大图阻塞事件循环
+        info, output, name = job
+        if output.get("url"):
+            result = await _save_together_output_async(output, name, save_folder, derivatives)
         else:
-            # 如果不符合上述成功结构，则尝试提取错误信息
-            error_detail = "火山引擎API未返回预期的成功状态或图像数据。"
-            # 尝试从 result.algorithm_base_resp 获取错误 (常见于业务失败但HTTP成功)
-            if hasattr(api_response, 'result') and api_response.result and \
-                    hasattr(api_response.result, 'algorithm_base_resp') and api_response.result.algorithm_base_resp:
-                algo_resp = api_response.result.algorithm_base_resp
-                algo_status_code = getattr(algo_resp, 'status_code', -1)
-                algo_status_message = getattr(algo_resp, 'status_message', "N/A")
-                if algo_status_code != 0:  # 假设0是内部算法成功码
-                    error_detail = f"算法处理错误: StatusCode={algo_status_code}, StatusMessage='{algo_status_message}'"
-            # 尝试从顶层 code 和 message 获取错误 (如果存在且 code 不是成功码)
-            elif hasattr(api_response, 'code') and hasattr(api_response, 'message'):
-                top_code = getattr(api_response, 'code', -1)
-                top_message = getattr(api_response, 'message', 'N/A')
-                if top_code != 10000:  # 假设10000是通用成功码
-                    error_detail = f"火山引擎API业务错误: Code={top_code}, Message='{top_message}'"
-
-            print(f"ERROR: {error_detail}")
-            print(f"DEBUG: API Response for error diagnosis: {api_response}")
-            return json.dumps({"success": False, "error": error_detail, "request_id": request_id_str})
-
-    except ApiException as e:
-        # ... (ApiException 处理与之前相同) ...
-        error_message_detail = str(e.body) if e.body else str(e)
-        try:
-            error_body_json = json.loads(e.body); error_message_detail = error_body_json.get("Error", {}).get("Message",
-                                                                                                              error_message_detail)
-        except:
-            pass
-        print(f"Volcengine API Exception: Status={e.status}, Code={e.code}, Message='{error_message_detail}'")
-        return json.dumps({"success": False,
-                           "error": f"火山引擎API异常: Status={e.status}, Code={e.code}, Msg='{error_message_detail}'"})
-    except Exception as e_gen:
-        print(f"火山引擎风格化时发生未知错误: {e_gen}")
-        traceback.print_exc()
-        return json.dumps({"success": False, "error": f"火山引擎风格化时发生未知错误: {str(e_gen)}"})
+            result = await _run_blocking(_save_together_output, output, name, save_folder, False)
+            result = await _with_derivatives_async(result, derivatives)
+        return {**info, **result}
+
+    outcomes = await asyncio.gather(*(generate(request) for request in requests_list))
+    jobs, results = _together_jobs(prompt_list, int(n), file_name, outcomes)
+    results.extend(await asyncio.gather(*(save(job) for job in jobs)))
+    return _together_summary(prompt_list, int(n), results)
+
+
+async def _save_together_output_async(output: dict, file_name: str, save_folder: str,
+                                     derivatives: bool | None) -> dict:
+    save_path, final_file_name = None, file_name
+    try:
+        save_path, _, final_file_name = _handle_save_path(file_name, save_folder)
+        with _stage("download", "together") as stage:
+            info = await _stream_download_async(output["url"], save_path, CONFIG["api"].get("timeout", 60))
+            stage["bytes_in"] = info["bytes"]
+        await _run_blocking(_cache_generation_output, output, save_path)
+        result = _generation_success(save_path, final_file_name, output)
+    except Exception as e:
+        _release_save_path(save_path)
+        return {"success": False, "file_name": final_file_name, "error": f"保存生成的图片时出错: {e}"}
+    return await _with_derivatives_async(result, derivatives)
+
+
+@app.tool()
+@_metered(provider="volcengine", style_arg="style_name")
+async def volcengine_style_transfer_async(
+        input_image_path: str,
+        style_name: str,
+        file_name: str,
+        save_folder: str = None,
+        add_logo: bool = False,
+        logo_position: int = 0,
+        logo_language: int = 0,
+        logo_opacity: float = 0.3,
+        logo_text_content: str = None
+) -> str:
+    """volcengine_style_transfer 的异步版本，参数与返回值相同；SDK 调用在独立的火山引擎线程池中执行。"""
+    return await _run_blocking(
+        _unmetered(volcengine_style_transfer), input_image_path, style_name, file_name, save_folder, add_logo,
+        logo_position, logo_language, logo_opacity, logo_text_content, executor=_get_volcengine_executor())
+
+
+# --- 异步任务队列 (jobs) ---
+# submit_job 立即返回任务 id，任务由本地工作线程按提交顺序执行，客户端用 get_job_status/get_job_result 轮询，
+# 不必在整个上游调用期间保持 MCP 调用。任务与结果持久化在 output.base_folder 下的 SQLite 文件中，可被共享该目录的
+# 多个服务进程同时消费；执行中的任务由所属进程定期续租 (heartbeat)，进程退出后租约 (jobs.lease 秒) 过期的任务
+# 重新排队，达到 jobs.max_attempts 次后标记为失败。
+_JOB_FINISHED = ("succeeded", "failed")
+
+
+class _JobQueue:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)  # 有新任务或工作线程数变化
+        self._conn = None
+        self._path = None
+        self._owner = uuid.uuid4().hex
+        self._tools = {}
+        self._workers = {}
+        self._maintenance = None
+
+    def register(self, func):
+        self._tools[func.__name__] = func
+        return func
+
+    def tools(self) -> list[str]:
+        return sorted(self._tools)
+
+    def _db(self):
+        # 调用方持有 self._lock
+        if self._conn is None:
+            import sqlite3
+
+            self._path = os.path.join(CONFIG["output"]["base_folder"], CONFIG["jobs"]["database"])
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            conn = sqlite3.connect(self._path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS jobs (seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT UNIQUE NOT NULL, "
+                         "tool TEXT NOT NULL, arguments TEXT NOT NULL, status TEXT NOT NULL, "
+                         "attempts INTEGER NOT NULL DEFAULT 0, owner TEXT, heartbeat_at REAL, created_at REAL NOT NULL, "
+                         "started_at REAL, finished_at REAL, result TEXT, error TEXT)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, seq)")
+            self._conn = conn
+            self._recover()
+        return self._conn
+
+    def _recover(self):
+        # 租约过期的执行中任务: 所属进程已退出或卡死
+        settings, now = CONFIG["jobs"], time.time()
+        stale_before = now - float(settings["lease"])
+        failed = self._conn.execute(
+            "UPDATE jobs SET status='failed', owner=NULL, finished_at=?, error=? "
+            "WHERE status='running' AND heartbeat_at < ? AND attempts >= ?",
+            (now, "任务执行被中断 (服务重启或进程退出)，已达到最大尝试次数", stale_before,
+             int(settings["max_attempts"]))).rowcount
+        requeued = self._conn.execute(
+            "UPDATE jobs SET status='queued', owner=NULL, started_at=NULL "
+            "WHERE status='running' AND heartbeat_at < ?", (stale_before,)).rowcount
+        purged = self._conn.execute(
+            "DELETE FROM jobs WHERE status IN ('succeeded', 'failed') AND finished_at < ?",
+            (now - float(settings["retention_days"]) * 86400,)).rowcount
+        if failed or requeued: logger.warning("任务恢复: %d 个中断的任务重新排队，%d 个标记为失败", requeued, failed)
+        if purged: logger.info("已清理 %d 个过期的已完成任务", purged)
+        if requeued: self._wakeup.notify_all()
+
+    def submit(self, tool: str, arguments: dict) -> dict:
+        func = self._tools.get(tool)
+        if func is None: raise ValueError(f"不支持的任务工具: {tool}. 可选: {', '.join(self.tools())}")
+        try:
+            inspect.signature(func).bind(**arguments)
+            encoded = json.dumps(arguments, ensure_ascii=False)
+        except (TypeError, ValueError) as e_args:
+            raise ValueError(f"{tool} 的参数无效: {e_args}")
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            db = self._db()
+            queued = db.execute("SELECT COUNT(*) FROM jobs WHERE status='queued'").fetchone()[0]
+            if queued >= int(CONFIG["jobs"]["max_queued"]):
+                raise ValueError(f"任务队列已满 ({queued} 个排队中)，请稍后重试")
+            db.execute("INSERT INTO jobs (id, tool, arguments, status, created_at) VALUES (?, ?, ?, 'queued', ?)",
+                       (job_id, tool, encoded, time.time()))
+            self._wakeup.notify()
+        self.start()
+        return {"job_id": job_id, "tool": tool, "status": "queued", "position": queued}
+
+    def _describe(self, row) -> dict:
+        job = {key: row[key] for key in ("tool", "status", "attempts", "created_at", "started_at", "finished_at",
+                                         "error")}
+        job["job_id"] = row["id"]
+        if row["status"] == "queued":
+            job["position"] = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status='queued' AND seq < ?",
+                                                 (row["seq"],)).fetchone()[0]
+        return job
+
+    def status(self, job_id: str) -> dict | None:
+        with self._lock:
+            row = self._db().execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone()
+            return self._describe(row) if row is not None else None
+
+    def recent(self, limit: int) -> dict:
+        with self._lock:
+            db = self._db()
+            rows = db.execute("SELECT * FROM jobs ORDER BY seq DESC LIMIT ?", (max(1, int(limit)),)).fetchall()
+            counts = dict(db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            return {"counts": counts, "workers": sum(1 for thread in self._workers.values() if thread.is_alive()),
+                    "database": self._path, "jobs": [self._describe(row) for row in rows]}
+
+    def result(self, job_id: str) -> dict | None:
+        with self._lock:
+            row = self._db().execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone()
+            if row is None: return None
+            job = self._describe(row)
+            if row["result"] is not None: job["result"] = json.loads(row["result"])
+            return job
+
+    def _claim(self):
+        # 调用方持有 self._lock；条件更新保证多个进程不会领取同一个任务
+        db = self._db()
+        while True:
+            row = db.execute("SELECT id, tool, arguments FROM jobs WHERE status='queued' ORDER BY seq LIMIT 1").fetchone()
+            if row is None: return None
+            now = time.time()
+            claimed = db.execute("UPDATE jobs SET status='running', owner=?, attempts=attempts+1, started_at=?, "
+                                 "heartbeat_at=? WHERE id=? AND status='queued'",
+                                 (self._owner, now, now, row["id"])).rowcount
+            if claimed: return row
+
+    def _run(self, job):
+        func = self._tools.get(job["tool"])
+        result, status, error = None, "failed", None
+        try:
+            if func is None: raise ValueError(f"不支持的任务工具: {job['tool']}")
+            result = func(**json.loads(job["arguments"]))
+            payload = json.loads(result)
+            status = "succeeded" if payload.get("success") else "failed"
+            if status == "failed": error = payload.get("error") or "任务执行失败，详见 result"
+        except Exception as e_job:
+            logger.error("任务 %s (%s) 执行失败: %s", job["id"], job["tool"], e_job)
+            error = str(e_job)
+        with self._lock:
+            self._db().execute("UPDATE jobs SET status=?, owner=NULL, finished_at=?, result=?, error=? "
+                               "WHERE id=? AND owner=?", (status, time.time(), result, error, job["id"], self._owner))
+
+    def _work(self, slot: int):
+        while True:
+            with self._lock:
+                if slot >= int(CONFIG["jobs"]["workers"]):
+                    self._workers.pop(slot, None)
+                    return
+                try:
+                    job = self._claim()
+                except Exception as e_claim:
+                    logger.error("领取任务失败: %s", e_claim)
+                    job = None
+                if job is None:
+                    self._wakeup.wait(float(CONFIG["jobs"]["poll_interval"]))
+                    continue
+            self._run(job)
+
+    def _maintain(self):
+        # 为本进程执行中的任务续租，并回收其他进程遗留的过期任务
+        while True:
+            time.sleep(max(0.5, float(CONFIG["jobs"]["lease"]) / 3))
+            try:
+                with self._lock:
+                    self._conn.execute("UPDATE jobs SET heartbeat_at=? WHERE owner=? AND status='running'",
+                                       (time.time(), self._owner))
+                    self._recover()
+            except Exception as e_maintain:
+                logger.error("任务队列维护失败: %s", e_maintain)
+
+    def start(self):
+        with self._lock:
+            self._db()
+            for slot in range(int(CONFIG["jobs"]["workers"])):
+                thread = self._workers.get(slot)
+                if thread is None or not thread.is_alive():
+                    thread = self._workers[slot] = threading.Thread(target=self._work, args=(slot,),
+                                                                    name=f"job-worker-{slot}", daemon=True)
+                    thread.start()
+            if self._maintenance is None:
+                self._maintenance = threading.Thread(target=self._maintain, name="job-maintenance", daemon=True)
+                self._maintenance.start()
+            self._wakeup.notify_all()
+
+    def resize(self):
+        # jobs.workers 变化: 多出的工作线程在当前任务完成后退出
+        if self._conn is not None: self.start()
+
+
+_JOBS = _JobQueue()
+for _job_tool in (generate_icon_togetherai, volcengine_style_transfer, volcengine_style_transfer_batch,
+                  download_image, download_images):
+    _JOBS.register(_job_tool)
+_CONFIG.subscribe("jobs.workers", _JOBS.resize)
+
+
+@app.tool()
+def submit_job(tool: str, arguments: dict | str = None) -> str:
+    """提交后台任务并立即返回 job_id，适用于耗时较长的调用 (如 generate_icon_togetherai、volcengine_style_transfer)。
+    tool 为工具名，arguments 为该工具的参数 (对象或 JSON 字符串)；之后用 get_job_status / get_job_result 查询。
+    任务保存在本地 SQLite 中，服务重启后排队中的任务继续执行。"""
+    try:
+        if isinstance(arguments, str): arguments = json.loads(arguments) if arguments.strip() else {}
+        if arguments is None: arguments = {}
+        if not isinstance(arguments, dict): raise ValueError("arguments 必须是 JSON 对象")
+        return json.dumps({"success": True, **_JOBS.submit(str(tool).strip(), arguments)}, ensure_ascii=False)
+    except ValueError as ve:
+        return json.dumps({"success": False, "error": str(ve)}, ensure_ascii=False)
+
+
+@app.tool()
+def get_job_status(job_id: str = None, limit: int = 20) -> str:
+    """返回任务状态 (queued/running/succeeded/failed)、排队位置、尝试次数与时间戳；不指定 job_id 时返回最近 limit 个任务与各状态计数。"""
+    if not job_id:
+        return json.dumps({"success": True, **_JOBS.recent(limit)}, ensure_ascii=False)
+    job = _JOBS.status(job_id)
+    if job is None: return json.dumps({"success": False, "error": f"任务不存在: {job_id}"}, ensure_ascii=False)
+    return json.dumps({"success": True, **job}, ensure_ascii=False)
+
+
+@app.tool()
+async def get_job_result(job_id: str, wait_seconds: float = 0) -> str:
+    """返回已完成任务的结果: result 字段与直接调用该工具的返回值相同。wait_seconds > 0 时最多等待这么久 (上限 60 秒)
+    直到任务完成；任务仍未完成时返回 success=false 与当前状态。"""
+    try:
+        wait = min(max(0.0, float(wait_seconds or 0)), 60.0)
+    except (TypeError, ValueError):
+        return json.dumps({"success": False, "error": "wait_seconds 必须是数字"})
+    # 等待期间在事件循环上休眠，只把每次 SQLite 查询放到线程池，长轮询不占用工作线程
+    deadline = time.monotonic() + wait
+    while True:
+        job = await _run_blocking(_JOBS.result, job_id)
+        remaining = deadline - time.monotonic()
+        if job is None or job["status"] in _JOB_FINISHED or remaining <= 0: break
+        await asyncio.sleep(min(remaining, float(CONFIG["jobs"]["poll_interval"])))
+    if job is None: return json.dumps({"success": False, "error": f"任务不存在: {job_id}"}, ensure_ascii=False)
+    if job["status"] not in _JOB_FINISHED:
+        return json.dumps({"success": False, **job, "error": f"任务尚未完成 (当前状态: {job['status']})"},
+                          ensure_ascii=False)
+    return json.dumps({"success": job["status"] == "succeeded", **job}, ensure_ascii=False)
+
+
+@app.tool()
+def get_config_status(reload: bool = False) -> str:
+    """返回当前配置快照的版本、加载时间、是否在监视 config.json 以及最近一次热更新错误；reload=True 时先立即重新加载配置 (文件与环境变量)，校验失败则保留当前配置。"""
+    result = _CONFIG.reload() if reload else None
+    return json.dumps({"success": result is None or result["success"], "reload": result, "status": _CONFIG.status()},
+                      ensure_ascii=False)
+
+
+def _startup_report() -> dict:
+    # sys.modules 只用于查看哪些重量级依赖已被加载，不会触发导入
+    heavy_modules = ("PIL", "requests", "httpx", "volcenginesdkcore", "volcenginesdkcv20240606")
+    return {"phases_ms": dict(_STARTUP_REPORT["phases_ms"]), "lazy_imports_ms": dict(_STARTUP_REPORT["lazy_imports_ms"]),
+            "loaded_modules": [name for name in heavy_modules if sys.modules.get(name) is not None],
+            "backends": {name: backend.status() for name, backend in _BACKENDS.items()}}
+
+
+@app.tool()
+def get_startup_report() -> str:
+    """返回服务启动耗时 (导入/配置/就绪各阶段，毫秒)、之后按需加载的依赖及其导入耗时，以及各可选后端 (如火山引擎 SDK) 是否可用/已加载。"""
+    return json.dumps({"success": True, "report": _startup_report()}, ensure_ascii=False)
+
 
+_mark_startup("ready")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Volcengine Image Style Transfer CLI for MCP")
@@ -579,7 +3982,12 @@ if __name__ == "__main__":
     parser.add_argument("--logo_language", type=int, default=0,
                         help="Logo language for Volcengine API (e.g., 0 for zh, 1 for en, check API docs).")
     parser.add_argument("--logo_opacity", type=float, default=0.3, help="Logo opacity for Volcengine API (0.0-1.0).")
+    parser.add_argument("--startup_report", action='store_true',
+                        help="Print the startup timing report as JSON and exit without starting the server.")
     args = parser.parse_args()
+    if args.startup_report:
+        print(json.dumps(_startup_report(), ensure_ascii=False, indent=2))
+        sys.exit(0)
     DEFAULT_TEST_IMAGE_PATH = r"C:\mcp\images_mcp\icons\cat_generated.jpg"
     cli_image_path = args.image_path if args.image_path else DEFAULT_TEST_IMAGE_PATH
     cli_style_name = args.style_name if args.style_name else "动漫风"
@@ -610,6 +4018,11 @@ if __name__ == "__main__":
                 print(f">>> Error: {result_data.get('error')}")
         except:
             pass
+    _ensure_config_file()
+    _CONFIG.start_watching()
+    # 有任务数据库时立即启动工作线程，继续执行上次未完成的任务；否则在首次 submit_job 时启动
+    if os.path.exists(os.path.join(CONFIG["output"]["base_folder"], CONFIG["jobs"]["database"])): _JOBS.start()
+    logger.info("启动耗时: %s ms (按需加载的依赖未计入)", _STARTUP_REPORT["phases_ms"].get("ready"))
     print("--- Starting FastMCP server ---")
     try:
         import uvicorn
@@ -621,7 +4034,7 @@ if __name__ == "__main__":
                     asgi_app_to_run = app.sse_app()
                 except Exception:
                     pass
-            uvicorn.run(asgi_app_to_run, host=CONFIG['server']['host'], port=CONFIG['server']['port'])
+            uvicorn.run(_with_metrics_route(asgi_app_to_run), host=CONFIG['server']['host'], port=CONFIG['server']['port'])
         else:
             print("错误: FastMCP 应用实例未正确初始化，无法启动服务器。")
     except ImportError: